@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Greppy benchmarks.
+
+Generates seeded synthetic csv files, runs greppy over them with a scenario for each kind of match clause,
+and reports rows/s, MB/s, peak memory and timings as JSON, so engines and options can be compared on the
+same data.  For example,
+
+    python3 benchmarks/greppy_bench.py --size 256M --shape narrow wide --modes default fast python -o report.json
+
+Generated files are kept in --work-dir (a temporary directory by default) and reused by later runs
+with the same settings.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+GREPPY = Path(__file__).resolve().parent.parent / 'runner' / 'greppy.py'
+sys.path.insert(0, str(GREPPY.parent))
+from greppy import parse_program, parse_rules, generate_awk_script, parse_size, fields_from_header  # noqa: E402
+
+CATEGORIES = ['grocery', 'snacks', 'pets', 'garden', 'hardware', 'toys', 'books', 'music', 'tools', 'office']
+WORDS = ['plain', 'fancy', 'salty', 'sugar', 'peanut', 'butter', 'crumpets', 'pretzels', 'jerky', 'treats',
+         'brittle', 'cheeze', 'mystery', 'dog', 'cat', 'organic', 'deluxe', 'mini', 'family', 'pack']
+
+# Columns of each shape.  Wide files add filler columns after the four that the scenarios search.
+SHAPES = {'narrow': 4, 'wide': 24}
+BASE_COLUMNS = ['ProductId', 'ProductPrice', 'ProductDescription', 'ProductCategory']
+
+# Scenarios: (name, match lines).  Field names are replaced with $n references for files without a header.
+SCENARIOS = [
+    ('equal', ['ProductCategory | pets']),
+    ('list', ['ProductId | [100017, 100034, 100051, 100068, 100085]']),
+    ('regex', ['ProductDescription | /peanut/']),
+    ('order', ['ProductPrice | > 90']),
+    ('awk', ['!AWK | ProductPrice > 50 && length(ProductDescription) > 20']),
+    ('not', ['NOT', 'ProductCategory | [grocery, snacks, pets]']),
+    ('and', ['AND', 'ProductDescription | /salty/', 'NOT | ProductCategory | snacks', 'ProductPrice | < 25']),
+    ('or', ['OR', 'ProductCategory | toys', 'ProductDescription | /deluxe/', 'ProductId | 12345']),
+]
+
+# Greppy options for each mode
+MODES = {
+    'default': [],
+    'fast': ['--fast'],
+    'python': ['--engine', 'python'],
+    'jobs': ['--jobs', '0'],
+    'fast-jobs': ['--fast', '--jobs', '0'],
+    'chunks': ['--jobs', '0', '--chunk-size', '64M'],
+}
+
+
+def column_names(shape: str) -> List[str]:
+    """Get the column names for a shape of file."""
+    return BASE_COLUMNS + [f'Extra{i}' for i in range(SHAPES[shape] - len(BASE_COLUMNS))]
+
+
+def generate_csv(path: str, size: int, shape: str = 'narrow', separator: str = '|', header: bool = True,
+                 seed: int = 1, first_id: int = 100000) -> int:
+    """
+    Write a csv file of synthetic product records.
+    args:
+        path: The file to write.
+        size: The approximate size of the file in bytes.  Records are added until it is reached.
+        shape: 'narrow' or 'wide' (see SHAPES).
+        separator: The field separator.
+        header: A boolean indicating if the file starts with a header line.
+        seed: The random seed.  The same seed and settings always give the same file.
+        first_id: The ProductId of the first record.  ProductIds count up from it.
+    returns:
+        The number of records written, not counting the header.
+    """
+    rng = random.Random(seed)
+    extra = SHAPES[shape] - len(BASE_COLUMNS)
+    # Put spaces around the separator for pipe files, like the greppy examples
+    sep = f' {separator} ' if separator == '|' else separator
+    rows = 0
+    written = 0
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        if header:
+            line = sep.join(column_names(shape)) + '\n'
+            f.write(line)
+            written += len(line)
+        block = []
+        while written < size:
+            description = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+            values = [str(first_id + rows), f'{rng.uniform(0, 100):.2f}', description, rng.choice(CATEGORIES)]
+            values += [str(rng.randint(0, 999999)) for _ in range(extra)]
+            line = sep.join(values) + '\n'
+            block.append(line)
+            written += len(line)
+            rows += 1
+            if len(block) == 10000:
+                f.write(''.join(block))
+                block = []
+        f.write(''.join(block))
+    return rows
+
+
+def make_dataset(work_dir: str, size: int, shape: str, separator: str, header: bool, seed: int,
+                 files: int) -> Dict:
+    """
+    Generate a dataset - a single csv file, or a directory of them if files > 1 - unless it exists already.
+    args:
+        work_dir: The directory to create the dataset in.
+        size: The total size in bytes.
+        shape, separator, header, seed: See generate_csv.
+        files: The number of files to split the dataset into.
+    returns:
+        A description of the dataset, with its path, row count, size and generation time.
+    """
+    name = f"{shape}_{'pipe' if separator == '|' else 'comma'}_{'header' if header else 'noheader'}_" \
+           f"{size}_{files}_{seed}"
+    path = os.path.join(work_dir, name)
+    meta_name = path + '.json'
+    if os.path.exists(meta_name):
+        with open(meta_name, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    start = time.perf_counter()
+    rows = 0
+    if files == 1:
+        path += '.csv'
+        rows = generate_csv(path, size, shape, separator, header, seed)
+    else:
+        os.makedirs(path, exist_ok=True)
+        for i in range(files):
+            rows += generate_csv(os.path.join(path, f'part{i:03}.csv'), size // files, shape, separator, header,
+                                 seed + i, first_id=100000 + i * 10000000)
+    dataset = {'name': name, 'path': path, 'shape': shape, 'separator': separator, 'header': header,
+               'files': files, 'rows': rows, 'bytes': dataset_bytes(path),
+               'generate_seconds': round(time.perf_counter() - start, 3)}
+    with open(meta_name, 'w', encoding='utf-8') as f:
+        json.dump(dataset, f)
+    return dataset
+
+
+def dataset_bytes(path: str) -> int:
+    """Get the total size of a dataset file or directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def program_text(dataset: Dict, lines: List[str]) -> str:
+    """
+    Write the greppy program for a scenario on a dataset.
+    args:
+        dataset: The dataset, from make_dataset.
+        lines: The match lines of the scenario.
+    returns:
+        The program text.
+    """
+    program = [dataset['path']]
+    if dataset['separator'] != '|':
+        program.append(f"!SEPARATOR {dataset['separator']}")
+    if not dataset['header']:
+        program.append('!NOHEADER')
+        # Refer to the columns by number, longest names first so ProductId doesn't match inside other names
+        for i, name in sorted(enumerate(BASE_COLUMNS), key=lambda item: -len(item[1])):
+            lines = [line.replace(name, f'${i + 1}') for line in lines]
+    return '\n'.join(program + lines) + '\n'
+
+
+def compile_seconds(text: str, dataset: Dict) -> float:
+    """Time parsing a program and generating its awk script, without running it."""
+    start = time.perf_counter()
+    program = parse_program(text)
+    fields = {}
+    if dataset['header']:
+        fields = fields_from_header(program.field_separator.join(column_names(dataset['shape'])),
+                                    program.field_separator)
+    generate_awk_script(parse_rules(program, fields), fields, program.field_separator, dataset['header'])
+    return time.perf_counter() - start
+
+
+def run_greppy(program_name: str, options: List[str], env: Dict[str, str]) -> Tuple[float, int, int, int]:
+    """
+    Run greppy once, counting its output lines.
+    args:
+        program_name: The greppy program file.
+        options: Other greppy command line options.
+        env: The environment to run it in.
+    returns:
+        (wall clock seconds, output lines, peak resident set size in KB, exit status).  The peak RSS is the
+        largest of greppy and the awk processes it waited for.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(GREPPY), program_name, '--stdout-only', *options],
+                            stdout=subprocess.PIPE, env=env)
+    lines = 0
+    while True:
+        block = proc.stdout.read(1024 * 1024)
+        if not block:
+            break
+        lines += block.count(b'\n')
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, lines, usage.ru_maxrss, proc.returncode
+
+
+def run_scenario(dataset: Dict, scenario: Tuple[str, List[str]], mode: str, repeat: int, work_dir: str,
+                 env: Dict[str, str]) -> Dict:
+    """
+    Benchmark one scenario on one dataset in one mode.
+    args:
+        dataset: The dataset, from make_dataset.
+        scenario: The scenario name and match lines.
+        mode: The key of the greppy options in MODES.
+        repeat: The number of timed runs.  The best time is reported, after an untimed warm up run.
+        work_dir: The directory to write the program file in.
+        env: The environment to run greppy in.
+    returns:
+        The results.
+    """
+    name, lines = scenario
+    text = program_text(dataset, lines)
+    program_name = os.path.join(work_dir, f"{dataset['name']}_{name}.txt")
+    with open(program_name, 'w', encoding='utf-8') as f:
+        f.write(text)
+    options = MODES[mode]
+    # Warm up the page cache and the script cache
+    run_greppy(program_name, options, env)
+    times = []
+    peak_rss = 0
+    for _ in range(repeat):
+        seconds, output_lines, rss, status = run_greppy(program_name, options, env)
+        if status != 0:
+            raise RuntimeError(f"greppy exited with status {status} for {name} on {dataset['name']} ({mode})")
+        times.append(seconds)
+        peak_rss = max(peak_rss, rss)
+    best = min(times)
+    return {
+        'dataset': dataset['name'],
+        'scenario': name,
+        'mode': mode,
+        'rows': dataset['rows'],
+        'bytes': dataset['bytes'],
+        'matched': output_lines - (1 if dataset['header'] and output_lines else 0),
+        'seconds': round(best, 4),
+        'rows_per_second': round(dataset['rows'] / best),
+        'mb_per_second': round(dataset['bytes'] / best / 1024 ** 2, 2),
+        'peak_rss_kb': peak_rss,
+        'stages': {
+            'generate_data': dataset['generate_seconds'],
+            'compile_program': round(compile_seconds(text, dataset), 6),
+            'run_median': round(sorted(times)[len(times) // 2], 4),
+            'run_best': round(best, 4),
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Main function."""
+    parser = argparse.ArgumentParser(description='Greppy benchmarks')
+    parser.add_argument('--size', type=parse_size, default=parse_size('64M'),
+                        help='Size of each dataset, e.g. 64M or 20G (default 64M)')
+    parser.add_argument('--shape', nargs='+', choices=list(SHAPES), default=['narrow'], help='File shapes')
+    parser.add_argument('--separator', nargs='+', default=['|'], help='Field separators, e.g. "|" ","')
+    parser.add_argument('--no-header', action='store_true', help='Also benchmark files without a header line')
+    parser.add_argument('--files', type=int, default=1,
+                        help='Split each dataset into this many files in a directory (default 1)')
+    parser.add_argument('--scenario', nargs='+', choices=[name for name, _ in SCENARIOS],
+                        default=[name for name, _ in SCENARIOS], help='Scenarios to run (default all)')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=['default'],
+                        help='Greppy modes to compare (default just default)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each benchmark (default 3)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the generated data (default 1)')
+    parser.add_argument('--work-dir', help='Directory for generated data, reused between runs '
+                        '(default a temporary directory that is removed afterwards)')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of standard output')
+    args = parser.parse_args(argv)
+    if 'chunks' in args.modes and (os.cpu_count() or 1) == 1:
+        parser.error('the chunks mode needs more than one CPU, since greppy only splits files between parallel jobs')
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='greppy_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    # Keep greppy's script cache and output out of the user's directories
+    env = dict(os.environ, GREPPY_CACHE_DIR=os.path.join(work_dir, 'cache'))
+    report = {'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+              'python': sys.version.split()[0], 'awk': shutil.which('gawk'),
+              'cpus': os.cpu_count(), 'datasets': [], 'results': []}
+    try:
+        for shape in args.shape:
+            for separator in args.separator:
+                for header in [True, False] if args.no_header else [True]:
+                    dataset = make_dataset(work_dir, args.size, shape, separator, header, args.seed, args.files)
+                    report['datasets'].append(dataset)
+                    for scenario in SCENARIOS:
+                        if scenario[0] not in args.scenario:
+                            continue
+                        for mode in args.modes:
+                            result = run_scenario(dataset, scenario, mode, args.repeat, work_dir, env)
+                            report['results'].append(result)
+                            print(f"{dataset['name']} {scenario[0]} {mode}: {result['mb_per_second']} MB/s",
+                                  file=sys.stderr)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,96 +1,297 @@
 """ Greppy: A simple grep-like utility for searching csv files or directories of csvs."""
 
 import argparse
+import ast
+import hashlib
+import heapq
+import io
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+import importlib
+from itertools import chain, islice, zip_longest
+import math
+import mmap
 import os
 from pathlib import Path
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
 import sys
-from typing import Dict, List, Tuple
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import subprocess
+try:
+    import resource
+except ImportError:  # Not available on Windows, where child CPU times are not reported
+    resource = None
 
 
-def get_operators(file_name: str) -> Tuple[str, bool]:
+# Directives that can appear in greppy programs, other than !AWK match conditions
+DIRECTIVES = ['!FIELDS', '!SEPARATOR', '!NOHEADER', '!SELECT', '!GROUPBY', '!AGG', '!QUOTED']
+
+# The file spec that designates standard input
+STDIN = '-'
+
+
+class Clause:
+    """
+    A match clause from a greppy program.
+        negate: boolean - whether or not the clause is negated
+        field:  string - can be a field name, empty string (full record match),
+                $n for column number or '!AWK' for awk match conditions
+        value:  string - value to match, as written in the program
+        kind:   string - 'awk' for awk match conditions, 'regex' for /regex/ values,
+                'order' for comparisons, 'list' for [a, b, c] lists and 'equal' for exact matches
+        values: list - the values in a list, or the value of an exact match, for 'list' and 'equal' clauses
+    """
+    __slots__ = ('negate', 'field', 'value', 'kind', 'values')
+
+    def __init__(self, negate: bool, field: str, value: str):
+        self.negate = negate
+        self.field = field
+        self.value = value
+        self.values = []
+        if field == '!AWK':
+            self.kind = 'awk'
+        elif value.startswith('/'):
+            self.kind = 'regex'
+        elif value[:1] in ['<', '>']:
+            self.kind = 'order'
+        elif value.startswith('[') and value.endswith(']'):
+            self.kind = 'list'
+            self.values = [v.strip() for v in value[1:-1].split(',')]
+        else:
+            self.kind = 'equal'
+            self.values = [value]
+
+    def __repr__(self):
+        return f"Clause({self.negate!r}, {self.field!r}, {self.value!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Clause) and \
+            (self.negate, self.field, self.value) == (other.negate, other.field, other.value)
+
+
+class GreppyProgram:
+    """
+    A parsed greppy program.
+        name:            string - the name of the program file, or None if it was not read from a file
+        file_spec:       string - the file or directory to be searched
+        path_type:       string - 'dir' if file_spec is a directory, 'stdin' if it is '-', 'file' otherwise
+        field_separator: string - the separator used in the csv files, from !SEPARATOR (default '|')
+        fields:          dict - field names and their column numbers from !FIELDS, or {} if not given
+        noheader:        boolean - whether the !NOHEADER directive is present
+        quoted:          boolean - whether the !QUOTED directive is present, so fields in double quotes can
+                         contain the separator (see get_splitter)
+        select:          list - the names of the columns to output from !SELECT, or [] for whole records
+        group_by:        list - the names of the columns to group matching records by, from !GROUPBY
+        aggregates:      list - (function, column name) for each aggregate to compute, from !AGG.  The column
+                         name is '' for count().
+        directives:      dict - the arguments of each directive in the program, keyed by directive name
+        operator:        string - '||' for OR, '&&' for AND or '' if neither is given
+        negate:          boolean - whether the NOT operator is present
+        clauses:         list - the match clauses, in program order
+        lines:           list - the program lines, without comments, blank lines or surrounding spaces
+    """
+    __slots__ = ('name', 'file_spec', 'path_type', 'field_separator', 'fields', 'noheader', 'quoted', 'select',
+                 'group_by', 'aggregates', 'directives', 'operator', 'negate', 'clauses', 'lines')
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.file_spec = ''
+        self.path_type = 'file'
+        self.field_separator = '|'
+        self.fields = {}
+        self.noheader = False
+        self.quoted = False
+        self.select = []
+        self.group_by = []
+        self.aggregates = []
+        self.directives = {}
+        self.operator = ''
+        self.negate = False
+        self.clauses = []
+        self.lines = []
+
+
+def get_path_type(file_spec: str) -> str:
     """
-    Scan the program file for single lines with 'NOT' and 'OR' or 'AND' operators.
+    Get the kind of input a file spec designates.
     args:
-        file_name: The name of the program file.
+        file_spec: The file or directory to be searched, or '-' for standard input.
     returns:
-        A tuple containing an operator ('OR' or 'AND') and a boolean indicating if 'NOT' is present.
+        'stdin' if file_spec is '-', 'dir' if it is a directory, 'file' otherwise.
     """
-    with open(file_name, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        operator = ''
-        negate = False
-        for line in lines:
-            line = line.strip()
-            if len(line) == 0 or line.startswith('#'):
-                continue  # Skip comment lines and blank lines
-            if line in ['OR', 'AND']:
-                if line == 'OR':
-                    operator = '||'
-                else:
-                    operator = '&&'
-                continue
-            if line == 'NOT':
-                negate = True
-    return operator, negate
+    if file_spec == STDIN:
+        return 'stdin'
+    return 'dir' if os.path.isdir(file_spec) else 'file'
+
+
+def parse_clause(line: str) -> Clause:
+    """
+    Parse a match line.  If the line is of the form, '!AWK | awk match condition', the clause field is '!AWK'.
+    args:
+        line: The match line, with leading and trailing spaces removed.
+    returns:
+        The match clause.
+    """
+    # this is a match line, split on | and check for NOT
+    parts = line.split('|')
+    clause_negate = False
+    field = ""
+    if len(parts) == 3:
+        # First part must be NOT
+        if parts[0].strip() != 'NOT':
+            print("Error parsing line: ", line)
+            raise ValueError("Error parsing line: " + line)
+        field = parts[1].strip()
+        clause_negate = True
+        value_index = 2
+    elif len(parts) == 2:
+        # Next part is the field name
+        field = parts[0].strip()
+        value_index = 1
+    else:
+        value_index = 0
+    # Get the value
+    value = parts[value_index].strip()
+    return Clause(clause_negate, field, value)
+
+
+def parse_program(text: str, name: Optional[str] = None, file_spec: Optional[str] = None) -> GreppyProgram:
+    """
+    Parse the text of a greppy program in a single pass.
+    args:
+        text: The program text.
+        name: The name of the program file, if any.
+        file_spec: If given, the file or directory to be searched, and the program text does not
+                   start with a file spec line.
+    returns:
+        The parsed program.
+    """
+    program = GreppyProgram(name)
+    expect_file_spec = file_spec is None
+    if not expect_file_spec:
+        program.file_spec = file_spec
+        program.path_type = get_path_type(file_spec)
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue  # Skip comment lines and blank lines
+        program.lines.append(line)
+        if expect_file_spec:
+            # The first line designates a directory or a file
+            program.file_spec = line
+            program.path_type = get_path_type(line)
+            expect_file_spec = False
+            continue
+        directive = next((name for name in DIRECTIVES if line.startswith(name)), None)
+        if directive is not None:
+            arguments = line[len(directive):].strip()
+            program.directives[directive] = arguments
+            if directive == '!FIELDS':
+                # Strip the [] from the line and split on commas
+                field_list = arguments[1:-1].split(',')
+                program.fields = {name.strip(): i + 1 for i, name in enumerate(field_list)}
+                program.fields[""] = 0
+            elif directive == '!SEPARATOR':
+                program.field_separator = arguments.split(' ')[0]
+            elif directive == '!NOHEADER':
+                program.noheader = True
+            elif directive == '!QUOTED':
+                program.quoted = True
+            elif directive == '!SELECT':
+                # Strip the [] from the line and split on commas, as for !FIELDS
+                program.select = [name.strip() for name in arguments[1:-1].split(',') if name.strip()]
+            elif directive == '!GROUPBY':
+                program.group_by = [name.strip() for name in arguments.strip('[]').split(',') if name.strip()]
+            elif directive == '!AGG':
+                program.aggregates = parse_aggregates(arguments)
+            continue
+        if line in ['OR', 'AND']:
+            program.operator = '||' if line == 'OR' else '&&'
+            continue
+        if line == 'NOT':
+            program.negate = True
+            continue
+        program.clauses.append(parse_clause(line))
+    return program
+
+
+def parse_aggregates(arguments: str) -> List[Tuple[str, str]]:
+    """
+    Parse the arguments of an !AGG directive, like 'sum(ProductPrice), count()'.
+    args:
+        arguments: The directive arguments.
+    returns:
+        A list of (function, column name) tuples.  The column name is '' for count().
+    """
+    aggregates = []
+    for part in arguments.split(','):
+        match = re.fullmatch(r'\s*(\w+)\s*\(\s*([^)]*?)\s*\)\s*', part)
+        if match is None or match.group(1).lower() not in AGGREGATE_FUNCTIONS:
+            print("Error parsing aggregate: ", part.strip())
+            raise ValueError("Error parsing aggregate: " + part.strip())
+        function, column = match.group(1).lower(), match.group(2)
+        if function != 'count' and not column:
+            print("Error: aggregate needs a column: ", part.strip())
+            raise ValueError("Aggregate needs a column: " + part.strip())
+        aggregates.append((function, column))
+    return aggregates
+
+
+def read_program(config_file) -> GreppyProgram:
+    """
+    Read and parse a greppy program file.
+    args:
+        config_file: The name of the program file.  If it is already a GreppyProgram, it is returned as is.
+    returns:
+        The parsed program.
+    """
+    if isinstance(config_file, GreppyProgram):
+        return config_file
+    with open(config_file, 'r', encoding='utf-8') as f:
+        return parse_program(f.read(), config_file)
+
+
+def get_operators(file_name) -> Tuple[str, bool]:
+    """
+    Get the 'NOT' and 'OR' or 'AND' operators from the program.
+    args:
+        file_name: The name of the program file, or a GreppyProgram.
+    returns:
+        A tuple containing an operator ('||', '&&' or '') and a boolean indicating if 'NOT' is present.
+    """
+    program = read_program(file_name)
+    return program.operator, program.negate
 
 
-def get_components(file_name: str) -> List[Tuple[bool, str, str]]:
+def get_components(file_name, keep_lists: bool = False) -> List[Tuple[bool, str, str]]:
     """
-    Parse the match lines from the config file and return a list of (negate, field, value) tuples.
-    If the line is of the form, 'awk | awk match contition', (False, 'awk', 'match condition') is returned.
+    Get the match clauses from the program as a list of (negate, field, value) tuples.
+    If the line is of the form, '!AWK | awk match condition', (False, '!AWK', 'awk match condition') is returned.
     args:
-        file_name: The name of the config file that contains the match rules.
+        file_name: The name of the program file, or a GreppyProgram.
+        keep_lists: If True, [a, b, c] list values are returned as is instead of being converted
+                    to regular expressions.
     returns:
         A list of (negate, field, value) tuples representing match clauses.
     """
-    with open(file_name, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        # Initialize the components list, a list of (negate, field, value) tuples
-        # representing match clauses.
-        #   negate: boolean - whether or not the clause is negated
-        #   field:  string - can be a field name, empty string (full record match),
-        #           or $n for column number
-        #   value:  string - value to match
-        components = []
-        for line in lines:
-            line = line.strip()
-            if len(line) == 0 or line.startswith('#') or line.startswith('!FIELDS') or line.startswith('!SEPARATOR') or line.startswith('!NOHEADER'):
-                continue  # Skip comment lines, blank lines and directives
-            if line in ['OR', 'AND', 'NOT']:
-                continue
-            # this is a match line, split on | and check for NOT
-            parts = line.split('|')
-            clause_negate = False
-            field = ""
-            if len(parts) == 3:
-                # First part must be NOT
-                if parts[0].strip() != 'NOT':
-                    print("Error parsing line: ", line)
-                    raise ValueError("Error parsing line: " + line)
-                field = parts[1].strip()
-                clause_negate = True
-                value_index = 2
-            elif len(parts) == 2:
-                # Next part is the field name
-                field = parts[0].strip()
-                value_index = 1
-            else:
-                value_index = 0
-            # Get the value
-            value = parts[value_index].strip()
-            # Check if value is a list.  If so, generate a regex to match any value in the list.
-            # Someting like this: '~//^[ ]*\"?(231|117|21|7)"?[ ]*$/'
-            # ignoring leading and trailing spaces and optional quotes
-            if value.startswith('[') and value.endswith(']'):
-                value = value[1:-1].split(',')
-                value = [v.strip() for v in value]
-                value = '|'.join(value)
-                value = f"/^[ ]*\"?({value})\"?[ ]*$/"
-
-            # Add the clause to the components list
-            components.append(
-                (clause_negate, field, value))
+    components = []
+    for clause in read_program(file_name).clauses:
+        value = clause.value
+        # If value is a list, generate a regex to match any value in the list.
+        # Someting like this: '~//^[ ]*\"?(231|117|21|7)"?[ ]*$/'
+        # ignoring leading and trailing spaces and optional quotes
+        if clause.kind == 'list' and not keep_lists:
+            value = f"/^[ ]*\"?({'|'.join(clause.values)})\"?[ ]*$/"
+        components.append((clause.negate, clause.field, value))
     return components
 
 
@@ -110,61 +311,371 @@ def replace_fields_with_numbers(fields: Dict[str, int], val: str) -> str:
     return val
 
 
-def parse_rules(config_file: str, fields: Dict[str, int]) -> str:
+def awk_clause(clause: Clause, fields: Dict[str, int]) -> str:
+    """
+    Get the awk match condition for a single match clause.
+    args:
+        clause: The match clause.
+        fields: A dictionary of field names and their index in the csv file.
+    returns:
+        The awk match condition.
+    """
+    # If the field is 'awk' pass the value with fields replaced by column numbers if needed
+    if clause.kind == 'awk':
+        condition = replace_fields_with_numbers(fields, clause.value)
+        return f"!({condition})" if clause.negate else condition
+    # To ignore leading and trailing spaces and allowing optional quotes,
+    # need to target a regex that looks like this: ^[ ]*["]?{val}["]?[ ]*$
+    comparator = '!~' if clause.negate else '~'
+    # If fld starts with a $, it is a column number, so use it as is;
+    # otherwise get the column number from the fields dictionary
+    if clause.field.startswith('$'):
+        match_field = clause.field[1:]  # Remove the $ sign
+    else:
+        match_field = fields[clause.field]
+    if clause.kind == 'regex':  # Contains search
+        return f"${match_field} {comparator} {clause.value}"
+    if clause.kind == 'order':  # Order comparison, value includes the test
+        if clause.negate:
+            return f"!(${match_field} {clause.value})"
+        return f"${match_field} {clause.value}"
+    # Use regex to ignore leading and trailing spaces and optional quotes
+    return f"${match_field} {comparator} /^[ ]*\"?({'|'.join(clause.values)})\"?[ ]*$/" \
+        if clause.kind == 'list' else f"${match_field} {comparator} /^[ ]*\"?{clause.value}\"?[ ]*$/"
+
+
+def parse_rules(config_file, fields: Dict[str, int]) -> str:
     """
         Parse the rules from the config file and return a match string to be used in the awk script.
         args:
-            config_file: The name of the config file that contains the match rules.
+            config_file: The name of the config file that contains the match rules, or a GreppyProgram.
             fields: A dictionary of field names and their index in the csv file.
                     fields[""] = 0 for full record match.
         returns:
             A string that can be used in the awk script to match the records that meet the criteria.
     """
-    order_operators = ['<', '>']
-    operator, negate = get_operators(config_file)
-    components = get_components(config_file)
+    program = read_program(config_file)
     # Build the match string
     # First check to make sure that if there is more than one component, the operator is || or &&
-    if len(components) > 2 and operator not in ['||', '&&']:
+    if len(program.clauses) > 1 and program.operator not in ['||', '&&']:
         print("Error: Multiple components require OR or AND")
         raise ValueError("Error: Multiple components require OR or AND")
 
-    match = ""
-    for i, component in enumerate(components):
-        # Skip the first component, which comes from the first line in the config
-        if i == 0:
-            continue
-        (neg, fld, val) = component
-        # If the field is 'awk' pass the value with fields replaced by column numbers if needed
-        if fld == '!AWK':
-            match += f"{replace_fields_with_numbers(fields, val)}"
-            if i < len(components) - 1:
-                match += f" {operator} "
+    match = f" {program.operator} ".join(awk_clause(clause, fields) for clause in program.clauses)
+    if program.negate:
+        match = f"!({match})"
+    elif '||' in match:
+        # Scripts test "NR > 1 && match", which would otherwise only apply NR > 1 to the first alternative
+        match = f"({match})"
+    return match
+
+
+# ---------------------------------------------------------------------------------------------
+# Optimizer
+#
+# optimize_rules builds the same match condition as parse_rules, rewritten to be cheaper for awk
+# to evaluate: exact matches on literal values compare normalized strings instead of running a
+# regex, literal lists become associative arrays built in BEGIN, fields used by several of those
+# are normalized once per record, cheap comparisons go before regexes and redundant range bounds
+# on the same field are dropped.
+# ---------------------------------------------------------------------------------------------
+
+# awk function that strips leading and trailing spaces and then one quote from each end of a
+# value, the way the regexes for exact matches ignore them (see normalize_value)
+NORMALIZE_FUNCTION = '''function _norm(s) { sub(/^ +/, "", s); sub(/ +$/, "", s); sub(/^"/, "", s); sub(/"$/, "", s); return s }
+'''
+
+# Characters that keep exact match values from being compared as literal strings.  awk always matches
+# values as regular expressions, so a value with any of them (even '.') can match other text.
+NON_LITERAL_CHARACTERS = set('\\^$[]|()*+?{}."/')
+
+# Relative costs of clause kinds, cheapest first.  !AWK clauses are never moved.
+CLAUSE_COSTS = {'order': 0, 'literal': 1, 'regex': 2, 'alternation': 3}
+
+
+def is_literal(clause: Clause) -> bool:
+    """Check if an exact match or list clause has only plain, non-empty values that can be compared as strings."""
+    return clause.kind in ('equal', 'list') and all(
+        value and not NON_LITERAL_CHARACTERS.intersection(value) for value in clause.values)
+
+
+def clause_field_number(clause: Clause, fields: Dict[str, int]) -> int:
+    """Get the column number of the field a clause matches, 0 for the whole record."""
+    return int(clause.field[1:]) if clause.field.startswith('$') else fields[clause.field]
+
+
+def clause_cost(clause: Clause) -> int:
+    """Get the relative cost of evaluating a clause (see CLAUSE_COSTS)."""
+    if clause.kind == 'order':
+        return CLAUSE_COSTS['order']
+    if is_literal(clause):
+        return CLAUSE_COSTS['literal']
+    if clause.kind == 'list':
+        return CLAUSE_COSTS['alternation']
+    return CLAUSE_COSTS['regex']
+
+
+def range_bound(clause: Clause) -> Optional[Tuple[str, float]]:
+    """
+    Get the bound a comparison clause sets on its field.
+    returns:
+        (operator, number) for a comparison with a number, like ('>=', 2.0), or None for any other clause.
+    """
+    if clause.kind != 'order' or clause.negate:
+        return None
+    operator = clause.value[:2] if clause.value[1:2] == '=' else clause.value[:1]
+    number = awk_number(clause.value[len(operator):])
+    return None if number is None else (operator, number)
+
+
+def redundant_bound(bound: Tuple[str, float], other: Tuple[str, float], operator: str) -> bool:
+    """
+    Check if one bound on a field adds nothing to another bound in the same direction.
+    Fields are compared as numbers if they look like numbers and as strings otherwise, so a bound is only
+    dropped if the numbers and their string forms are in the same order.
+    args:
+        bound: The bound that might be redundant.
+        other: The other bound.
+        operator: '&&' if the bounds are both required, '||' if either one is enough.
+    returns:
+        True if the bound can be dropped.
+    """
+    (op, number), (other_op, other_number) = bound, other
+    if (op[0] == '>') != (other_op[0] == '>'):
+        return False
+    if (op, number) == (other_op, other_number):
+        return True
+    lower = op[0] == '>'
+    # With &&, the tighter bound wins; with ||, the looser one does
+    keep_tighter = operator == '&&'
+    if number == other_number:
+        # Same limit - the strict comparison is the tighter one
+        strict, other_strict = len(op) == 1, len(other_op) == 1
+        return strict != other_strict and other_strict == keep_tighter
+    text, other_text = awk_to_string(number), awk_to_string(other_number)
+    if (number < other_number) != (text < other_text):
+        return False
+    other_tighter = (other_number > number) == lower
+    return other_tighter == keep_tighter
+
+
+def optimize_rules(config_file, fields: Dict[str, int], array_prefix: str = '_list') -> Tuple[str, str, str]:
+    """
+    Build the awk match condition for the rules, optimized for evaluation (see the Optimizer section).
+    args:
+        config_file: The name of the config file that contains the match rules, or a GreppyProgram.
+        fields: A dictionary of field names and their index in the csv file.
+        array_prefix: The start of the names of the arrays used for lists, which are numbered from 1.
+                      Default is '_list'.
+    returns:
+        (match, begin, prelude) - the match condition, statements for the BEGIN block that set up the
+        arrays it uses and statements to run on each record before testing it.  Pass them all to
+        generate_awk_script.
+    """
+    program = read_program(config_file)
+    if len(program.clauses) > 1 and program.operator not in ['||', '&&']:
+        print("Error: Multiple components require OR or AND")
+        raise ValueError("Error: Multiple components require OR or AND")
+    clauses = list(program.clauses)
+
+    # Drop comparisons that are implied by (with &&) or imply (with ||) another one on the same field
+    if program.operator:
+        kept = []
+        for clause in clauses:
+            bound = range_bound(clause)
+            if bound is not None and any(
+                    range_bound(other) is not None and other.field == clause.field
+                    and redundant_bound(bound, range_bound(other), program.operator) for other in kept):
+                continue
+            if bound is not None:
+                # Drop earlier comparisons made redundant by this one
+                kept = [other for other in kept if range_bound(other) is None or other.field != clause.field
+                        or not redundant_bound(range_bound(other), bound, program.operator)]
+            kept.append(clause)
+        clauses = kept
+
+    # Put cheaper clauses first, so && and || can skip the expensive ones.  !AWK conditions might
+    # have side effects, so they stay where they are and clauses are only sorted between them.
+    ordered = []
+    segment = []
+    for clause in clauses + [None]:
+        if clause is None or clause.kind == 'awk':
+            ordered += sorted(segment, key=clause_cost)
+            segment = []
+            if clause is not None:
+                ordered.append(clause)
+        else:
+            segment.append(clause)
+
+    # Normalize fields used by more than one literal clause once per record
+    literal_fields = [clause_field_number(clause, fields) for clause in ordered if is_literal(clause)]
+    shared = sorted({number for number in literal_fields if literal_fields.count(number) > 1})
+    prelude = ' '.join(f"_n{number} = _norm(${number});" for number in shared)
+    begin = []
+    conditions = []
+    for clause in ordered:
+        if not is_literal(clause):
+            conditions.append(awk_clause(clause, fields))
             continue
-        # To ignore leading and trailing spaces and allowing optional quotes,
-        # need to target a regex that looks like this: ^[ ]*["]?{val}["]?[ ]*$
-        comparator = '!~' if neg else '~'
-        # If fld starts with a $, it is a column number, so use it as is;
-        # otherwise get the column number from the fields dictionary
-        if fld.startswith('$'):
-            match_field = fld[1:]  # Remove the $ sign
+        number = clause_field_number(clause, fields)
+        value = f"_n{number}" if number in shared else f"_norm(${number})"
+        if clause.kind == 'equal':
+            condition = f"{value} {'!=' if clause.negate else '=='} {awk_string(clause.values[0])}"
         else:
-            match_field = fields[fld]
-        if val.startswith('/'):  # Contains search
-            match += f"${match_field} {comparator} {val}"
-        elif val[0] in order_operators:  # Order comparison, value includes the test
-            match += f"${match_field} {val}"
-        else:  # Use regex to ignore leading and trailing spaces and optional quotes
-            match += f"${match_field} {comparator} /^[ ]*\"?{val}\"?[ ]*$/"
-        if i < len(components) - 1:
-            match += f" {operator} "
-    if negate:
+            array = f"{array_prefix}{len(begin) + 1}"
+            # Literal values have no quotes or backslashes, so they can go straight into an awk string
+            values = '\\n'.join(clause.values)
+            begin.append(f'_split = split("{values}", _values, "\\n"); '
+                         f'for (_i = 1; _i <= _split; _i++) {array}[_values[_i]];')
+            condition = f"({value} in {array})"
+            if clause.negate:
+                condition = f"!{condition}"
+        conditions.append(condition)
+
+    match = f" {program.operator} ".join(conditions)
+    if program.negate:
         match = f"!({match})"
-    return match
+    elif '||' in match:
+        match = f"({match})"
+    return match, ' '.join(begin), prelude
+
+
+# awk functions used by --fast scripts, which write their results straight to the output file.
+# trim strips leading and trailing whitespace from output lines, like the python relay does.
+# emit writes a line to the file named by the out variable (if set) and to standard output if console is set.
+FAST_OUTPUT_FUNCTIONS = r'''function trim(s) { sub(/^[ \t\r\n\f\v]+/, "", s); sub(/[ \t\r\n\f\v]+$/, "", s); return s }
+function emit(line) { if (out != "") print line >> out; if (console) print line }
+'''
+
+
+def awk_string(value: str) -> str:
+    """Quote a value as an awk string constant."""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# Stands in for separators in double quotes while quoted records are split (see get_splitter)
+QUOTED_SEPARATOR = '\x1d'
+
+
+def check_quoted_separator(field_separator: str):
+    """Check that a separator can be used with !QUOTED - a single character other than a space or a quote."""
+    if len(field_separator) != 1 or field_separator in ' "':
+        print("Error: !QUOTED needs a single character separator other than a space or a quote: ", field_separator)
+        raise ValueError("!QUOTED needs a single character separator other than a space or a quote: "
+                         + field_separator)
+
+
+def quoted_function(field_separator: str) -> str:
+    """
+    Generate the awk function that splits records with quoted fields.
+    args:
+        field_separator: The separator used in the csv file.
+    returns:
+        The definition of _unquote, which splits $0 again with the separators in double quotes kept in their
+        fields, the way get_splitter does with quoted set.  With OFS set to the separator, $0 is unchanged.
+    """
+    check_quoted_separator(field_separator)
+    separator = '\\' + field_separator if field_separator in '\\]^-/' else field_separator
+    replacement = awk_string('\\&' if field_separator == '&' else field_separator)
+    return ('function _unquote(  parts, n, i, line) { n = split($0, parts, "\\""); line = parts[1]; '
+            f'for (i = 2; i <= n; i++) {{ if (i % 2 == 0) gsub(/[{separator}]/, "\\035", parts[i]); '
+            'line = line "\\"" parts[i] } '
+            f'$0 = line; for (i = 1; i <= NF; i++) if (index($i, "\\035")) gsub(/\\035/, {replacement}, $i) }}\n')
+
+
+def awk_variables(**variables) -> List[str]:
+    """
+    Get the awk command line options that set variables.
+    args:
+        variables: The variable names and values.
+    returns:
+        A list of -v options.  Backslashes in values are escaped, since awk processes escape sequences in them.
+    """
+    options = []
+    for name, value in variables.items():
+        options += ['-v', name + '=' + str(value).replace('\\', '\\\\')]
+    return options
+
+
+def select_columns(select: List[str], fields: Dict[str, int]) -> List[int]:
+    """
+    Get the column numbers of the columns to output.
+    args:
+        select: The names of the columns, from !SELECT or --select.  $n selects column n.
+        fields: A dictionary of field names and their index in the csv file.
+    returns:
+        The column numbers, in the order given.
+    """
+    columns = []
+    for name in select:
+        if name.startswith('$') and name[1:].isdigit():
+            columns.append(int(name[1:]))
+        elif name in fields:
+            columns.append(fields[name])
+        else:
+            print("Error: Unknown column in select: ", name)
+            raise ValueError("Unknown column in select: " + name)
+    return columns
+
+
+def select_header(fields: Dict[str, int], field_separator: str = '|', select: Optional[List[int]] = None) -> str:
+    """
+    Generate a header line from the fields dictionary, for inputs without one.
+    args:
+        fields: A dictionary of field names and their index in the csv file.
+        field_separator: The separator used in the csv file. Default is '|'.
+        select: The column numbers to output (see select_columns), or None for all of them.
+    returns:
+        The header line, without a line ending.
+    """
+    if not select:
+        # Strip off the field_separator added for the "" field, which is last
+        return field_separator.join(fields.keys())[:-1]
+    names = {number: name for name, number in fields.items()}
+    return field_separator.join(names.get(number, f"${number}") for number in select)
+
+
+class ScriptOptions(NamedTuple):
+    """
+    The options that shape a generated awk script, other than its input (see generate_awk_script).  The
+    script cache key is made from all of them (see script_cache_key), so a new option is always part of it.
+        emit_header: bool - handle the header line.  False for scripts that filter chunks after the first one
+                     in a split file.
+        fast:        bool - awk formats the output itself and writes it to the file named by the out variable,
+                     printing it to standard output only if the console variable is set.  The header line is
+                     only written if the header variable is set.
+        multi_file:  bool - with fast, add the name of the file in the fname variable to the end of each line
+        stats:       bool - count the records read and matched, writing the counts to the file named by the
+                     stats variable at the end (see --stats)
+        limit:       bool - stop after the number of matches in the limit variable
+        count_only:  bool - count matches (see stats) without printing them or the header line
+        select:      list - the column numbers to print (see select_columns), joined by the field separator,
+                     in the header line and in each record, or None to print whole lines
+        aggregate:   tuple - (group_by, aggregates) from resolve_aggregates.  If given, matching records are
+                     accumulated instead of printed, and partial aggregates (see awk_aggregate) are printed at
+                     the end.
+        header:      string - with has_fields, the header line to print instead of the input's (see Schema)
+        quoted:      bool - separators in double quotes are part of the field (see !QUOTED)
+        distinct:    list - the column numbers that make up the key of a record for --distinct, or [] for the
+                     whole record.  If given, records with the same key as a record printed before are not
+                     printed.
+    """
+    emit_header: bool = True
+    fast: bool = False
+    multi_file: bool = False
+    stats: bool = False
+    limit: bool = False
+    count_only: bool = False
+    select: Optional[List[int]] = None
+    aggregate: Optional[Tuple[List[int], List[Tuple[str, int]]]] = None
+    header: Optional[str] = None
+    quoted: bool = False
+    distinct: Optional[List[int]] = None
 
 
 def generate_awk_script(
-    match: str, fields: Dict[str, int], field_separator="|", has_fields=True
+    match: str, fields: Dict[str, int], field_separator="|", has_fields=True,
+    options: ScriptOptions = ScriptOptions(), begin='', prelude=''
 ) -> str:
     """
     Generate the awk script, using the match string.
@@ -173,46 +684,164 @@ def generate_awk_script(
             fields: A dictionary of field names and their index in the csv file.
             field_separator: The separator used in the csv file. Default is '|'.
             has_fields: A boolean indicating if the input files have headers. Default is True.
+            options: The ScriptOptions that shape the script.  Default is ScriptOptions(), which prints the
+                     header line and whole matching lines.
+            begin: awk statements to run before reading the input, like setting up arrays used by the match
+                   string (see optimize_rules). Default is ''.
+            prelude: awk statements to run on each line before it is tested against the match string. Default is ''.
         returns:
             A string that is the awk script that can be used to search the csv files.
     """
+    emit_header, fast, multi_file, stats, limit, count_only, select, aggregate, header, quoted, distinct = options
+    # The selected columns, or the whole line
+    record = f' {awk_string(field_separator)} '.join(f"${number}" for number in select) if select else "$0"
+    record_actions = ["matched++"] if stats or limit or count_only else []
+    if fast:
+        # Format lines the same way relay_results does
+        record_suffix = f' {awk_string(field_separator + " ")} fname' if multi_file else ''
+        header_suffix = f' {awk_string(" " + field_separator + " file name")}' if multi_file else ''
+        record_actions.append(f"emit(trim({record}){record_suffix})")
+        header_line = awk_string(header) if header is not None else f"trim({record})"
+        print_header = f"{{ if (header) emit({header_line}{header_suffix}) }}"
+    else:
+        action = f"print {record}"
+        if distinct is not None:
+            # Only print the first record with each key
+            key = ' SUBSEP '.join(f"_norm(${number})" for number in distinct) if distinct else record
+            action = f"_key = {key}; if (!(_key in _seen)) {{ _seen[_key]; {action} }}"
+        record_actions.append(action)
+        print_header = f"{{ print {awk_string(header) if header is not None else record} }}"
+    if count_only or aggregate:
+        record_actions.pop()
+        print_header = "{ }"
+    if aggregate and not count_only:
+        accumulate, end_block = awk_aggregate(*aggregate)
+        record_actions.append(accumulate)
+    if limit:
+        record_actions.append("if (matched >= limit) exit")
+    print_record = f"{{ {'; '.join(record_actions)} }}"
+    # Setup from the optimizer goes after the BEGIN block that sets FS and prints the generated header
+    setup = f"BEGIN {{ {begin} }}\n" if begin else ""
+    field_setup = f'FS="{field_separator}"'
+    if quoted:
+        # Split records with quotes again before anything looks at their fields.  Setting OFS keeps $0
+        # the same when _unquote assigns fields.
+        field_setup += f'; OFS="{field_separator}"'
+        prelude = '; '.join(statement for statement in ['if (index($0, "\\"")) _unquote()', prelude] if statement)
+    if prelude:
+        setup += f"{{ {prelude} }}\n"
+    if not emit_header:
+        # Input does not start at the beginning of the file, so every line is a record to match
+        awk_script = f'BEGIN {{ {field_setup}}}\n' + setup
+        awk_script += f"{match}  {print_record}\n"
     # If input file has no headers, generate a header line from the fields dictionary
     # if it is not empty.
-    if not has_fields:
-        if len(fields) == 0:  # noheader must be true, do not generate header line
-            awk_script = f'BEGIN {{ FS="{field_separator}"}}\n'
+    elif not has_fields:
+        if len(fields) == 0 or count_only or aggregate:  # noheader must be true, do not generate header line
+            awk_script = f'BEGIN {{ {field_setup}}}\n'
         else:
-            header = field_separator.join(fields.keys())
-            # Strip off the last field_separator
-            header = header[:-1]
-            awk_script = f'BEGIN {{ FS="{field_separator}"; print "{header}" }}\n'
-        awk_script += f"{match}  {{ print $0 }}\n"
+            header = select_header(fields, field_separator, select)
+            if fast:
+                awk_script = f'BEGIN {{ {field_setup}; if (header) emit("{header}"{header_suffix}) }}\n'
+            else:
+                awk_script = f'BEGIN {{ {field_setup}; print "{header}" }}\n'
+        awk_script += setup
+        awk_script += f"{match}  {print_record}\n"
     else:
         # If input file has headers, print the first line and then match the rest of the lines.
-        awk_script = f'BEGIN {{ FS="{field_separator}"}}\n'
-        awk_script += "NR == 1 { print $0 }\n"
-        awk_script += f"NR > 1 && {match}  {{ print $0 }}\n"
+        awk_script = f'BEGIN {{ {field_setup}}}\n' + setup
+        awk_script += f"NR == 1 {print_header}\n"
+        awk_script += f"NR > 1 && {match}  {print_record}\n"
+    if aggregate and not count_only:
+        awk_script += end_block
+    if stats:
+        # Separate the counts with a space even if OFS is set (see quoted)
+        awk_script += 'END { if (stats != "") print NR " " matched + 0 > stats }\n'
+    if fast:
+        awk_script += FAST_OUTPUT_FUNCTIONS
+    if '_norm(' in awk_script:
+        awk_script += NORMALIZE_FUNCTION
+    if quoted:
+        awk_script += quoted_function(field_separator)
     return awk_script
 
 
-def get_file_spec(config_file: str) -> Tuple[str, str]:
-    """Get the file or directory to be searched."""
-    # Read the first line of config_file. See if it designates a directory or a file.
-    # If it is a directory, return 'dir' and the directory name.
-    # If it is a file, return 'file' and the file name.
-    with open(config_file, 'r', encoding='utf-8') as f:
-        # Skip blank lines and comments
-        while True:
-            first_line = f.readline().strip()
-            if len(first_line) == 0 or first_line.startswith('#'):
-                continue
+def get_file_spec(config_file) -> Tuple[str, str]:
+    """
+    Get the file or directory to be searched.
+    args:
+        config_file: The name of the config file, or a GreppyProgram.
+    returns:
+        ('dir', directory name) if the first line of the program designates a directory,
+        ('stdin', '-') if it is '-', ('file', file name) otherwise.
+    """
+    program = read_program(config_file)
+    return program.path_type, program.file_spec
+
+
+def read_header_line(path: str, path_type: str) -> str:
+    """
+    Read the first line of the file_spec or the first csv file in the directory.
+        args:
+            path: The file or directory to be searched.
+            path_type: 'dir' if path is a directory, 'stdin' for standard input, 'file' if path is a file.
+        returns:
+            The first line, without its line ending, or '' if there is no csv file to read it from.
+            Compressed files (see get_compression) are decompressed.  Reading the header from standard input
+            consumes it, and nothing after it.
+    """
+    if path_type == 'stdin':
+        return read_stdin_line().decode('utf-8').strip()
+    if path_type == 'dir':
+        file_list = [os.path.join(path, f) for f in os.listdir(path)]
+        path = next((file for file in file_list if is_csv_name(file)), None)
+        if path is None:
+            return ''
+    with open_input(path) as f:
+        return f.readline().decode('utf-8').strip()
+
+
+def read_stdin_line() -> bytes:
+    """
+    Read one line from standard input without buffering, so that the rest of it is left for awk,
+    which inherits the file descriptor.
+    returns:
+        The line, including its line ending, or b'' at the end of the input.
+    """
+    fd = sys.stdin.fileno()
+    line = bytearray()
+    while True:
+        byte = os.read(fd, 1)
+        if not byte:
+            break
+        line += byte
+        if byte == b'\n':
             break
-        if os.path.isdir(first_line):
-            return 'dir', first_line
-        return 'file', first_line
+    return bytes(line)
+
+
+def fields_from_header(header_line: str, field_separator: str, quoted: bool = False) -> dict:
+    """
+    Get the fields dictionary for a header line.
+        args:
+            header_line: The header line.
+            field_separator: The separator used in the csv file.
+            quoted: A boolean indicating if names can be in double quotes (see get_splitter), which are
+                    removed.  Default is False.
+        returns:
+            A dictionary of field names and their index in the csv file, with {"": 0} for full record match.
+    """
+    if quoted:
+        fields = [normalize_value(name) for name in get_splitter(field_separator, True)(header_line)]
+    else:
+        fields = header_line.split(field_separator)
+    ret = {fields[i].strip(): i + 1 for i in range(len(fields))}
+    # Add {"": 0} to the fields dictionary for full record match
+    ret[""] = 0
+    return ret
 
 
-def get_fields(path: str, path_type: str, field_separator: str) -> dict:
+def get_fields(path: str, path_type: str, field_separator: str, quoted: bool = False) -> dict:
     """ 
      Get the fields from the first line of the file_spec or the first csv file in the directory.
      Return a dictionary of field names and their index in the csv file.
@@ -221,31 +850,17 @@ def get_fields(path: str, path_type: str, field_separator: str) -> dict:
             path: The file or directory to be searched.
             path_type: 'dir' if path is a directory, 'file' if path is a file.
             field_separator: The separator used in the csv file.
+            quoted: A boolean indicating if names can be in double quotes (see get_splitter).
         returns:
             A dictionary of field names and their index in the csv file.
      """
-    if path_type == 'dir':
-        file_list = [os.path.join(path, f) for f in os.listdir(path)]
-        for file in file_list:
-            if file.endswith('.csv'):
-                with open(file, 'r', encoding='utf-8') as f:
-                    fields = f.readline().strip().split(field_separator)
-                    ret = {fields[i].strip(): i +
-                           1 for i in range(len(fields))}
-                    break
-    else:
-        with open(path, 'r', encoding='utf-8') as f:
-            fields = f.readline().strip().split(field_separator)
-            ret = {fields[i].strip(): i + 1 for i in range(len(fields))}
-    # Add {"": 0} to the fields dictionary for full record match
-    ret[""] = 0
-    return ret
+    return fields_from_header(read_header_line(path, path_type), field_separator, quoted)
 
 
-def process_directives(config_file: str) -> Tuple[str, dict, bool]:
+def process_directives(config_file) -> Tuple[str, dict, bool]:
     """Process directives in the config file.
     args:
-        config_file: The name of the config file that contains the match rules.
+        config_file: The name of the config file that contains the match rules, or a GreppyProgram.
     returns:
         A tuple containing the field separator, a dictionary of field names and their index in the csv file,
         and a boolean indicating if the input files have headers.
@@ -253,116 +868,4046 @@ def process_directives(config_file: str) -> Tuple[str, dict, bool]:
         If !SEPARATOR directive is found, the field separator is taken from the directive, otherwise '|' is returned.
         If !NOHEADER directive is found, the boolean is set to True, otherwise False.
     """
-    field_separator = '|'
-    fields = {}
-    noheader = False
-    with open(config_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('!FIELDS'):
-                # Strip off the "!FIELDS" directive
-                line = line[7:].strip()
-                # Strip the [] from the line and split on commas
-                line = line[1:-1]
-                field_list = line.split(',')
-                fields = {name.strip(): i + 1 for i, name in enumerate(
-                    field_list)}
-                fields[""] = 0
-            if line.startswith('!SEPARATOR'):
-                field_separator = line.split(' ')[1].strip()
-            if line.startswith('!NOHEADER'):
-                noheader = True
-    return field_separator, fields, noheader
+    program = read_program(config_file)
+    return program.field_separator, dict(program.fields), program.noheader
 
 
-def main():
-    """Main function."""
-    # Parse command line arguments.  Expecting a single argument, the greppy match rules file, defaulting to greppy.txt
-    parser = argparse.ArgumentParser(
-        description='Greppy: A simple grep-like utility')
-    parser.add_argument('config_file', nargs='?',
-                        default='greppy.txt', help='Greppy configuration file')
-    args = parser.parse_args()
+# ---------------------------------------------------------------------------------------------
+# Compressed input
+#
+# Input files compressed with gzip, bzip2, xz or zstd are searched without unpacking them to disk.
+# They are recognized by their extension or, failing that, their magic bytes.  awk reads them
+# through a pipe from a decompressor process, so decompression runs alongside the search.
+# ---------------------------------------------------------------------------------------------
 
-    # Get the file spec from the config file and determine if it is a file or a directory
-    path_type, file_spec = get_file_spec(args.config_file)
+# Compression formats: (magic bytes, file extension, decompressor command, python module)
+COMPRESSIONS = {
+    'gzip': (b'\x1f\x8b', '.gz', ['gzip', '-dc'], 'gzip'),
+    'bzip2': (b'BZh', '.bz2', ['bzip2', '-dc'], 'bz2'),
+    'xz': (b'\xfd7zXZ\x00', '.xz', ['xz', '-dc'], 'lzma'),
+    'zstd': (b'\x28\xb5\x2f\xfd', '.zst', ['zstd', '-dc'], 'zstandard'),
+}
 
-    # Process directives - !HEADER and !SEPARATOR
-    field_separator, fields, noheader = process_directives(args.config_file)
+# The exit status of a decompressor that was stopped because awk stopped reading, like it does at --limit
+PIPE_CLOSED_STATUS = -signal.SIGPIPE if hasattr(signal, 'SIGPIPE') else None
 
-    # Get the fields from the first line of the file_spec or the first csv file in the directory
-    # if column names are not provided in directive and noheader is False.
-    # has_fields means input files have headers
-    has_fields = len(fields) == 0 and not noheader
-    if has_fields:
-        fields = get_fields(file_spec, path_type, field_separator)
 
-    # Parse the rules from the config file
-    match = parse_rules(args.config_file, fields)
+def get_compression(file_name: str) -> Optional[str]:
+    """
+    Get the compression format of an input file.
+    args:
+        file_name: The name of the file, or '-' for standard input, which is never treated as compressed.
+    returns:
+        The key of the format in COMPRESSIONS, or None if the file is not compressed.
+    """
+    if file_name == STDIN:
+        return None
+    for compression, (_, extension, _, _) in COMPRESSIONS.items():
+        if file_name.endswith(extension):
+            return compression
+    with open(file_name, 'rb') as f:
+        start = f.read(6)
+    for compression, (magic, _, _, _) in COMPRESSIONS.items():
+        if start.startswith(magic):
+            return compression
+    return None
 
-    # Generate a base output file name by contatenating the file_spec and rules file names with underscores
-    # and removing special characters.
-    output_name = file_spec + '_' + args.config_file
-    output_name = output_name.replace('/', '_').replace(
-        '.', '_').replace(' ', '_').replace('csv', '').replace('txt', '').replace('__', '_').replace('\\', '_').replace('C:', '').replace('-', '_')
-    script_name = output_name + '.awk'
 
-    # Generate and save the awk script
-    awk_script = generate_awk_script(
-        match, fields, field_separator, has_fields)
+def is_csv_name(file_name: str) -> bool:
+    """Check if a file name ends with .csv, or with .csv and a compression extension like .csv.gz."""
+    for _, extension, _, _ in COMPRESSIONS.values():
+        if file_name.endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+    return file_name.endswith('.csv')
 
-    with open(script_name, 'w', encoding='utf-8') as f:
-        f.write(awk_script)
 
-    # Generate a list of files to process.  If the file_spec is a file, just process that file.
-    # If it is a directory, add all files in the directory to the list.
-    if path_type == 'dir':
-        file_list = [os.path.join(file_spec, f) for f in os.listdir(file_spec)]
-    else:
-        file_list = [file_spec]
+def decompress_process(file_name: str, compression: str) -> subprocess.Popen:
+    """
+    Start a process that writes the decompressed contents of a file to its standard output.
+    Uses the decompressor command if it is installed, and the python module for the format otherwise.
+    args:
+        file_name: The compressed file.
+        compression: The key of its format in COMPRESSIONS.
+    returns:
+        The process.
+    raises:
+        ValueError if neither the command nor the module is installed.
+    """
+    _, _, command, module = COMPRESSIONS[compression]
+    if shutil.which(command[0]) is None:
+        # zstandard is not part of the standard library, so it may be missing too
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            raise ValueError(f"{file_name} is compressed with {compression}, which needs the {command[0]} command "
+                             f"or the python {module} module") from e
+        # The module stops quietly if the reader stops early, as the command does
+        command = [sys.executable, '-c', f'import os, shutil, sys, {module}\n'
+                   f'try:\n    shutil.copyfileobj({module}.open(sys.argv[1]), sys.stdout.buffer, 1024 * 1024)\n'
+                   f'except BrokenPipeError:\n    os._exit(0)']
+    return subprocess.Popen([*command, file_name], stdout=subprocess.PIPE)
 
-    # Execute the awk script on each file, printing the file name, then the results.
-    # Also pipe the results to a file with the same name as the file_spec with a .csv extension.
-    # If there are multiple files, add the file name as a new field to the end of each line.
-    # Do not repeat the header line for each file - just create one with the new field name.
-    num_files = len(file_list)
-    ct = 0
-    for i, file in enumerate(file_list):
-        print(f"Results for {file}")
-        file_name = str(file)
-        p = Path(__file__).with_name(output_name + '.csv')
-        with p.open('ab') as out:
-            with subprocess.Popen(
-                    ['gawk', '-f', script_name, file], stdout=subprocess.PIPE, text=True) as proc:
-                line_number = 0
-                for line in proc.stdout:
-                    if ct == 1 and line_number == 0:
-                        # Skip header line for files after the first one in multi-file
-                        line_number += 1
-                        continue
-                    if num_files > 1 and i == 0 and ct == 0:
-                        # get the first line of the awk output and add file name
-                        header = line.encode().strip() + " ".encode() + \
-                            field_separator.encode() + " file name\n".encode()
-                        out.writelines([header])
-                        sys.stdout.buffer.writelines([header])
-                        ct += 1
-                        line_number += 1
-                        continue
-                    if num_files > 1:
-                        # Add the file name to the end of each line
-                        line = line.encode().strip() + field_separator.encode() + \
-                            " ".encode() + file_name.encode() + "\n".encode()
-                    else:
-                        line = line.encode().strip() + "\n".encode()
-                    sys.stdout.buffer.writelines([line])
-                    out.writelines([line])
-                    line_number += 1
-                proc.wait()
-                sys.stdout.flush()
-                sys.stderr.flush()
-                out.flush()
+
+def open_input(file_name: str) -> BinaryIO:
+    """
+    Open an input file for reading in binary mode, decompressing it if it is compressed.
+    args:
+        file_name: The name of the file.
+    returns:
+        The open file, or the output of a decompressor process if there is no python module for the format.
+    """
+    compression = get_compression(file_name)
+    if compression is None:
+        return open(file_name, 'rb', buffering=1024 * 1024)
+    try:
+        module = importlib.import_module(COMPRESSIONS[compression][3])
+    except ImportError:
+        return decompress_process(file_name, compression).stdout
+    return module.open(file_name, 'rb')
+
+
+@contextmanager
+def awk_process(awk_args: List[str], file_name: str, start: int = 0, end: Optional[int] = None,
+                offsets: Optional[List[int]] = None, **popen_args) -> Iterator[subprocess.Popen]:
+    """
+    Run gawk on an input file, piping it through a decompressor if it is compressed.
+    args:
+        awk_args: The gawk arguments that go before the input file name.
+        file_name: The input file.
+        start: The offset of the first byte to search.  Must be the beginning of a line.
+        end: The offset just past the last byte to search, or None to search to the end of the file.
+             Byte ranges other than the whole file can't be searched in compressed files.
+        offsets: The byte offsets of the lines to search, in increasing order, like the candidate records
+                 from a column index, or None to search the byte range.
+        popen_args: Other arguments for subprocess.Popen, like stdout.
+    returns:
+        A context manager for the gawk process, which waits for it (and the decompressor) on exit.
+    raises:
+        ValueError on exit if the decompressor fails, like it does on a truncated or corrupt file.
+    """
+    if offsets is not None or start != 0 or end is not None:
+        # Feed the lines or byte range to awk through its standard input, from a thread so that the caller
+        # can read awk's output at the same time
+        with subprocess.Popen(['gawk', *awk_args, '-'], stdin=subprocess.PIPE, **popen_args) as proc:
+            if offsets is not None:
+                feeder = threading.Thread(target=feed_lines, args=(file_name, offsets, proc.stdin))
+            else:
+                feeder = threading.Thread(target=feed_range, args=(file_name, start, end, proc.stdin))
+            feeder.start()
+            try:
+                yield proc
+            finally:
+                feeder.join()
+        return
+    compression = get_compression(file_name)
+    if compression is None:
+        with subprocess.Popen(['gawk', *awk_args, file_name], **popen_args) as proc:
+            yield proc
+        return
+    with decompress_process(file_name, compression) as decompressor:
+        with subprocess.Popen(['gawk', *awk_args, '-'], stdin=decompressor.stdout, **popen_args) as proc:
+            # Only awk reads the pipe, so the decompressor stops if awk does
+            decompressor.stdout.close()
+            yield proc
+    if decompressor.returncode not in [0, PIPE_CLOSED_STATUS]:
+        raise ValueError(f"Could not decompress {file_name} (exit status {decompressor.returncode}), "
+                         f"so the results for it are incomplete")
+
+
+def feed_range(file_name: str, start: int, end: Optional[int], pipe: BinaryIO):
+    """
+    Write a byte range of a file to a pipe, closing the pipe at the end.
+    args:
+        file_name: The file.
+        start: The offset of the first byte to write.
+        end: The offset just past the last byte to write, or None to write to the end of the file.
+        pipe: The pipe, like the standard input of a process.
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            f.seek(start)
+            remaining = (end if end is not None else os.path.getsize(file_name)) - start
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                pipe.write(block)
+                remaining -= len(block)
+    except BrokenPipeError:
+        # The reader stopped early, like awk does at --limit
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def feed_lines(file_name: str, offsets: Iterable[int], pipe: BinaryIO):
+    """
+    Write the lines that start at the given offsets of a file to a pipe, closing the pipe at the end.
+    args:
+        file_name: The file.
+        offsets: The byte offsets of the beginnings of the lines, in increasing order.
+        pipe: The pipe, like the standard input of a process.
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                pipe.write(f.readline())
+    except BrokenPipeError:
+        # The reader stopped early, like awk does at --limit
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+# ---------------------------------------------------------------------------------------------
+# Script cache
+#
+# Generated awk scripts are cached on disk, keyed by a hash of the normalized program, the field
+# separator, the header line of the input and the options used to generate the script, so that
+# repeat runs of the same program over the same kind of input can skip script generation.
+# ---------------------------------------------------------------------------------------------
+
+# Default maximum total size of the script cache
+CACHE_SIZE = 16 * 1024 * 1024
+
+
+def get_cache_dir() -> str:
+    """Get the script cache directory - $GREPPY_CACHE_DIR, or greppy under the user's cache directory."""
+    if os.environ.get('GREPPY_CACHE_DIR'):
+        return os.environ['GREPPY_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'greppy')
+
+
+def script_cache_key(program: GreppyProgram, header_line: str, options: ScriptOptions, has_fields: bool = True,
+                     optimize: bool = True) -> str:
+    """
+    Get the cache key for a generated awk script.
+    args:
+        program: The parsed program.
+        header_line: The header line of the input, or '' if the input has no header.
+        options: The ScriptOptions used to generate the script.
+        has_fields: A boolean indicating if the input has a header line.
+        optimize: A boolean indicating if the rules were optimized (see optimize_rules).
+    returns:
+        A hex digest identifying the script.
+    """
+    # Include the size and modification time of this file, so that changes to greppy invalidate the cache
+    source = os.stat(__file__)
+    key = repr((source.st_size, source.st_mtime_ns, program.lines, program.field_separator,
+                header_line, has_fields, optimize, sorted(options._asdict().items())))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_cached_script(key: str, generate: Callable[[], str], cache_dir: Optional[str] = None,
+                      max_size: int = CACHE_SIZE) -> str:
+    """
+    Get an awk script from the cache, generating and caching it if it is not there.
+    Least recently used scripts are evicted once the cache is bigger than max_size.
+    args:
+        key: The cache key from script_cache_key.
+        generate: A function that generates the script.
+        cache_dir: The cache directory.  Default is get_cache_dir().
+        max_size: The maximum total size of the cached scripts, in bytes.
+    returns:
+        The awk script.
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    path = os.path.join(cache_dir, key + '.awk')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            script = f.read()
+        # Mark the script as recently used
+        os.utime(path)
+        return script
+    except OSError:
+        pass
+    script = generate()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file and rename, so concurrent runs never see partial scripts
+        fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(script)
+        os.replace(temp_name, path)
+        evict_cache(cache_dir, max_size)
+    except OSError as e:
+        print(f"Warning: could not cache awk script in {cache_dir}: {e}", file=sys.stderr)
+    return script
+
+
+def evict_cache(cache_dir: str, max_size: int):
+    """
+    Remove the least recently used scripts from the cache until it is no bigger than max_size.
+    args:
+        cache_dir: The cache directory.
+        max_size: The maximum total size of the cached scripts, in bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.awk'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def save_script(script_name: str, script: str):
+    """Save a generated awk script, unless the file already holds the same script."""
+    try:
+        with open(script_name, 'r', encoding='utf-8') as f:
+            if f.read() == script:
+                return
+    except OSError:
+        pass
+    with open(script_name, 'w', encoding='utf-8') as f:
+        f.write(script)
+
+
+# ---------------------------------------------------------------------------------------------
+# Schemas
+#
+# The files in a directory don't always have the same columns - files dropped over months can have
+# columns added, removed or reordered.  discover_schemas reads the header line of each file and groups
+# the files by their columns, so that each group is searched with the program's field names resolved
+# against its own header.  Matching records are output with the columns of the first file's header,
+# so the results of all of the files line up.
+# ---------------------------------------------------------------------------------------------
+
+# Name of the file in the cache directory holding the header lines read from input files
+HEADER_CACHE_NAME = 'headers.json'
+# Maximum number of header lines kept in the cache
+HEADER_CACHE_ENTRIES = 10000
+
+
+class Schema:
+    """
+    The columns of a group of input files.
+        header_line: string - the header line of the first file in the group
+        fields:      dict - field names and their index in the files.  Fields of the first file's header that
+                     the files lack are numbered past their last column, so their values are empty, as in awk.
+        select:      list - the column numbers to output (see select_columns), or None for whole lines
+        header:      string - the header line to output instead of the files' own, or None to output theirs
+        aggregate:   tuple - (group_by, aggregates) from resolve_aggregates, or None if not aggregating.  The
+                     python engine aggregates the records after they are output with the first file's columns,
+                     so only awk scripts use this.
+    """
+    __slots__ = ('header_line', 'fields', 'select', 'header', 'aggregate')
+
+    def __init__(self, header_line: str, fields: Dict[str, int], select: Optional[List[int]] = None,
+                 header: Optional[str] = None, aggregate: Optional[Tuple[List[int], List[Tuple[str, int]]]] = None):
+        self.header_line = header_line
+        self.fields = fields
+        self.select = select
+        self.header = header
+        self.aggregate = aggregate
+
+
+def read_header(file_name: str) -> str:
+    """
+    Read the first line of a file, without its line ending.  Compressed files are decompressed, and bytes
+    that are not utf-8 are replaced, so files that are not csv files can't stop the search.
+    """
+    with open_input(file_name) as f:
+        return f.readline().decode('utf-8', errors='replace').strip()
+
+
+def read_headers(file_list: List[str], jobs: int = 1, cache_dir: Optional[str] = None) -> Dict[str, str]:
+    """
+    Read the header line of each file, jobs files at a time.  Header lines are cached with the size and
+    modification time of their files, so files that have not changed are not read again.
+    args:
+        file_list: The names of the files.
+        jobs: The number of files to read at once. Default is 1.
+        cache_dir: The cache directory.  Default is get_cache_dir().
+    returns:
+        A dictionary of file names and their first lines, without line endings ('' for empty files).
+    """
+    cache_name = os.path.join(cache_dir or get_cache_dir(), HEADER_CACHE_NAME)
+    try:
+        with open(cache_name, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    headers = {}
+    signatures = {}
+    for file in file_list:
+        stat = os.stat(file)
+        signatures[file] = [stat.st_size, stat.st_mtime_ns]
+        entry = cache.get(os.path.abspath(file))
+        if entry is not None and entry[:2] == signatures[file]:
+            headers[file] = entry[2]
+    unread = [file for file in file_list if file not in headers]
+    if not unread:
+        return headers
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        headers.update(zip(unread, executor.map(read_header, unread)))
+    for file in unread:
+        # Move the entry to the end, so that the least recently read headers are dropped first
+        key = os.path.abspath(file)
+        cache.pop(key, None)
+        cache[key] = signatures[file] + [headers[file]]
+    try:
+        os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+        # Write to a temporary file and rename, so concurrent runs never see a partial cache
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(cache_name), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(dict(list(cache.items())[-HEADER_CACHE_ENTRIES:]), f)
+        os.replace(temp_name, cache_name)
+    except OSError as e:
+        print(f"Warning: could not cache header lines in {os.path.dirname(cache_name)}: {e}", file=sys.stderr)
+    return headers
+
+
+def discover_schemas(program: GreppyProgram, file_list: List[str], primary: Schema, field_separator: str = '|',
+                     select_names: Optional[List[str]] = None, jobs: int = 1) -> Dict[str, Schema]:
+    """
+    Group files by their columns.
+    args:
+        program: The parsed program.
+        file_list: The files to be searched.
+        primary: The Schema of the first file's header, which the output follows.
+        field_separator: The separator used in the csv files. Default is '|'.
+        select_names: The names of the columns to output, from --select or !SELECT, or None to output
+                      the columns of the first file's header.
+        jobs: The number of files to read at once. Default is 1.
+    returns:
+        A dictionary of file names and their Schema.  Files with the same columns as the first file, empty
+        files, and files with none of its columns (like files with a different separator) get primary, so
+        they are searched as they would be if files were not grouped.
+    """
+    names = [name for name in primary.fields if name]
+    header = project_line(primary.header_line, primary.select, field_separator,
+                          get_splitter(field_separator, program.quoted)) if primary.select else primary.header_line
+    schemas = {tuple(primary.fields.items()): primary}
+    file_schemas = {}
+    for file, header_line in read_headers(file_list, jobs).items():
+        fields = fields_from_header(header_line, field_separator, program.quoted) if header_line else {}
+        missing = [name for name in names if name not in fields]
+        if len(missing) == len(names):
+            file_schemas[file] = primary
+            continue
+        # Keep {"": 0} last, as in fields_from_header
+        del fields['']
+        for number, name in enumerate(missing, len(fields) + 1):
+            fields[name] = number
+        fields[''] = 0
+        key = tuple(fields.items())
+        if key not in schemas:
+            if missing:
+                print(f"Warning: {file} has no {', '.join(missing)} column, so its values are empty",
+                      file=sys.stderr)
+            schemas[key] = Schema(header_line, fields, select_columns(select_names or names, fields), header,
+                                  resolve_aggregates(program, fields) if primary.aggregate else None)
+        file_schemas[file] = schemas[key]
+    return file_schemas
+
+
+# ---------------------------------------------------------------------------------------------
+# Python engine
+#
+# The functions below evaluate greppy programs in-process, without forking awk.  They follow
+# awk's rules for splitting records into fields and for comparing values, so that the python
+# and awk engines return the same records.
+# ---------------------------------------------------------------------------------------------
+
+# Numeric strings, as recognized by awk when deciding whether to compare fields as numbers
+AWK_NUMBER = re.compile(r'[ \t\n\r\f\v]*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[ \t\n\r\f\v]*\Z')
+
+# Leading numeric prefix, used by awk to convert strings to numbers in arithmetic
+AWK_NUMBER_PREFIX = re.compile(r'[ \t\n\r\f\v]*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+# Tokens in awk match conditions supported by the python engine
+AWK_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<field>\$\d+)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<regex>/(?:[^/\\]|\\.)*/)
+  | (?P<op>&&|\|\||==|!=|<=|>=|!~|[-+*/%<>!~(),])
+  | (?P<name>[A-Za-z_]\w*)
+)''', re.VERBOSE)
+
+
+class AwkString(str):
+    """A string constant or string function result.  Unlike field values, these never compare as numbers."""
+    __slots__ = ()
+
+
+def awk_number(value: str) -> Optional[float]:
+    """
+    Return the numeric value of a field if awk would treat it as a number, otherwise None.
+    args:
+        value: The field value.
+    returns:
+        The value as a float, or None if it does not look like a number.
+    """
+    if AWK_NUMBER.match(value):
+        return float(value)
+    return None
+
+
+def awk_to_number(value) -> float:
+    """Convert a value to a number the way awk does in arithmetic - using its leading numeric prefix, if any."""
+    if isinstance(value, float):
+        return value
+    prefix = AWK_NUMBER_PREFIX.match(value)
+    return float(prefix.group(1)) if prefix else 0.0
+
+
+def awk_to_string(value) -> str:
+    """Convert a value to a string the way awk does - integral numbers print without a decimal point."""
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return f'{value:.6g}'
+    return value
+
+
+def awk_compare(left, operator: str, right) -> float:
+    """
+    Compare two values the way awk does.  If both are numbers or numeric-looking field values,
+    they are compared as numbers; otherwise they are compared as strings.
+    args:
+        left: The left hand value - a float, field value or AwkString.
+        operator: One of <, <=, >, >=, == or !=.
+        right: The right hand value.
+    returns:
+        1.0 if the comparison is true, 0.0 otherwise.
+    """
+    left_number = left if isinstance(left, float) else None if isinstance(left, AwkString) else awk_number(left)
+    right_number = right if isinstance(right, float) else None if isinstance(right, AwkString) else awk_number(right)
+    if left_number is not None and right_number is not None:
+        left, right = left_number, right_number
+    else:
+        left, right = awk_to_string(left), awk_to_string(right)
+    return float(ORDER_OPERATORS[operator](left, right))
+
+
+def awk_true(value) -> bool:
+    """Return the awk truth value of a value - numbers are true if non-zero, strings if non-empty."""
+    if isinstance(value, float):
+        return value != 0
+    if not isinstance(value, AwkString):
+        number = awk_number(value)
+        if number is not None:
+            return number != 0
+    return value != ''
+
+
+# gawk's regular expression escapes, as python regular expressions.  \y, \< and \> are word boundaries,
+# \` and \' the start and end of the text.  Other escaped characters stand for themselves.
+AWK_REGEX_ESCAPES = {'y': r'\b', 'B': r'\B', '<': r'\b(?=\w)', '>': r'\b(?<=\w)', 's': r'\s', 'S': r'\S',
+                     'w': r'\w', 'W': r'\W', '`': r'\A', "'": r'\Z', 'n': r'\n', 't': r'\t', 'r': r'\r',
+                     'f': r'\f', 'v': r'\v', 'a': r'\x07', 'b': r'\x08'}
+
+# The characters escaped in bracket expressions, as python characters
+AWK_BRACKET_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\x07', 'b': '\x08'}
+
+# POSIX character classes, as the contents of python character sets (for the C locale)
+POSIX_CLASSES = {'alpha': 'A-Za-z', 'digit': '0-9', 'alnum': '0-9A-Za-z', 'upper': 'A-Z', 'lower': 'a-z',
+                 'space': r' \t\n\r\f\v', 'blank': r' \t', 'xdigit': '0-9A-Fa-f', 'cntrl': r'\x00-\x1f\x7f',
+                 'print': ' -~', 'graph': '!-~', 'punct': r'!-/:-@\[-`{-~'}
+
+# An interval expression, like {2} or {1,3}
+AWK_INTERVAL = re.compile(r'\{(?:\d+(?:,\d*)?|,\d+)\}')
+
+
+def awk_regex(pattern: str) -> re.Pattern:
+    """
+    Compile a gawk regular expression into a python regular expression that matches the same text.
+    gawk's regular expressions are POSIX extended regular expressions with a few extensions, like the
+    word boundary operators, so they are translated to python syntax first.
+    args:
+        pattern: The regular expression, as written between the slashes of an awk regex constant.
+    returns:
+        The compiled python regular expression.
+    raises:
+        ValueError if the regular expression is not valid or uses syntax that the python engine does not support.
+    """
+    python = []
+    # The repetition operator that python[-1] is, if any - gawk applies repeated operators in turn
+    repeat = None
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        position += 1
+        if char in '*+?' and repeat is not None:
+            if repeat == '{':
+                raise ValueError(f"Unsupported regular expression for the python engine: /{pattern}/")
+            # x** is x*, x++ is x+ and x?? is x?; any other pair matches any number of x's
+            repeat = char if char == repeat else '*'
+            python[-1] = repeat
+            continue
+        if char in '*+?':
+            repeat = char
+            python.append(char)
+            continue
+        repeat = None
+        if char == '\\':
+            if position == len(pattern):
+                raise ValueError(f"Regular expression ends with a backslash: /{pattern}/")
+            escaped = pattern[position]
+            position += 1
+            if escaped in '01234567':
+                # An octal character code, of up to three digits
+                digits = re.match('[0-7]{1,3}', pattern[position - 1:]).group()
+                position += len(digits) - 1
+                python.append(re.escape(chr(int(digits, 8))))
+            else:
+                python.append(AWK_REGEX_ESCAPES.get(escaped, re.escape(escaped)))
+        elif char == '[':
+            character_set, position = awk_bracket_expression(pattern, position)
+            python.append(character_set)
+        elif char == '(' and pattern.startswith('?', position):
+            raise ValueError(f"Unsupported regular expression for the python engine: /{pattern}/")
+        elif char == '{' and AWK_INTERVAL.match(pattern, position - 1):
+            interval = AWK_INTERVAL.match(pattern, position - 1).group()
+            python.append(interval)
+            position += len(interval) - 1
+            repeat = '{'
+        elif char == '{':
+            python.append(r'\{')
+        else:
+            python.append(char)
+    try:
+        return re.compile(''.join(python))
+    except re.error as e:
+        raise ValueError(f"Invalid regular expression: /{pattern}/ ({e})") from e
+
+
+def awk_bracket_expression(pattern: str, position: int) -> Tuple[str, int]:
+    """
+    Translate a bracket expression in a gawk regular expression, like [^[:digit:]x-z], into a python character set.
+    args:
+        pattern: The regular expression.
+        position: The position just past the [ that starts the bracket expression.
+    returns:
+        The python character set and the position just past the ] that ends the bracket expression.
+    raises:
+        ValueError if the bracket expression is not valid.
+    """
+    items = []
+    negate = pattern.startswith('^', position)
+    if negate:
+        position += 1
+    start = position
+    # Whether the last item is a single character, which can start a range
+    single = False
+    while True:
+        if position >= len(pattern):
+            raise ValueError(f"Unterminated bracket expression: /{pattern}/")
+        char = pattern[position]
+        if char == ']' and position > start:
+            return '[' + '^' * negate + ''.join(items) + ']', position + 1
+        if char == '[' and pattern[position + 1:position + 2] in [':', '.', '=']:
+            # A character class, like [:digit:], or a collating symbol or equivalence class, like [.-.]
+            kind = pattern[position + 1]
+            end = pattern.find(kind + ']', position + 2)
+            name = pattern[position + 2:end]
+            if end < 0 or (kind == ':' and name not in POSIX_CLASSES) or (kind != ':' and len(name) != 1):
+                raise ValueError(f"Unsupported bracket expression for the python engine: /{pattern}/")
+            items.append(POSIX_CLASSES[name] if kind == ':' else re.escape(name))
+            single = kind != ':'
+            position = end + 2
+            continue
+        if char == '-' and single and pattern[position + 1:position + 2] not in ['', ']']:
+            # A range, like a-z
+            items.append('-')
+            single = False
+            position += 1
+            continue
+        if char == '\\' and position + 1 < len(pattern):
+            escaped = pattern[position + 1]
+            char = AWK_BRACKET_ESCAPES.get(escaped, escaped)
+            position += 1
+        items.append('\\' + char if char in '\\]^-[&~|' else char)
+        single = True
+        position += 1
+
+
+ORDER_OPERATORS = {'<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b,
+                   '>=': lambda a, b: a >= b, '==': lambda a, b: a == b, '!=': lambda a, b: a != b}
+
+ARITHMETIC_OPERATORS = {ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+                        ast.Div: lambda a, b: a / b, ast.Mod: math.fmod}
+
+AWK_FUNCTIONS = {
+    'length': lambda s=None: float(len(awk_to_string(s))),
+    'tolower': lambda s: AwkString(awk_to_string(s).lower()),
+    'toupper': lambda s: AwkString(awk_to_string(s).upper()),
+    'index': lambda s, t: float(awk_to_string(s).find(awk_to_string(t)) + 1),
+    'int': lambda n: float(math.trunc(awk_to_number(n))),
+    'substr': lambda s, m, n=None: AwkString(
+        awk_to_string(s)[max(int(awk_to_number(m)), 1) - 1:] if n is None else
+        awk_to_string(s)[max(int(awk_to_number(m)), 1) - 1:max(int(awk_to_number(m)) + int(awk_to_number(n)) - 1, 0)]),
+}
+
+
+class AwkExpressionCompiler(ast.NodeTransformer):
+    """
+    Rewrite a python expression translated from an awk match condition so that its operators
+    follow awk semantics, rejecting anything that is not part of the supported subset.
+    """
+
+    def visit_Compare(self, node):  # pylint: disable=invalid-name
+        """a < b becomes _compare(a, '<', b)"""
+        if len(node.ops) != 1:
+            raise ValueError("Chained comparisons are not supported by the python engine")
+        operators = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.Eq: '==', ast.NotEq: '!='}
+        return ast.Call(ast.Name('_compare', ast.Load()),
+                        [self.visit(node.left), ast.Constant(operators[type(node.ops[0])]),
+                         self.visit(node.comparators[0])], [])
+
+    def visit_BinOp(self, node):  # pylint: disable=invalid-name
+        """Arithmetic converts operands to numbers.  @ and // stand in for awk's ~ and !~ regex matches."""
+        left, right = self.visit(node.left), self.visit(node.right)
+        if isinstance(node.op, ast.MatMult):
+            return ast.Call(ast.Name('_match', ast.Load()), [left, right], [])
+        if isinstance(node.op, ast.FloorDiv):
+            return ast.Call(ast.Name('_not', ast.Load()),
+                            [ast.Call(ast.Name('_match', ast.Load()), [left, right], [])], [])
+        if type(node.op) not in ARITHMETIC_OPERATORS:
+            raise ValueError("Unsupported operator in awk match condition")
+        return ast.Call(ast.Name('_arithmetic', ast.Load()),
+                        [ast.Constant(type(node.op).__name__), left, right], [])
+
+    def visit_UnaryOp(self, node):  # pylint: disable=invalid-name
+        """~ stands in for awk's ! and negation converts its operand to a number."""
+        operand = self.visit(node.operand)
+        if isinstance(node.op, (ast.Invert, ast.Not)):
+            return ast.Call(ast.Name('_not', ast.Load()), [operand], [])
+        if isinstance(node.op, ast.USub):
+            return ast.UnaryOp(ast.USub(), ast.Call(ast.Name('_number', ast.Load()), [operand], []))
+        return ast.Call(ast.Name('_number', ast.Load()), [operand], [])
+
+    def visit_BoolOp(self, node):  # pylint: disable=invalid-name
+        """&& and || test the awk truth value of their operands."""
+        return ast.BoolOp(node.op, [ast.Call(ast.Name('_true', ast.Load()), [self.visit(value)], [])
+                                    for value in node.values])
+
+    def visit_Call(self, node):  # pylint: disable=invalid-name
+        """Only field references, string constants and the supported awk functions can be called."""
+        if not isinstance(node.func, ast.Name) or node.keywords or \
+                node.func.id not in ['_field', '_string', '_match'] + list(AWK_FUNCTIONS):
+            raise ValueError("Unsupported function in awk match condition")
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Constant(self, node):  # pylint: disable=invalid-name
+        """Numbers and strings are the only constants."""
+        if not isinstance(node.value, (int, float, str)):
+            raise ValueError("Unsupported constant in awk match condition")
+        return node
+
+    def visit_Name(self, node):  # pylint: disable=invalid-name
+        """NF is the only awk variable supported."""
+        if node.id != '_nf' or not isinstance(node.ctx, ast.Load):
+            raise ValueError(f"Unsupported variable in awk match condition: {node.id}")
+        return node
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.Load)):
+            raise ValueError(f"Unsupported syntax in awk match condition: {type(node).__name__}")
+        return super().generic_visit(node)
+
+
+def compile_awk_condition(condition: str) -> Callable[[List[str], str], bool]:
+    """
+    Compile an awk match condition into a python function.  Supports field references ($n),
+    numbers, strings, regular expression matches, comparisons, arithmetic, &&, ||, !, NF and the
+    awk functions length, tolower, toupper, index, int and substr.
+    args:
+        condition: The awk match condition, with field names already replaced by $n column numbers.
+    returns:
+        A function that takes the list of fields in a record and the full record and returns
+        True if the record satisfies the condition.
+    raises:
+        ValueError if the condition uses awk features that the python engine does not support.
+    """
+    # Translate awk tokens into python syntax.  Regex matches become @ (~) and // (!~), and
+    # awk's ! becomes ~, so that they keep awk's operator precedence.
+    python = []
+    expect_operand = True
+    position = 0
+    condition = condition.strip()
+    while position < len(condition):
+        token = AWK_TOKEN.match(condition, position)
+        if token is None or token.end() == position:
+            raise ValueError(f"Unsupported syntax in awk match condition: {condition[position:]}")
+        position = token.end()
+        kind, text = token.lastgroup, token.group(token.lastgroup)
+        if kind == 'number':
+            python.append(repr(float(text)))
+        elif kind == 'field':
+            python.append(f'_field({int(text[1:])})')
+        elif kind == 'string':
+            python.append(f'_string({text})')
+        elif kind == 'regex' and expect_operand:
+            # Check that the python engine supports the regex before it sees any records
+            awk_regex(text[1:-1])
+            pattern = repr(text[1:-1])
+            # A regex on its own matches the full record
+            python.append(pattern if python and python[-1] in ['@', '//'] else f'_match(_field(0), {pattern})')
+        elif kind == 'regex':
+            # Not a regex after all - a division followed by more tokens
+            position = token.start('regex') + 1
+            python.append('/')
+            expect_operand = True
+            continue
+        elif kind == 'name':
+            if text == 'NF':
+                python.append('_nf')
+            elif text in AWK_FUNCTIONS:
+                python.append(text)
+            else:
+                raise ValueError(f"Unsupported variable in awk match condition: {text}")
+        else:
+            python.append({'&&': ' and ', '||': ' or ', '~': '@', '!~': '//', '!': '~'}.get(text, text))
+        expect_operand = kind == 'op' and text != ')'
+    try:
+        tree = ast.parse(' '.join(python), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Unsupported syntax in awk match condition: {condition}") from e
+    body = AwkExpressionCompiler().visit(tree).body
+    # Compile the condition into a lambda taking the field accessor and NF
+    arguments = ast.arguments(posonlyargs=[], args=[ast.arg('_field'), ast.arg('_nf')],
+                              kwonlyargs=[], kw_defaults=[], defaults=[])
+    tree = ast.fix_missing_locations(ast.Expression(ast.Lambda(arguments, body)))
+    regexes = {}
+
+    def match(value, pattern) -> float:
+        pattern = awk_to_string(pattern)
+        if pattern not in regexes:
+            regexes[pattern] = awk_regex(pattern)
+        return float(regexes[pattern].search(awk_to_string(value)) is not None)
+
+    namespace = {'__builtins__': {}, '_string': AwkString, '_match': match, '_compare': awk_compare,
+                 '_true': lambda value: float(awk_true(value)), '_not': lambda value: float(not awk_true(value)),
+                 '_number': awk_to_number,
+                 '_arithmetic': lambda op, a, b: ARITHMETIC_OPERATORS[getattr(ast, op)](
+                     awk_to_number(a), awk_to_number(b))}
+    namespace.update(AWK_FUNCTIONS)
+    evaluate = eval(compile(tree, '<greppy>', 'eval'), namespace)  # pylint: disable=eval-used
+
+    def condition_function(record: List[str], line: str) -> bool:
+        def field(index: int) -> str:
+            if index == 0:
+                return line
+            return record[index - 1] if index <= len(record) else ''
+        return awk_true(evaluate(field, float(len(record))))
+    return condition_function
+
+
+def normalize_value(value: str) -> str:
+    """Strip leading and trailing spaces and an optional quote at each end, the way equality matches ignore them."""
+    value = value.strip(' ')
+    if value.startswith('"'):
+        value = value[1:]
+    if value.endswith('"'):
+        value = value[:-1]
+    return value
+
+
+def get_splitter(field_separator: str, quoted: bool = False) -> Callable[[str], List[str]]:
+    """
+    Get a function that splits a record into fields the way awk does with FS set to field_separator.
+    args:
+        field_separator: The separator used in the csv file.
+        quoted: A boolean indicating if separators in double quotes are part of the field, as in RFC 4180
+                csv files, like the scripts from generate_awk_script with quoted set.  Fields keep their
+                quotes.  The separator must be a single character other than a space or a quote.
+                Default is False.
+    returns:
+        A function that takes a record and returns a list of its fields.
+    """
+    if quoted:
+        check_quoted_separator(field_separator)
+
+        def split_quoted(line: str) -> List[str]:
+            if '"' not in line:
+                return line.split(field_separator) if line else []
+            # Every other part is in quotes - an escaped quote ("") leaves an empty part between
+            parts = line.split('"')
+            for index in range(1, len(parts), 2):
+                parts[index] = parts[index].replace(field_separator, QUOTED_SEPARATOR)
+            return [value.replace(QUOTED_SEPARATOR, field_separator)
+                    for value in '"'.join(parts).split(field_separator)]
+        return split_quoted
+    if field_separator == ' ':
+        return str.split
+    if len(field_separator) == 1:
+        return lambda line: line.split(field_separator) if line else []
+    separator = awk_regex(field_separator)
+    return lambda line: separator.split(line) if line else []
+
+
+def project_line(line: str, select: List[int], field_separator: str = '|',
+                 splitter: Optional[Callable[[str], List[str]]] = None) -> str:
+    """
+    Get the selected columns of a record, joined by the field separator, as the awk script prints them.
+    args:
+        line: The record, without its line ending.
+        select: The column numbers to output (see select_columns).  Column 0 is the whole record.
+        field_separator: The separator used in the csv file. Default is '|'.
+        splitter: The function from get_splitter for field_separator, if the caller has one.
+    returns:
+        The projected record.
+    """
+    values = (splitter or get_splitter(field_separator))(line)
+    return field_separator.join(line if number == 0 else values[number - 1] if number <= len(values) else ''
+                                for number in select)
+
+
+def compile_clause(clause: Clause, fields: Dict[str, int]) -> Callable[[List[str], str], bool]:
+    """
+    Compile a single match clause into a python function.
+    args:
+        clause: The match clause.
+        fields: A dictionary of field names and their index in the csv file.
+    returns:
+        A function that takes the list of fields in a record and the full record and returns
+        True if the record satisfies the clause.
+    """
+    val = clause.value
+    if clause.kind == 'awk':
+        test = compile_awk_condition(replace_fields_with_numbers(fields, val))
+    else:
+        if not clause.field.startswith('$') and clause.field not in fields:
+            raise ValueError(f"Unknown field: {clause.field}")
+        index = int(clause.field[1:]) if clause.field.startswith('$') else fields[clause.field]
+
+        def value_of(record: List[str], line: str) -> str:
+            if index == 0:
+                return line
+            return record[index - 1] if index <= len(record) else ''
+
+        if clause.kind == 'regex':  # Contains search
+            regex = awk_regex(val[1:-1])
+
+            def test(record, line):
+                return regex.search(value_of(record, line)) is not None
+        elif clause.kind == 'order':  # Order comparison, value includes the test
+            operator = val[:2] if val[1:2] == '=' else val[:1]
+            target = val[len(operator):].strip()
+            number = awk_number(target)
+            if number is None:
+                # Target is an expression, so evaluate the whole comparison as an awk condition
+                test = compile_awk_condition(f"${index} {val}")
+            else:
+                compare = ORDER_OPERATORS[operator]
+                target = awk_to_string(number)
+
+                def test(record, line):
+                    value = value_of(record, line)
+                    value_number = awk_number(value)
+                    if value_number is None:
+                        return compare(value, target)
+                    return compare(value_number, number)
+        else:  # Exact match, ignoring leading and trailing spaces and optional quotes
+            if any(NON_LITERAL_CHARACTERS.intersection(v) for v in clause.values):
+                regex = awk_regex(f'^[ ]*"?({"|".join(clause.values)})"?[ ]*$')
+
+                def test(record, line):
+                    return regex.search(value_of(record, line)) is not None
+            else:
+                targets = set(clause.values)
+
+                def test(record, line):
+                    return normalize_value(value_of(record, line)) in targets
+    if clause.negate:
+        return lambda record, line: not test(record, line)
+    return test
+
+
+def compile_predicate(config_file, fields: Dict[str, int], field_separator: str = '|') -> Callable[[str], bool]:
+    """
+    Compile the rules in the config file into a python function that tests records.
+    args:
+        config_file: The name of the config file that contains the match rules, or a GreppyProgram.
+        fields: A dictionary of field names and their index in the csv file.
+        field_separator: The separator used in the csv file. Default is '|'.
+    returns:
+        A function that takes a record (without its trailing newline) and returns True if it
+        satisfies the rules.
+    """
+    program = read_program(config_file)
+    negate = program.negate
+    if len(program.clauses) > 1 and program.operator not in ['||', '&&']:
+        print("Error: Multiple components require OR or AND")
+        raise ValueError("Error: Multiple components require OR or AND")
+    tests = [compile_clause(clause, fields) for clause in program.clauses]
+    split = get_splitter(field_separator, program.quoted)
+    combine = any if program.operator == '||' else all
+
+    def predicate(line: str) -> bool:
+        record = split(line)
+        return combine(test(record, line) for test in tests) != negate
+    return predicate
+
+
+def read_lines(file_name: str, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+    """
+    Read the lines of a file, or of a byte range of it, through a large buffer.
+    args:
+        file_name: The name of the file to read, or '-' for the rest of standard input.  Compressed files
+                   are decompressed, and must be read from start to end.
+        start: The offset of the first byte to read.  Must be the beginning of a line.
+        end: The offset just past the last byte to read, or None to read to the end of the file.
+    returns:
+        An iterator over the lines, including their line endings.
+    """
+    if file_name == STDIN:
+        for line in sys.stdin.buffer:
+            yield line.decode('utf-8')
+        return
+    with open_input(file_name) as f:
+        if start:
+            f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def python_filter(lines: Iterable[str], predicate: Callable[[str], bool], fields: Dict[str, int],
+                  field_separator: str = '|', has_fields: bool = True, emit_header: bool = True,
+                  select: Optional[List[int]] = None, header: Optional[str] = None,
+                  quoted: bool = False) -> Iterator[str]:
+    """
+    Filter lines in-process, producing the same output as the script from generate_awk_script.
+    args:
+        lines: The input lines.
+        predicate: The function from compile_predicate.
+        fields: A dictionary of field names and their index in the csv file.
+        field_separator: The separator used in the csv file. Default is '|'.
+        has_fields: A boolean indicating if the input has a header line. Default is True.
+        emit_header: A boolean indicating if the header should be handled. Default is True.
+        select: The column numbers to output (see select_columns), or None for whole lines. Default is None.
+        header: With has_fields, the header line to output instead of the input's (see Schema). Default is None.
+        quoted: A boolean indicating if separators in double quotes are part of the field (see !QUOTED), for
+                select. Default is False.
+    returns:
+        An iterator over the output lines.
+    """
+    lines = iter(lines)
+    splitter = get_splitter(field_separator, quoted) if select else None
+    if emit_header and has_fields:
+        for line in lines:
+            if header is not None:
+                line = header
+            elif select:
+                line = project_line(line.rstrip('\n'), select, field_separator, splitter)
+            yield line if line.endswith('\n') else line + '\n'
+            break
+    elif emit_header and len(fields) > 0:
+        # Generate the header line from the fields dictionary, as generate_awk_script does
+        yield select_header(fields, field_separator, select) + '\n'
+    for line in lines:
+        if line.endswith('\n'):
+            if predicate(line[:-1]):
+                yield project_line(line[:-1], select, field_separator, splitter) + '\n' if select else line
+        elif predicate(line):
+            # Like awk's print, always end the line with a newline
+            yield (project_line(line, select, field_separator, splitter) if select else line) + '\n'
+
+
+def head_records(lines: Iterable, limit: int, has_header: bool = True) -> Iterator:
+    """
+    Pass through the header line, if any, and at most limit of the lines after it.
+    args:
+        lines: The output lines.
+        limit: The maximum number of records to pass through.
+        has_header: A boolean indicating if the first line is a header line. Default is True.
+    returns:
+        An iterator over the lines.
+    """
+    lines = iter(lines)
+    if has_header:
+        for line in lines:
+            yield line
+            break
+    yield from islice(lines, limit)
+
+
+def check_results(awk_lines: Iterable[bytes], python_lines: Iterable[str], file_name: str,
+                  mismatches: List[str]) -> Iterator[bytes]:
+    """
+    Pass through the awk output lines, comparing them with the output of the python engine.
+    args:
+        awk_lines: The lines output by awk, as bytes.
+        python_lines: The lines output by python_filter for the same input.
+        file_name: The name of the input file, used in mismatch reports.
+        mismatches: A list that descriptions of any differences are appended to.
+    returns:
+        An iterator over the awk output lines.
+    """
+    for line_number, (awk_line, python_line) in enumerate(zip_longest(awk_lines, python_lines), 1):
+        if python_line is not None:
+            python_line = python_line.encode()
+        if awk_line != python_line and not mismatches:
+            mismatches.append(f"{file_name}: output line {line_number} differs - "
+                              f"awk: {awk_line!r}, python: {python_line!r}")
+        if awk_line is not None:
+            yield awk_line
+
+
+# ---------------------------------------------------------------------------------------------
+# Aggregation
+#
+# !GROUPBY and !AGG summarize the matching records instead of outputting them.  awk accumulates
+# the aggregates for each group in arrays and prints partial results at the end, which python
+# merges across files and chunks and formats as a table.  Group values are compared the way
+# exact matches compare them (see normalize_value), and columns are converted to numbers the
+# way awk does in arithmetic.
+# ---------------------------------------------------------------------------------------------
+
+# Aggregate functions supported by !AGG
+AGGREGATE_FUNCTIONS = ['count', 'sum', 'min', 'max', 'avg']
+
+# Separator between the values in lines of partial aggregates - awk's SUBSEP
+PARTIAL_SEPARATOR = '\x1c'
+
+
+def resolve_aggregates(program: GreppyProgram, fields: Dict[str, int]) -> Tuple[List[int], List[Tuple[str, int]]]:
+    """
+    Get the column numbers used by the !GROUPBY and !AGG directives of a program.
+    args:
+        program: The parsed program.
+        fields: A dictionary of field names and their index in the csv file.
+    returns:
+        (group_by, aggregates) - the numbers of the columns to group by, and (function, column number)
+        for each aggregate, with column number 0 for count().  !GROUPBY without !AGG counts the records
+        in each group.
+    """
+    group_by = select_columns(program.group_by, fields)
+    aggregates = [(function, select_columns([column], fields)[0] if column else 0)
+                  for function, column in program.aggregates or [('count', '')]]
+    return group_by, aggregates
+
+
+def aggregate_header(program: GreppyProgram, field_separator: str = '|') -> str:
+    """Get the header line of the aggregate table for a program - the group columns, then the aggregates."""
+    labels = [f"{function}({column})" for function, column in program.aggregates or [('count', '')]]
+    return field_separator.join(program.group_by + labels)
+
+
+def awk_aggregate(group_by: List[int], aggregates: List[Tuple[str, int]]) -> Tuple[str, str]:
+    """
+    Generate the awk code that computes aggregates.
+    args:
+        group_by: The numbers of the columns to group by.
+        aggregates: (function, column number) for each aggregate.
+    returns:
+        (accumulate, end) - the statements that add a matching record to the aggregates of its group,
+        and an END block that prints a line of partial aggregates for each group.  The values in each
+        line are separated by SUBSEP: the group values (one empty value if there is no !GROUPBY), the
+        number of records, and then the count, sum, minimum or maximum for each aggregate (the sum for avg).
+    """
+    key = ' SUBSEP '.join(f"_norm(${number})" for number in group_by) or '""'
+    statements = [f"_k = {key}", "_count[_k]++"]
+    for index, (function, number) in enumerate(aggregates, 1):
+        if function in ('sum', 'avg'):
+            statements.append(f"_agg{index}[_k] += ${number}")
+        elif function in ('min', 'max'):
+            operator = '<' if function == 'min' else '>'
+            statements.append(f"if (_count[_k] == 1 || ${number} + 0 {operator} _agg{index}[_k]) "
+                              f"_agg{index}[_k] = ${number} + 0")
+    values = ''.join(f' SUBSEP "%.17g"' for _ in aggregates)
+    arguments = ''.join(f", _count[_k]" if function == 'count' else f", _agg{index}[_k]"
+                        for index, (function, _) in enumerate(aggregates, 1))
+    end = f'END {{ for (_k in _count) printf "%s" SUBSEP "%.17g"{values} "\\n", _k, _count[_k]{arguments} }}\n'
+    return '; '.join(statements), end
+
+
+def format_aggregate(value: float) -> str:
+    """Format an aggregate value - integers without a decimal point, other values with 15 significant digits."""
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f'{value:.15g}'
+
+
+class Aggregator:
+    """
+    Aggregates for the groups of matching records, merged from records and from partial aggregates.
+        group_by:        list - the numbers of the columns to group by
+        aggregates:      list - (function, column number) for each aggregate
+        field_separator: string - the separator used in the csv files
+        splitter:        function - splits records into fields (see get_splitter)
+        groups:          dict - [number of records, value of each aggregate] for each group, keyed by a
+                         tuple of the group values
+    """
+    __slots__ = ('group_by', 'aggregates', 'field_separator', 'splitter', 'groups')
+
+    def __init__(self, group_by: List[int], aggregates: List[Tuple[str, int]], field_separator: str = '|',
+                 quoted: bool = False):
+        self.group_by = group_by
+        self.aggregates = aggregates
+        self.field_separator = field_separator
+        self.splitter = get_splitter(field_separator, quoted)
+        self.groups = {}
+
+    def merge(self, key: Tuple[str, ...], count: float, values: List[float]):
+        """Merge the aggregates of count records in a group into the totals."""
+        totals = self.groups.get(key)
+        if totals is None:
+            self.groups[key] = [count, *values]
+            return
+        totals[0] += count
+        for index, (function, _) in enumerate(self.aggregates, 1):
+            if function == 'min':
+                totals[index] = min(totals[index], values[index - 1])
+            elif function == 'max':
+                totals[index] = max(totals[index], values[index - 1])
+            else:
+                totals[index] += values[index - 1]
+
+    def update(self, other: 'Aggregator'):
+        """Merge the aggregates of another Aggregator for the same program into the totals."""
+        for key, (count, *values) in other.groups.items():
+            self.merge(key, count, values)
+
+    def add_record(self, line: str):
+        """Add a matching record, without its line ending, to the aggregates, computing them as awk does."""
+        values = self.splitter(line)
+
+        def column(number: int) -> str:
+            if number == 0:
+                return line
+            return values[number - 1] if number <= len(values) else ''
+        key = tuple(normalize_value(column(number)) for number in self.group_by) or ('',)
+        self.merge(key, 1.0, [1.0 if function == 'count' else awk_to_number(column(number))
+                              for function, number in self.aggregates])
+
+    def add_partial(self, line: str):
+        """Add a line of partial aggregates printed by the awk script (see awk_aggregate)."""
+        parts = line.rstrip('\n').split(PARTIAL_SEPARATOR)
+        size = max(1, len(self.group_by))
+        self.merge(tuple(parts[:size]), float(parts[size]), [float(value) for value in parts[size + 1:]])
+
+    def add_records(self, lines: Iterable[str], has_header: bool = True):
+        """Add the lines output by python_filter, with line endings, skipping the header line if there is one."""
+        lines = iter(lines)
+        if has_header:
+            next(lines, None)
+        for line in lines:
+            self.add_record(line[:-1] if line.endswith('\n') else line)
+
+    def lines(self, header: str) -> Iterator[str]:
+        """
+        Get the aggregate table.
+        args:
+            header: The header line (see aggregate_header).
+        returns:
+            An iterator over the lines of the table, with line endings - the header line, then a line for
+            each group, sorted by the group values.
+        """
+        yield header + '\n'
+        for key in sorted(self.groups):
+            count, *values = self.groups[key]
+            formatted = [format_aggregate(count if function == 'count' else value / count if function == 'avg'
+                                          else value) for (function, _), value in zip(self.aggregates, values)]
+            # Quote group values that contain the separator, which only !QUOTED input can have
+            values = [f'"{value}"' if self.field_separator in value else value for value in key]
+            yield self.field_separator.join((values if self.group_by else []) + formatted) + '\n'
+
+
+# ---------------------------------------------------------------------------------------------
+# Distinct and top records
+#
+# --distinct outputs only the first matching record with each key - the values of some columns, or
+# the whole record.  awk skips records it has already printed for the file it is searching, and
+# python skips the ones already output for earlier files (see Distinct).  --top outputs the K
+# matching records with the smallest (or, with --desc, largest) values in a column, keeping the
+# first K of each file and merging them with the first K so far (see TopRecords).  Memory grows
+# with the number of keys or with K, not with the number of matching records.
+# ---------------------------------------------------------------------------------------------
+
+# Number of --distinct keys to keep in memory before moving them to a temporary database on disk
+DISTINCT_KEYS = 1000000
+
+
+def output_column(name: str, fields: Dict[str, int], select: Optional[List[int]] = None) -> int:
+    """
+    Get the number of a column in the output records.
+    args:
+        name: The name of the column, or $n for column n of the input.
+        fields: A dictionary of field names and their index in the csv file.
+        select: The column numbers that are output (see select_columns), or None for whole records.
+    returns:
+        The column number in the output records.
+    """
+    if name.startswith('$') and name[1:].isdigit():
+        number = int(name[1:])
+    elif name in fields:
+        number = fields[name]
+    else:
+        print("Error: Unknown column: ", name)
+        raise ValueError("Unknown column: " + name)
+    if not select:
+        return number
+    if number not in select:
+        print("Error: Column is not selected: ", name)
+        raise ValueError("Column is not selected: " + name)
+    return select.index(number) + 1
+
+
+class Distinct:
+    """
+    Drops output records with the same key as a record output before.
+        columns:  list - the numbers of the output columns that make up the key, or [] for the whole record.
+                  Column values are compared the way exact matches compare them (see normalize_value).
+        splitter: function - splits records into fields (see get_splitter)
+        max_keys: int - the number of keys to keep in memory
+        keys:     set - digests of the keys seen so far, while there are at most max_keys of them
+        spill:    sqlite3.Connection - a temporary database holding the digests once there are more, or None
+    """
+    __slots__ = ('columns', 'splitter', 'max_keys', 'keys', 'spill')
+
+    def __init__(self, columns: List[int], field_separator: str = '|', quoted: bool = False,
+                 max_keys: int = DISTINCT_KEYS):
+        self.columns = columns
+        self.splitter = get_splitter(field_separator, quoted)
+        self.max_keys = max_keys
+        self.keys = set()
+        self.spill = None
+
+    def key(self, record: bytes) -> bytes:
+        """Get the key of an output record, without its line ending."""
+        if not self.columns:
+            return record
+        values = self.splitter(record.decode('utf-8'))
+        return '\x1c'.join(normalize_value(values[number - 1]) if number <= len(values) else ''
+                           for number in self.columns).encode()
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, returning True if it hasn't been seen before."""
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        if self.spill is not None:
+            return self.spill.execute("INSERT OR IGNORE INTO keys VALUES (?)", (digest,)).rowcount == 1
+        if digest in self.keys:
+            return False
+        self.keys.add(digest)
+        if len(self.keys) > self.max_keys:
+            # An empty name makes a database that sqlite deletes when it is closed
+            self.spill = sqlite3.connect('')
+            self.spill.execute("CREATE TABLE keys (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            self.spill.executemany("INSERT INTO keys VALUES (?)", ((digest,) for digest in self.keys))
+            self.keys = set()
+        return True
+
+    def filter(self, lines: Iterable[bytes], has_header: bool = True) -> Iterator[bytes]:
+        """Pass on output lines, with line endings, leaving out records with keys seen before."""
+        lines = iter(lines)
+        if has_header:
+            for line in lines:
+                yield line
+                break
+        for line in lines:
+            if self.add(self.key(line[:-1] if line.endswith(b'\n') else line)):
+                yield line
+
+
+class TopRecords:
+    """
+    The first output records in the order of a column, across files.  Values that look like numbers are
+    compared as numbers, and come before other values (like empty ones), which are compared as strings.
+        count:      int - the number of records to keep
+        column:     int - the number of the output column to order records by
+        descending: boolean - whether to keep the records with the largest values instead of the smallest
+        splitter:   function - splits records into fields (see get_splitter)
+        header:     bytes - the header line of the output, or None if it has none
+        records:    list - (record, file name) for the first records so far, in order.  Records with the
+                    same value are in the order they were added.
+    """
+    __slots__ = ('count', 'column', 'descending', 'splitter', 'header', 'records')
+
+    def __init__(self, count: int, column: int, descending: bool = False, field_separator: str = '|',
+                 quoted: bool = False):
+        self.count = count
+        self.column = column
+        self.descending = descending
+        self.splitter = get_splitter(field_separator, quoted)
+        self.header = None
+        self.records = []
+
+    def order(self, record: bytes) -> Tuple[int, object]:
+        """Get the sort key of an output record, without its line ending."""
+        values = self.splitter(record.decode('utf-8'))
+        value = values[self.column - 1] if self.column <= len(values) else ''
+        number = awk_number(value)
+        # Numbers come first in either order
+        if number is not None:
+            return (1, number) if self.descending else (0, number)
+        return (0, value) if self.descending else (1, value)
+
+    def add_records(self, lines: Iterable[bytes], file_name: str, has_header: bool = True):
+        """Add the output lines for a file, with line endings, keeping the header line if there is one."""
+        lines = iter(lines)
+        if has_header:
+            header = next(lines, None)
+            if self.header is None:
+                self.header = header
+        records = ((line[:-1] if line.endswith(b'\n') else line, file_name) for line in lines)
+        first = heapq.nlargest if self.descending else heapq.nsmallest
+        # The records kept so far go first, so that they stay ahead of later records with the same value
+        self.records = first(self.count, chain(self.records, records), key=lambda record: self.order(record[0]))
+
+
+# ---------------------------------------------------------------------------------------------
+# Statistics
+#
+# With --stats, greppy times each stage of a run and counts what it reads and writes for each
+# input file.  CompiledProgram.filter takes a RunStats to do the same for in-process filtering.
+# ---------------------------------------------------------------------------------------------
+
+class FileStats:
+    """
+    Counters for one input file.
+        name:         string - the name of the file
+        seconds:      float - wall clock time spent searching the file and writing its results
+        bytes_read:   int - bytes read from the file, or None if it is a stream
+        rows_scanned: int - records searched, not counting the header line
+        rows_matched: int - records that matched
+        output_bytes: int - bytes of results written, including the header line
+        cpu_seconds:  float - CPU time used by awk and decompressor processes for the file, or None if files
+                      were searched in parallel, in which case only the total is known
+    """
+    __slots__ = ('name', 'seconds', 'bytes_read', 'rows_scanned', 'rows_matched', 'output_bytes', 'cpu_seconds')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.rows_scanned = 0
+        self.rows_matched = 0
+        self.output_bytes = 0
+        self.cpu_seconds = None
+
+    def as_dict(self) -> dict:
+        """Get the counters as a dictionary."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class RunStats:
+    """
+    Timings and counters for a greppy run (see --stats) or for filtering with CompiledProgram.
+        stages:       dict - wall clock seconds spent in each stage, in the order the stages started
+        files:        dict - the FileStats for each input file, keyed by file name
+        script_bytes: int - the size of the generated awk script, or 0 if awk was not used
+        cpu_seconds:  float - total CPU time used by awk and decompressor processes
+        files_skipped: int - the number of files in a directory that were not searched because their zone
+                       maps showed that they could not match
+    """
+    __slots__ = ('stages', 'files', 'script_bytes', 'cpu_seconds', 'files_skipped')
+
+    def __init__(self):
+        self.stages = {}
+        self.files = {}
+        self.script_bytes = 0
+        self.cpu_seconds = 0.0
+        self.files_skipped = 0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the run.  Time spent in a stage more than once is added up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def file(self, name: str) -> FileStats:
+        """Get the counters for an input file, adding them the first time."""
+        if name not in self.files:
+            self.files[name] = FileStats(name)
+        return self.files[name]
+
+    def totals(self) -> dict:
+        """Get the counters added up over all of the files."""
+        totals = {'files': len(self.files), 'seconds': sum(self.stages.values())}
+        for name in ['bytes_read', 'rows_scanned', 'rows_matched', 'output_bytes']:
+            totals[name] = sum(getattr(f, name) or 0 for f in self.files.values())
+        totals['cpu_seconds'] = self.cpu_seconds
+        totals['script_bytes'] = self.script_bytes
+        totals['files_skipped'] = self.files_skipped
+        return totals
+
+    def as_dict(self) -> dict:
+        """Get the statistics as a dictionary, suitable for JSON."""
+        return {'stages': self.stages, 'files': [f.as_dict() for f in self.files.values()],
+                'totals': self.totals()}
+
+    def format(self, style: str = 'text') -> str:
+        """
+        Format the statistics for display.
+        args:
+            style: 'json' for JSON or 'text' for a human-readable table.
+        returns:
+            The formatted statistics.
+        """
+        if style == 'json':
+            return json.dumps(self.as_dict(), indent=2)
+
+        def number(value) -> str:
+            if value is None:
+                return '-'
+            return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+        columns = ['seconds', 'bytes_read', 'rows_scanned', 'rows_matched', 'output_bytes', 'cpu_seconds']
+        lines = ['Stages:']
+        lines += [f"  {name:<20} {seconds:10.3f}s" for name, seconds in self.stages.items()]
+        rows = [[f.name] + [number(getattr(f, name)) for name in columns] for f in self.files.values()]
+        totals = self.totals()
+        rows.append(['total'] + [number(totals[name]) for name in columns])
+        widths = [max(len(row[i]) for row in rows + [['file'] + columns]) for i in range(len(columns) + 1)]
+        lines.append('Files:')
+        for row in [['file'] + columns] + rows:
+            lines.append('  ' + '  '.join(value.ljust(widths[i]) if i == 0 else value.rjust(widths[i])
+                                          for i, value in enumerate(row)))
+        if self.script_bytes:
+            lines.append(f"awk script: {self.script_bytes} bytes")
+        if self.files_skipped:
+            lines.append(f"files skipped by zone maps: {self.files_skipped}")
+        return '\n'.join(lines)
+
+
+def children_cpu_seconds() -> float:
+    """Get the CPU time used so far by child processes that have finished, or 0 if it is not available."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def read_awk_stats(stats_name: str) -> Tuple[int, int]:
+    """
+    Read and remove the counts written by a script generated with stats=True (see generate_awk_script).
+    args:
+        stats_name: The file named by the stats variable.
+    returns:
+        (records read, including any header line, records matched), or (0, 0) if awk wrote nothing.
+    """
+    try:
+        with open(stats_name, 'r', encoding='utf-8') as f:
+            counts = f.read().split()
+    finally:
+        os.remove(stats_name)
+    if len(counts) != 2:
+        return 0, 0
+    return int(counts[0]), int(counts[1])
+
+
+def awk_stats_name() -> str:
+    """Create an empty temporary file for a script generated with stats=True to write its counts to."""
+    fd, stats_name = tempfile.mkstemp(prefix='greppy_', suffix='.stats')
+    os.close(fd)
+    return stats_name
+
+
+def count_lines(lines: Iterable, file_stats: FileStats, counter: str, count_bytes: bool = False) -> Iterator:
+    """
+    Pass lines through unchanged, counting them.
+    args:
+        lines: The lines.
+        file_stats: The counters to add to.
+        counter: The name of the counter to add one to for each line, like 'rows_scanned'.
+        count_bytes: A boolean indicating if the UTF-8 length of each line should be added to bytes_read.
+    returns:
+        An iterator over the lines.
+    """
+    count = size = 0
+    try:
+        for line in lines:
+            count += 1
+            if count_bytes:
+                size += len(line.encode('utf-8')) if isinstance(line, str) else len(line)
+            yield line
+    finally:
+        setattr(file_stats, counter, getattr(file_stats, counter) + count)
+        if count_bytes:
+            file_stats.bytes_read += size
+
+
+class ByteCounter:
+    """A binary output that discards what is written to it, counting the bytes.  Stands in for the output
+    file with --stdout-only."""
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data: bytes) -> int:
+        self.count += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class CompiledProgram:
+    """
+    A greppy program compiled for filtering in-process with the python engine.
+    Nothing is written to disk and no subprocesses are started.
+        program: GreppyProgram - the parsed program
+    """
+    __slots__ = ('program', 'predicates')
+
+    def __init__(self, program: GreppyProgram):
+        self.program = program
+        # Compiled predicates, keyed by the fields they were compiled for
+        self.predicates = {}
+
+    def get_predicate(self, fields: Dict[str, int]) -> Callable[[str], bool]:
+        """Get the predicate for inputs with the given fields, compiling it the first time it is needed."""
+        key = tuple(fields.items())
+        if key not in self.predicates:
+            self.predicates[key] = compile_predicate(self.program, fields, self.program.field_separator)
+        return self.predicates[key]
+
+    def sources(self, source) -> Iterator[Tuple[str, Iterable]]:
+        """
+        Get the inputs to filter, each as an iterable of lines.
+        args:
+            source: A file or directory name, a text or binary file object, an iterable of lines,
+                    or None for the file spec in the program.
+        returns:
+            An iterator over (name, lines) for the inputs.  Directories produce one input for each file in them.
+            Inputs that are not files are named after the object's name attribute, if any, or '<input>'.
+        """
+        if source is None:
+            source = self.program.file_spec
+        if isinstance(source, (str, os.PathLike)):
+            source = os.fspath(source)
+            for file in get_input_files(source, get_path_type(source)):
+                yield file, read_lines(file)
+            return
+        name = str(getattr(source, 'name', '<input>'))
+        if isinstance(source, io.TextIOBase):
+            yield name, source
+        elif hasattr(source, 'read'):
+            yield name, (line.decode('utf-8') for line in source)
+        else:
+            yield name, (line.decode('utf-8') if isinstance(line, bytes) else line for line in source)
+
+    def filter(self, source=None, stats: Optional[RunStats] = None) -> Iterator[str]:
+        """
+        Filter records, yielding the ones that match the program.
+        args:
+            source: A file or directory name, a text or binary file object (like sys.stdin), an iterable
+                    of lines, or None for the file spec in the program.  If the program has neither !FIELDS
+                    nor !NOHEADER, the first line of each input is its header.
+            stats: If given, the rows scanned and matched and the bytes read for each input are added to it.
+                   The time for each input includes the time the caller spends on its records.
+        returns:
+            A generator over the matching records, without their line endings.  If the program has a !SELECT
+            directive, only the selected columns of each record are returned.
+        """
+        program = self.program
+        has_fields = len(program.fields) == 0 and not program.noheader
+        for name, lines in self.sources(source):
+            start = time.perf_counter()
+            lines = iter(lines)
+            fields = program.fields
+            file_stats = stats.file(name) if stats is not None else None
+            if file_stats is not None:
+                file_stats.bytes_read = os.path.getsize(name) if os.path.isfile(name) else None
+            if has_fields:
+                header_line = next(lines, None)
+                if header_line is None:
+                    continue
+                fields = fields_from_header(header_line.strip(), program.field_separator, program.quoted)
+            predicate = self.get_predicate(fields)
+            select = select_columns(program.select, fields)
+            splitter = get_splitter(program.field_separator, program.quoted)
+            scanned = matched = 0
+            try:
+                for scanned, line in enumerate(lines, 1):
+                    if line.endswith('\n'):
+                        line = line[:-1]
+                    if predicate(line):
+                        matched += 1
+                        yield project_line(line, select, program.field_separator, splitter) if select else line
+            finally:
+                if file_stats is not None:
+                    file_stats.rows_scanned += scanned
+                    file_stats.rows_matched += matched
+                    file_stats.seconds += time.perf_counter() - start
+
+    def count(self, source=None, stats: Optional[RunStats] = None) -> int:
+        """
+        Count the records that match the program.
+        args:
+            source: The input, as for filter.
+            stats: If given, statistics are added to it, as for filter.
+        returns:
+            The number of matching records.
+        """
+        return sum(1 for _ in self.filter(source, stats))
+
+
+def compile_program(program_text: str, file_spec: Optional[str] = None) -> CompiledProgram:
+    """
+    Compile greppy program text for filtering in-process.  For example,
+
+        products = compile_program("AND\\nProductDescription | /nut/\\nNOT | ProductCategory | snacks", file_spec='')
+        for record in products.filter(open('products.csv')):
+            ...
+
+    args:
+        program_text: The program, in the same format as program files.
+        file_spec: If given, the program text does not start with a file spec line and this is used instead.
+    returns:
+        The compiled program.
+    """
+    return CompiledProgram(parse_program(program_text, file_spec=file_spec))
+
+
+# ---------------------------------------------------------------------------------------------
+# Column indexes
+#
+# "greppy.py index FILE COLUMN" builds a sidecar index (FILE.gpidx, an sqlite database) mapping the
+# normalized values of a column to the byte offsets of the records that have them.  When every
+# input file has an up to date index for a column with an exact match clause, greppy reads just
+# the records the index points to and passes them to the engine (awk, unless --engine python)
+# instead of scanning, so an index never changes which records match.
+# ---------------------------------------------------------------------------------------------
+
+# Extension of column index files, added to the name of the indexed file
+INDEX_EXTENSION = '.gpidx'
+
+
+def get_index_name(file_name: str) -> str:
+    """Get the name of the column index file for an input file."""
+    return file_name + INDEX_EXTENSION
+
+
+def file_signature(file_name: str) -> str:
+    """Get a string that changes when a file is modified, from its size and modification time."""
+    stat = os.stat(file_name)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def open_index(file_name: str, field_separator: str, has_header: bool) -> Optional[sqlite3.Connection]:
+    """
+    Open the column index of an input file, if it has one that is up to date.
+    args:
+        file_name: The indexed file.
+        field_separator: The separator used in the csv file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+    returns:
+        The index database, or None if there is no index, the file has changed since it was built, it was
+        built with a different separator or header setting or it can't be read.
+    """
+    index_name = get_index_name(file_name)
+    if not os.path.isfile(index_name):
+        return None
+    connection = sqlite3.connect(index_name)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+    except sqlite3.DatabaseError as e:
+        print(f"Warning: ignoring unreadable index {index_name}: {e}", file=sys.stderr)
+        connection.close()
+        return None
+    if meta != {'signature': file_signature(file_name), 'separator': field_separator,
+                'header': str(int(has_header))}:
+        connection.close()
+        return None
+    return connection
+
+
+def build_index(file_name: str, column: str, field_separator: str = '|', has_header: bool = True) -> int:
+    """
+    Build or update the column index for an input file.  Indexes for other columns are kept if the file
+    has not changed since they were built.
+    args:
+        file_name: The file to index.  It must not be compressed, since index lookups seek into it.
+        column: The name of the column in the header line, or $n for column n.
+        field_separator: The separator used in the csv file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+    returns:
+        The number of records indexed.
+    """
+    if get_compression(file_name) is not None:
+        raise ValueError(f"Compressed files can't be indexed: {file_name}")
+    if column.startswith('$'):
+        number = int(column[1:])
+    else:
+        fields = fields_from_header(read_header_line(file_name, 'file'), field_separator) if has_header else {}
+        if column not in fields:
+            raise ValueError(f"Unknown field: {column}")
+        number = fields[column]
+    split = get_splitter(field_separator)
+    connection = open_index(file_name, field_separator, has_header)
+    if connection is None:
+        # Start over, dropping any out of date index
+        if os.path.exists(get_index_name(file_name)):
+            os.remove(get_index_name(file_name))
+        connection = sqlite3.connect(get_index_name(file_name))
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE idx (field INTEGER, value TEXT, offset INTEGER)")
+        connection.execute("CREATE INDEX idx_value ON idx (field, value)")
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('signature', file_signature(file_name)), ('separator', field_separator),
+            ('header', str(int(has_header)))])
+
+    def entries() -> Iterator[Tuple[int, str, int]]:
+        offset = 0
+        with open(file_name, 'rb', buffering=1024 * 1024) as f:
+            for line_number, line in enumerate(f):
+                if not (has_header and line_number == 0):
+                    record = line.decode('utf-8').rstrip('\n')
+                    values = split(record)
+                    value = record if number == 0 else values[number - 1] if number <= len(values) else ''
+                    yield number, normalize_value(value), offset
+                offset += len(line)
+
+    with connection:
+        connection.execute("DELETE FROM idx WHERE field = ?", (number,))
+        connection.executemany("INSERT INTO idx VALUES (?, ?, ?)", entries())
+        count = connection.execute("SELECT COUNT(*) FROM idx WHERE field = ?", (number,)).fetchone()[0]
+    connection.close()
+    return count
+
+
+def index_offsets(program: GreppyProgram, fields: Dict[str, int], file_name: str,
+                  has_header: bool) -> Optional[List[int]]:
+    """
+    Use the column index of an input file to find the records that may satisfy a program.
+    The program must be a single clause or clauses joined by AND, without NOT, and at least one of the
+    clauses must be an exact match or list clause with literal values on an indexed column.
+    args:
+        program: The parsed program.
+        fields: A dictionary of field names and their index in the csv file.
+        file_name: The input file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+    returns:
+        The sorted byte offsets of the candidate records, or None if the index can't be used.  Candidates
+        satisfy the indexed clauses, and still have to be checked against the whole program.
+    """
+    if program.negate or (program.operator == '||' and len(program.clauses) > 1):
+        return None
+    if file_name == STDIN or not os.path.isfile(file_name) or get_compression(file_name) is not None:
+        return None
+    connection = open_index(file_name, program.field_separator, has_header)
+    if connection is None:
+        return None
+    offsets = None
+    try:
+        indexed = {field for (field,) in connection.execute("SELECT DISTINCT field FROM idx")}
+        for clause in program.clauses:
+            if clause.negate or clause.kind not in ('equal', 'list'):
+                continue
+            if not clause.field.startswith('$') and clause.field not in fields:
+                continue
+            if any(NON_LITERAL_CHARACTERS.intersection(value) for value in clause.values):
+                # awk matches the value as a regex, so records with other values can match it
+                continue
+            number = int(clause.field[1:]) if clause.field.startswith('$') else fields[clause.field]
+            if number not in indexed:
+                continue
+            placeholders = ', '.join('?' * len(clause.values))
+            found = {offset for (offset,) in connection.execute(
+                f"SELECT offset FROM idx WHERE field = ? AND value IN ({placeholders})",
+                (number, *clause.values))}
+            offsets = found if offsets is None else offsets & found
+    except sqlite3.DatabaseError as e:
+        print(f"Warning: ignoring unreadable index {get_index_name(file_name)}: {e}", file=sys.stderr)
+        offsets = None
+    finally:
+        connection.close()
+    return None if offsets is None else sorted(offsets)
+
+
+def read_lines_at(file_name: str, offsets: Iterable[int]) -> Iterator[str]:
+    """
+    Read the lines that start at the given offsets of a file.
+    args:
+        file_name: The name of the file to read.
+        offsets: The byte offsets of the beginnings of the lines, in increasing order.
+    returns:
+        An iterator over the lines, including their line endings.
+    """
+    with open(file_name, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            line = f.readline()
+            if line:
+                yield line.decode('utf-8')
+
+
+def index_main(argv: List[str]) -> int:
+    """The index command: build a column index for an input file."""
+    parser = argparse.ArgumentParser(prog='greppy.py index',
+                                     description='Build a column index that greppy uses for exact match lookups')
+    parser.add_argument('file', help='The csv file to index')
+    parser.add_argument('column', help='The name of the column to index, or $n for column n')
+    parser.add_argument('--separator', default='|', help='The field separator used in the file (default |)')
+    parser.add_argument('--noheader', action='store_true', help='The file has no header line')
+    args = parser.parse_args(argv)
+    try:
+        count = build_index(args.file, args.column, args.separator, not args.noheader)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Indexed {count} records of {args.file} in {get_index_name(args.file)}")
+    return 0
+
+
+# ---------------------------------------------------------------------------------------------
+# Zone maps
+#
+# "greppy.py zonemap FILE_OR_DIRECTORY..." builds a sidecar zone map for each file (FILE.gpzm, a small
+# JSON file) with the smallest and largest values of each column and a Bloom filter of the values.
+# Before searching a directory, greppy skips the files whose zone maps show that none of their
+# records can satisfy the program, like daily files whose dates or IDs are all outside the range
+# that the program asks for.  Zone maps are ignored once their file changes.
+# ---------------------------------------------------------------------------------------------
+
+# Extension of zone map files, added to the name of the file they describe
+ZONEMAP_EXTENSION = '.gpzm'
+
+# Default size of the Bloom filter of each column, in bits, and the number of bits set for each value
+BLOOM_BITS = 8192
+BLOOM_HASHES = 3
+
+# The comparison a record has to fail for a negated comparison clause to match it
+INVERSE_OPERATORS = {'<': '>=', '<=': '>', '>': '<=', '>=': '<'}
+
+
+def get_zonemap_name(file_name: str) -> str:
+    """Get the name of the zone map file for an input file."""
+    return file_name + ZONEMAP_EXTENSION
+
+
+def bloom_positions(value: str, bits: int) -> List[int]:
+    """Get the positions of the Bloom filter bits for a value."""
+    digest = hashlib.blake2b(value.encode(), digest_size=4 * BLOOM_HASHES).digest()
+    return [int.from_bytes(digest[i:i + 4], 'little') % bits for i in range(0, len(digest), 4)]
+
+
+class ColumnZone:
+    """
+    The range of the values in a column of a file.
+        count:       int - the number of records with a value in the column
+        low, high:   string - the smallest and largest values, normalized as for exact matches (see normalize_value)
+        number_low, number_high: float - the smallest and largest values that awk compares as numbers, or None
+        text_low, text_high:     string - the smallest and largest of the other values, as written, or None
+        bloom:       int - the Bloom filter of the normalized values, as the bits of an integer
+    """
+    __slots__ = ('count', 'low', 'high', 'number_low', 'number_high', 'text_low', 'text_high', 'bloom')
+
+    def __init__(self, zone: Optional[dict] = None):
+        zone = zone or {}
+        self.count = zone.get('count', 0)
+        self.low, self.high = zone.get('low'), zone.get('high')
+        self.number_low, self.number_high = zone.get('number_low'), zone.get('number_high')
+        self.text_low, self.text_high = zone.get('text_low'), zone.get('text_high')
+        self.bloom = int(zone.get('bloom', '0'), 16)
+
+    def add(self, value: str, bloom_bits: int):
+        """Add a value, without its separators, to the range."""
+        self.count += 1
+        normalized = normalize_value(value)
+        if self.low is None or normalized < self.low:
+            self.low = normalized
+        if self.high is None or normalized > self.high:
+            self.high = normalized
+        number = awk_number(value)
+        if number is not None:
+            if self.number_low is None or number < self.number_low:
+                self.number_low = number
+            if self.number_high is None or number > self.number_high:
+                self.number_high = number
+        else:
+            if self.text_low is None or value < self.text_low:
+                self.text_low = value
+            if self.text_high is None or value > self.text_high:
+                self.text_high = value
+        if bloom_bits:
+            for position in bloom_positions(normalized, bloom_bits):
+                self.bloom |= 1 << position
+
+    def as_dict(self) -> dict:
+        """Get the range as a dictionary, suitable for JSON."""
+        return {'count': self.count, 'low': self.low, 'high': self.high, 'number_low': self.number_low,
+                'number_high': self.number_high, 'text_low': self.text_low, 'text_high': self.text_high,
+                'bloom': format(self.bloom, 'x')}
+
+    def may_equal(self, values: List[str], bloom_bits: int) -> bool:
+        """Check if any value in the column could be one of the normalized values."""
+        return any(self.low <= value <= self.high and (not bloom_bits or all(
+            self.bloom >> position & 1 for position in bloom_positions(value, bloom_bits))) for value in values)
+
+    def may_compare(self, operator: str, number: float) -> bool:
+        """Check if any value in the column could satisfy a comparison with a number, the way awk compares."""
+        compare = ORDER_OPERATORS[operator]
+        bound = self.number_high if operator[0] == '>' else self.number_low
+        if bound is not None and compare(bound, number):
+            return True
+        # awk compares values that don't look like numbers as strings
+        bound = self.text_high if operator[0] == '>' else self.text_low
+        return bound is not None and compare(bound, awk_to_string(number))
+
+
+def read_zonemap(file_name: str, field_separator: str = '|', has_header: bool = True,
+                 quoted: bool = False) -> Optional[dict]:
+    """
+    Read the zone map of an input file, if it has one that is up to date.
+    args:
+        file_name: The file.
+        field_separator: The separator used in the csv file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+        quoted: A boolean indicating if fields in double quotes can contain the separator (see !QUOTED).
+    returns:
+        The zone map, or None if there is none, the file has changed since it was built or it was built
+        with different settings.
+    """
+    try:
+        with open(get_zonemap_name(file_name), 'r', encoding='utf-8') as f:
+            zonemap = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if [zonemap.get(key) for key in ('signature', 'separator', 'header', 'quoted')] != \
+            [file_signature(file_name), field_separator, has_header, quoted]:
+        return None
+    return zonemap
+
+
+def build_zonemap(file_name: str, field_separator: str = '|', has_header: bool = True, quoted: bool = False,
+                  bloom_bits: int = BLOOM_BITS) -> int:
+    """
+    Build the zone map for an input file.
+    args:
+        file_name: The file.  Compressed files are decompressed.
+        field_separator: The separator used in the csv file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+        quoted: A boolean indicating if fields in double quotes can contain the separator (see !QUOTED).
+        bloom_bits: The size of the Bloom filter of each column, in bits, or 0 for no Bloom filters.
+    returns:
+        The number of records in the file.
+    """
+    # Read the signature first, so that a file that changes while it is read gets a zone map that is out of date
+    signature = file_signature(file_name)
+    split = get_splitter(field_separator, quoted)
+    zones = []
+    records = 0
+    for line_number, line in enumerate(read_lines(file_name)):
+        if has_header and line_number == 0:
+            continue
+        records += 1
+        values = split(line[:-1] if line.endswith('\n') else line)
+        zones += [ColumnZone() for _ in range(len(values) - len(zones))]
+        for zone, value in zip(zones, values):
+            zone.add(value, bloom_bits)
+    for zone in zones:
+        if zone.count < records:
+            # Records that end before the column have an empty value in it
+            zone.add('', bloom_bits)
+            zone.count = records
+    zonemap = {'signature': signature, 'separator': field_separator, 'header': has_header, 'quoted': quoted,
+               'records': records, 'bloom_bits': bloom_bits, 'columns': [zone.as_dict() for zone in zones]}
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(zonemap, f)
+    os.replace(temp_name, get_zonemap_name(file_name))
+    return records
+
+
+def clause_may_match(clause: Clause, fields: Dict[str, int], zonemap: dict, negate: bool = False) -> bool:
+    """
+    Check if any record described by a zone map could satisfy a clause.
+    args:
+        clause: The match clause.
+        fields: A dictionary of field names and their index in the csv file.
+        zonemap: The zone map, from read_zonemap.
+        negate: A boolean indicating if the clause is negated by a NOT for the whole program.
+    returns:
+        False if no record can satisfy the clause, True if one might.
+    """
+    if zonemap['records'] == 0:
+        return False
+    if clause.kind not in ('equal', 'list', 'order'):
+        return True
+    if not clause.field.startswith('$') and clause.field not in fields:
+        return True
+    number = int(clause.field[1:]) if clause.field.startswith('$') else fields[clause.field]
+    if number == 0:
+        return True
+    columns = zonemap['columns']
+    # Columns after the last one in every record are empty
+    zone = ColumnZone(columns[number - 1]) if number <= len(columns) else ColumnZone()
+    if number > len(columns):
+        zone.add('', zonemap['bloom_bits'])
+    negate = negate != clause.negate
+    if clause.kind == 'order':
+        operator = clause.value[:2] if clause.value[1:2] == '=' else clause.value[:1]
+        target = awk_number(clause.value[len(operator):])
+        if target is None:
+            return True
+        return zone.may_compare(INVERSE_OPERATORS[operator] if negate else operator, target)
+    if any(NON_LITERAL_CHARACTERS.intersection(value) for value in clause.values):
+        # awk matches the value as a regex, so other values can match it
+        return True
+    if negate:
+        # Only a column with a single value that is one of the values can't match
+        return not (zone.low == zone.high and zone.low in clause.values)
+    return zone.may_equal(clause.values, zonemap['bloom_bits'])
+
+
+def zonemap_may_match(program: GreppyProgram, fields: Dict[str, int], file_name: str, has_header: bool) -> bool:
+    """
+    Check if any record of an input file could satisfy a program, using the file's zone map.
+    args:
+        program: The parsed program.
+        fields: A dictionary of field names and their index in the csv file.
+        file_name: The input file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+    returns:
+        False if the zone map shows that no record can satisfy the program, True if there is no up to date
+        zone map or a record might.
+    """
+    zonemap = read_zonemap(file_name, program.field_separator, has_header, program.quoted)
+    if zonemap is None or not program.clauses:
+        return True
+    matches = (clause_may_match(clause, fields, zonemap, program.negate) for clause in program.clauses)
+    # NOT (a AND b) is (NOT a) OR (NOT b), and NOT (a OR b) is (NOT a) AND (NOT b)
+    return any(matches) if (program.operator == '||') != program.negate else all(matches)
+
+
+def zonemap_main(argv: List[str]) -> int:
+    """The zonemap command: build zone maps for input files."""
+    parser = argparse.ArgumentParser(prog='greppy.py zonemap',
+                                     description='Build the zone maps that greppy uses to skip files that cannot match')
+    parser.add_argument('paths', nargs='+', metavar='path', help='The csv files, or directories of csv files')
+    parser.add_argument('--separator', default='|', help='The field separator used in the files (default |)')
+    parser.add_argument('--noheader', action='store_true', help='The files have no header line')
+    parser.add_argument('--quoted', action='store_true',
+                        help='Fields in double quotes can contain the separator, as with the !QUOTED directive')
+    parser.add_argument('--bloom-bits', type=int, default=BLOOM_BITS,
+                        help=f'Size of the Bloom filter of each column in bits, or 0 for none (default {BLOOM_BITS})')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files to read at once. 0 means one per CPU.')
+    args = parser.parse_args(argv)
+    if args.jobs < 0 or args.bloom_bits < 0:
+        parser.error('--jobs and --bloom-bits must be at least 0')
+    if args.quoted:
+        try:
+            check_quoted_separator(args.separator)
+        except ValueError as e:
+            parser.error(str(e))
+    file_list = [file for path in args.paths for file in get_input_files(path, get_path_type(path))]
+
+    def build(file_name: str) -> int:
+        return build_zonemap(file_name, args.separator, not args.noheader, args.quoted, args.bloom_bits)
+    with ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count() or 1) as executor:
+        for file, records in zip(file_list, executor.map(build, file_list)):
+            print(f"Mapped {records} records of {file} in {get_zonemap_name(file)}")
+    return 0
+
+
+# ---------------------------------------------------------------------------------------------
+# Literal prefilter
+#
+# With --prefilter, greppy finds the text that every matching record has to contain - the literal
+# part of a /regex/, or the values of an exact match or [list] clause - and searches the memory-mapped
+# input for it, like grep does, instead of splitting every record into fields.  Only the lines that
+# contain it are passed to the engine (awk, unless --engine python), which checks them against the
+# whole program.  This is much faster when few records can match.  When the text is common, most
+# lines are read a second time, which is slower than a scan.
+# ---------------------------------------------------------------------------------------------
+
+def regex_literal(pattern: str) -> str:
+    """
+    Get the longest text that every match of a regular expression contains.
+    args:
+        pattern: The regular expression, without the surrounding slashes.
+    returns:
+        The text, or '' if no text is required (or the pattern has alternatives).
+    """
+    if '|' in pattern:
+        return ''
+    runs, run = [''], ''
+    depth, i = 0, 0
+    while i < len(pattern):
+        c, literal = pattern[i], None
+        if c == '\\' and i + 1 < len(pattern):
+            i += 1
+            # Escaped letters and digits, and \<, \>, \` and \', are operators or control characters
+            if not pattern[i].isalnum() and pattern[i] not in AWK_REGEX_ESCAPES:
+                literal = pattern[i]
+        elif c == '[':
+            # Skip the bracket expression, including any [:class:] in it
+            try:
+                i = awk_bracket_expression(pattern, i + 1)[1] - 1
+            except ValueError:
+                return ''
+        elif c == '{':
+            i = pattern.find('}', i)
+            if i < 0:
+                return ''
+        elif c in '()':
+            depth += 1 if c == '(' else -1
+        elif c not in '.^$*?+':
+            literal = c
+        following = pattern[i + 1:i + 2]
+        if literal is not None and depth == 0 and following not in ['*', '?', '{']:
+            run += literal
+        if literal is None or depth or following in ['*', '?', '{', '+']:
+            # The text can't go on past a character that can be left out or repeated
+            runs.append(run)
+            run = ''
+        i += 1
+    runs.append(run)
+    return max(runs, key=len)
+
+
+def clause_literals(clause: Clause) -> Optional[List[str]]:
+    """
+    Get the texts that a record has to contain one of to satisfy a clause.
+    returns:
+        The texts, or None if the clause doesn't require any.
+    """
+    if clause.negate:
+        return None
+    if clause.kind == 'regex':
+        literals = [regex_literal(clause.value[1:-1])]
+    elif clause.kind in ('equal', 'list'):
+        # Values are matched whole, after leaving out spaces and quotes around them
+        literals = [regex_literal(value) if NON_LITERAL_CHARACTERS.intersection(value) else value
+                    for value in clause.values]
+    else:
+        return None
+    return None if '' in literals else literals
+
+
+def program_literals(program: GreppyProgram) -> Optional[List[str]]:
+    """
+    Get the texts that a record has to contain one of to satisfy a program.
+    Under AND, the clause with the fewest and longest texts is used.  Under OR, every clause has to
+    require some text, and a record has to contain one of them.
+    returns:
+        The texts, or None if the program doesn't require any.
+    """
+    if program.negate or not program.clauses:
+        return None
+    choices = [clause_literals(clause) for clause in program.clauses]
+    if program.operator == '||' and len(program.clauses) > 1:
+        if None in choices:
+            return None
+        return sorted({literal for literals in choices for literal in literals})
+    choices = [literals for literals in choices if literals is not None]
+    if not choices:
+        return None
+    return sorted(set(min(choices, key=lambda literals: (len(literals), -min(map(len, literals))))))
+
+
+def prefilter_offsets(program: GreppyProgram, file_name: str, has_header: bool) -> Optional[List[int]]:
+    """
+    Find the records of an input file that contain the text the program requires (see program_literals).
+    args:
+        program: The parsed program.
+        file_name: The input file.
+        has_header: A boolean indicating if the first line of the file is a header line.
+    returns:
+        The byte offsets of the candidate records, in increasing order, or None if the file can't be memory-mapped
+        or the program doesn't require any text.  Candidates still have to be checked against the whole program.
+    """
+    if file_name == STDIN or not os.path.isfile(file_name) or get_compression(file_name) is not None:
+        return None
+    literals = program_literals(program)
+    if literals is None:
+        return None
+    if os.path.getsize(file_name) == 0:
+        return []
+    targets = [literal.encode() for literal in literals]
+    if len(targets) == 1:
+        target = targets[0]
+
+        def find(data, position: int) -> int:
+            return data.find(target, position)
+    else:
+        regex = re.compile(b'|'.join(re.escape(target) for target in sorted(targets, key=len, reverse=True)))
+
+        def find(data, position: int) -> int:
+            match = regex.search(data, position)
+            return match.start() if match else -1
+    offsets = []
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = data.find(b'\n') + 1 if has_header else 0
+        if position == 0 and has_header:
+            return []
+        while True:
+            found = find(data, position)
+            if found < 0:
+                break
+            offsets.append(data.rfind(b'\n', 0, found) + 1)
+            position = data.find(b'\n', found) + 1
+            if position == 0:
+                break
+    return offsets
+
+
+def get_output_name(file_spec: str, config_file: str) -> str:
+    """
+    Generate a base output file name by contatenating the file_spec and rules file names with underscores
+    and removing special characters.
+    args:
+        file_spec: The file or directory searched.
+        config_file: The name of the config file.
+    returns:
+        The name, without an extension.
+    """
+    output_name = file_spec + '_' + config_file
+    return output_name.replace('/', '_').replace(
+        '.', '_').replace(' ', '_').replace('csv', '').replace('txt', '').replace('__', '_').replace('\\', '_').replace('C:', '').replace('-', '_')
+
+
+def get_input_files(file_spec: str, path_type: str) -> List[str]:
+    """
+    Get the list of input files to search.
+    args:
+        file_spec: The file or directory to be searched.
+        path_type: 'dir' if file_spec is a directory, 'stdin' for standard input, 'file' if it is a file.
+    returns:
+        A list containing just file_spec if it is a file or '-', or the regular files in it
+        (in directory listing order) if it is a directory.
+    """
+    if path_type == 'dir':
+        file_list = [os.path.join(file_spec, f) for f in os.listdir(file_spec)]
+        # Column indexes and zone maps describe the files next to them, so they are not searched
+        return [file for file in file_list
+                if os.path.isfile(file) and not file.endswith((INDEX_EXTENSION, ZONEMAP_EXTENSION))]
+    return [file_spec]
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a byte count like '500000', '64K', '256M' or '2G'.
+    args:
+        size: The size string.  K, M and G suffixes are powers of 1024.
+    returns:
+        The number of bytes.
+    """
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def split_file(file_name: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Split a file into byte ranges of roughly chunk_size bytes, aligned to line boundaries.
+    args:
+        file_name: The name of the file to split.
+        chunk_size: The target number of bytes in each range.
+    returns:
+        A list of (start, end) byte offsets covering the whole file.  Each range starts at
+        the beginning of a line and ends just after a newline or at the end of the file.
+    """
+    size = os.path.getsize(file_name)
+    bounds = [0]
+    with open(file_name, 'rb') as f:
+        while bounds[-1] + chunk_size < size:
+            # Move to the end of the line containing the last byte of the chunk
+            f.seek(bounds[-1] + chunk_size - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def run_awk_to_file(script_args: List[str], file: str, start: int = 0, end: Optional[int] = None,
+                    variables: Iterable[str] = ()) -> str:
+    """
+    Run the awk script on a single input file or a byte range of it, saving the results in a temporary file.
+    Used by worker threads in --jobs mode.
+    args:
+        script_args: The awk arguments giving the script (see awk_program_args).
+        file: The input file to search.  Compressed files are decompressed, and must be searched whole.
+        start: The offset of the first byte to search.  Must be the beginning of a line.
+        end: The offset just past the last byte to search, or None to search to the end of the file.
+        variables: awk command line options setting variables used by the script (see awk_variables).
+    returns:
+        The name of the temporary file holding the results.  The caller is responsible for removing it.
+    """
+    fd, result_name = tempfile.mkstemp(prefix='greppy_', suffix='.out')
+    with os.fdopen(fd, 'wb') as result:
+        with awk_process([*variables, *script_args], file, start, end, stdout=result):
+            pass
+    return result_name
+
+
+# Scripts longer than this are not passed on the awk command line, which has a length limit
+INLINE_SCRIPT_SIZE = 64 * 1024
+
+
+def awk_program_args(script: str, script_name: Optional[str] = None) -> List[str]:
+    """
+    Get the awk arguments that give it a script.
+    args:
+        script: The awk script.
+        script_name: The file the script has been saved in, or None to pass the script on the command line.
+    returns:
+        ['-f', script_name] if the script has been saved, [script] otherwise.
+    """
+    if script_name is not None:
+        return ['-f', script_name]
+    return [script]
+
+
+def files_as_completed(file_futures: Dict[str, List[Future]]) -> Iterator[str]:
+    """
+    Yield the files being searched in the order that all of their chunks finish.
+    args:
+        file_futures: A dictionary of files and the futures for their chunks.
+    returns:
+        An iterator over the files whose futures are all done.
+    """
+    owners = {future: file for file, futures in file_futures.items() for future in futures}
+    remaining = {file: len(futures) for file, futures in file_futures.items()}
+    for future in as_completed(owners):
+        file = owners[future]
+        remaining[file] -= 1
+        if remaining[file] == 0:
+            yield file
+
+
+def relay_results(lines: Iterable[bytes], out: BinaryIO, file_name: str, field_separator: str,
+                  multi_file: bool, has_header: bool, header_written: bool, console: bool = True) -> bool:
+    """
+    Write the awk output lines for one input file to the console and to the output file.
+    If there are multiple files, add the file name as a new field to the end of each line.
+    Do not repeat the header line for each file - just create one with the new field name.
+        args:
+            lines: The lines output by awk for the input file, as bytes.
+            out: The output csv file, opened in binary mode.
+            file_name: The name of the input file.
+            field_separator: The separator used in the csv file.
+            multi_file: A boolean indicating if more than one file is being searched.
+            has_header: A boolean indicating if the first line of awk output is a header line.
+            header_written: A boolean indicating if the header line has already been written.
+            console: A boolean indicating if the lines should also be written to the console. Default is True.
+        returns:
+            A boolean indicating if the header line has been written.
+    """
+    stdout = sys.stdout.buffer
+    file_suffix = f"{field_separator} {file_name}\n".encode()
+    header_suffix = f" {field_separator} file name\n".encode()
+    for line_number, line in enumerate(lines):
+        if has_header and line_number == 0:
+            if header_written:
+                # Skip header line for files after the first one in multi-file
+                continue
+            header_written = True
+            if multi_file:
+                # get the first line of the awk output and add file name
+                line = line.strip() + header_suffix
+                out.write(line)
+                if console:
+                    stdout.write(line)
+                continue
+        if multi_file:
+            # Add the file name to the end of each line
+            line = line.strip() + file_suffix
+        else:
+            line = line.strip() + b"\n"
+        if console:
+            stdout.write(line)
+        out.write(line)
+    return header_written
+
+
+def copy_results(result: BinaryIO, out: BinaryIO, skip_header: bool, console: bool = True):
+    """
+    Copy results that awk has already formatted for the output file (see --fast) in large blocks.
+    args:
+        result: The awk output, opened in binary mode.
+        out: The output csv file, opened in binary mode.
+        skip_header: A boolean indicating if the first line is a header line that has already been written.
+        console: A boolean indicating if the results should also be written to the console. Default is True.
+    returns:
+        A boolean indicating if there were any results, including the header line.
+    """
+    if skip_header and not result.readline():
+        return False
+    copied = skip_header
+    while True:
+        block = result.read(1024 * 1024)
+        if not block:
+            break
+        copied = True
+        out.write(block)
+        if console:
+            sys.stdout.buffer.write(block)
+    return copied
+
+
+# ---------------------------------------------------------------------------------------------
+# Incremental search
+#
+# With --incremental, greppy keeps a state file recording how far it has searched each input file,
+# so that each run only searches the records appended since the last one, and the files added to
+# the directory.  Files are identified by their inode, so a file that is replaced or truncated
+# (rotated) is searched again from the start.  --follow keeps searching as the input grows.
+# ---------------------------------------------------------------------------------------------
+
+def load_state(state_name: str) -> dict:
+    """
+    Load the state of incremental searches.
+    args:
+        state_name: The name of the state file.
+    returns:
+        The state - {'header_written': whether the header line has been written to the output,
+        'files': {file name: {'inode': inode, 'size': size, 'offset': offset searched up to}}},
+        with no files if the state file does not exist yet.
+    """
+    try:
+        with open(state_name, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'header_written': False, 'files': {}}
+
+
+def save_state(state_name: str, state: dict):
+    """Save the state of incremental searches, replacing the state file in one step."""
+    directory = os.path.dirname(os.path.abspath(state_name))
+    fd, temp_name = tempfile.mkstemp(prefix='greppy_', suffix='.state', dir=directory)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_name, state_name)
+
+
+def complete_lines_end(file_name: str, size: int) -> int:
+    """
+    Get the offset just past the last complete line in the first size bytes of a file.  A line that
+    is still being written, without its line ending, is left for the next search.
+    args:
+        file_name: The file.
+        size: The size of the file.
+    returns:
+        The offset, or 0 if there is no complete line.
+    """
+    with open(file_name, 'rb') as f:
+        end = size
+        while end > 0:
+            start = max(0, end - 64 * 1024)
+            f.seek(start)
+            block = f.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def plan_increment(file_list: List[str], files: Dict[str, dict]) -> Tuple[Dict[str, Tuple[int, Optional[int]]],
+                                                                           Dict[str, dict]]:
+    """
+    Work out what to search in an incremental search.
+    args:
+        file_list: The input files.
+        files: The state of each file after the last search (see load_state).
+    returns:
+        (ranges, files) - the (start, end) byte range to search in each file that has new records, and
+        the state of each file once they have been searched.  Compressed files can't be searched from
+        the middle, so they are searched whole whenever they change.
+    """
+    ranges = {}
+    searched = {}
+    for file in file_list:
+        stat = os.stat(file)
+        previous = files.get(file)
+        same_file = previous is not None and previous['inode'] == stat.st_ino
+        entry = {'inode': stat.st_ino, 'size': stat.st_size}
+        if get_compression(file) is not None:
+            if not same_file or previous['size'] != stat.st_size:
+                ranges[file] = (0, None)
+            entry['offset'] = stat.st_size
+        else:
+            start = previous['offset'] if same_file and stat.st_size >= previous['offset'] else 0
+            end = complete_lines_end(file, stat.st_size) if stat.st_size > start else start
+            if end > start:
+                ranges[file] = (start, end)
+            entry['offset'] = max(start, end)
+        searched[file] = entry
+    return ranges, searched
+
+
+# ---------------------------------------------------------------------------------------------
+# Batch mode
+#
+# "greppy.py batch PROGRAM..." runs several programs that search the same input in one pass.  The
+# match conditions of all of them go into one awk script, which reads each record once and prints
+# it to a separate temporary output for each program that it matches.  The outputs are then
+# relayed to each program's output csv as main would write it.
+# ---------------------------------------------------------------------------------------------
+
+def generate_batch_script(matches: List[str], fields: Dict[str, int], field_separator: str = '|',
+                          has_fields: bool = True, emit_header: bool = True, begin: str = '',
+                          prelude: str = '', selects: Optional[List[Optional[List[int]]]] = None,
+                          quoted: bool = False, headers: Optional[List[Optional[str]]] = None) -> str:
+    """
+    Generate an awk script that runs several match conditions over the same input.  The records matching
+    the condition for program n are printed to the file named by the variable outn, starting with out1.
+    args:
+        matches: The match strings generated from the rules of each program.
+        fields: A dictionary of field names and their index in the csv file.
+        field_separator: The separator used in the csv file. Default is '|'.
+        has_fields: A boolean indicating if the input files have headers. Default is True.
+        emit_header: A boolean indicating if the script should handle the header line. Default is True.
+        begin: awk statements to run before reading the input (see optimize_rules). Default is ''.
+        prelude: awk statements to run on each line before it is tested. Default is ''.
+        selects: The column numbers each program outputs (see select_columns), or None for whole lines.
+                 Default is None, which outputs whole lines for every program.
+        quoted: A boolean indicating if separators in double quotes are part of the field (see !QUOTED).
+                Default is False.
+        headers: With has_fields, the header line each program outputs instead of the input's (see Schema),
+                 or None to output the input's.  Default is None, which outputs the input's for every program.
+    returns:
+        The awk script.
+    """
+    outputs = [f"out{number}" for number in range(1, len(matches) + 1)]
+    selects = selects or [None] * len(matches)
+    headers = headers or [None] * len(matches)
+    records = [f' {awk_string(field_separator)} '.join(f"${number}" for number in select) if select else "$0"
+               for select in selects]
+    print_header = '; '.join(f"print {awk_string(header) if header is not None else record} > {output}"
+                             for record, header, output in zip(records, headers, outputs))
+    routes = '; '.join(f"if ({match}) print {record} > {output}"
+                       for match, record, output in zip(matches, records, outputs))
+    awk_script = f'BEGIN {{ FS="{field_separator}"'
+    if quoted:
+        awk_script += f'; OFS="{field_separator}"'
+    if emit_header and not has_fields and len(fields) > 0:
+        # Generate the header line from the fields dictionary, as generate_awk_script does
+        awk_script += ''.join(f'; print "{select_header(fields, field_separator, select)}" > {output}'
+                              for select, output in zip(selects, outputs))
+    awk_script += '}\n'
+    if begin:
+        awk_script += f"BEGIN {{ {begin} }}\n"
+    if quoted:
+        awk_script += '{ if (index($0, "\\"")) _unquote() }\n'
+    if emit_header and has_fields:
+        awk_script += f"NR == 1 {{ {print_header} }}\n"
+        awk_script += f"NR > 1 {{ {prelude + ' ' if prelude else ''}{routes} }}\n"
+    else:
+        awk_script += f"{{ {prelude + ' ' if prelude else ''}{routes} }}\n"
+    if '_norm(' in awk_script:
+        awk_script += NORMALIZE_FUNCTION
+    if quoted:
+        awk_script += quoted_function(field_separator)
+    return awk_script
+
+
+def batch_main(argv: List[str]) -> int:
+    """The batch command: run several programs over the same input in one pass."""
+    parser = argparse.ArgumentParser(prog='greppy.py batch',
+                                     description='Run several greppy programs that search the same input, '
+                                     'reading it once')
+    parser.add_argument('config_files', nargs='+', metavar='config_file', help='Greppy configuration files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files to search in parallel when the file spec is a directory. '
+                        '0 means one per CPU.')
+    parser.add_argument('--no-optimize', action='store_true',
+                        help='Generate the awk match conditions exactly as written in the programs')
+    parser.add_argument('--output-dir', metavar='DIR',
+                        help='Write the output csv files to DIR instead of next to greppy.py')
+    args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error('--jobs must be at least 0')
+    jobs = args.jobs or os.cpu_count() or 1
+
+    programs = [read_program(config_file) for config_file in args.config_files]
+    first = programs[0]
+    for config_file, program in zip(args.config_files, programs):
+        if ((program.file_spec, program.field_separator, program.fields, program.noheader, program.quoted) !=
+                (first.file_spec, first.field_separator, first.fields, first.noheader, first.quoted)):
+            parser.error(f'{config_file} does not search the same input as {args.config_files[0]}.  Batch programs '
+                         'must have the same file spec and !FIELDS, !SEPARATOR, !NOHEADER and !QUOTED directives')
+        if program.group_by or program.aggregates:
+            parser.error(f'{config_file} uses !GROUPBY or !AGG, which batch programs do not support')
+    path_type, file_spec = first.path_type, first.file_spec
+    field_separator, fields, noheader, quoted = first.field_separator, dict(first.fields), first.noheader, first.quoted
+    if quoted:
+        try:
+            check_quoted_separator(field_separator)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # Read the header line once for all the programs, as main does for one
+    has_fields = len(fields) == 0 and not noheader
+    header_line = ''
+    if has_fields:
+        header_line = read_header_line(file_spec, path_type)
+        fields = fields_from_header(header_line, field_separator, quoted)
+    stdin_header = has_fields and path_type == 'stdin'
+    selects = []
+    for config_file, program in zip(args.config_files, programs):
+        try:
+            selects.append(select_columns(program.select, fields) or None)
+        except ValueError as e:
+            parser.error(f'{config_file}: {e}')
+
+    # Files in a directory with other columns than the first file get their own script, and their results
+    # have the first file's columns, as main searches them (see discover_schemas)
+    file_list = get_input_files(file_spec, path_type)
+    primary = Schema(header_line, fields)
+    file_schemas = {}
+    if has_fields and path_type == 'dir' and len(file_list) > 1:
+        file_schemas = discover_schemas(first, file_list, primary, field_separator, jobs=jobs)
+    scripts = {}
+
+    def schema_script_args(schema: Schema) -> List[str]:
+        """Get the awk arguments giving the batch script for files with the schema's columns."""
+        if schema in scripts:
+            return scripts[schema]
+        schema_selects, headers = selects, None
+        if schema is not primary:
+            # Each program's columns, found in the schema's header, and its header line from the first file
+            try:
+                schema_selects = [select_columns(program.select, schema.fields) if program.select else schema.select
+                                  for program in programs]
+            except ValueError as e:
+                parser.error(str(e))
+            headers = [project_line(header_line, select, field_separator, get_splitter(field_separator, quoted))
+                       if select else header_line for select in selects]
+        # Combine the match conditions.  Each program gets its own list arrays, and statements normalizing
+        # fields that several programs test are only run once per record.
+        matches, begins, prelude = [], [], []
+        for number, program in enumerate(programs, 1):
+            if args.no_optimize:
+                match, begin, program_prelude = parse_rules(program, schema.fields), '', ''
+            else:
+                match, begin, program_prelude = optimize_rules(program, schema.fields, f'_list{number}_')
+            matches.append(match)
+            begins.append(begin)
+            for statement in program_prelude.split(';'):
+                if statement.strip() and statement.strip() + ';' not in prelude:
+                    prelude.append(statement.strip() + ';')
+        script = generate_batch_script(matches, schema.fields, field_separator, has_fields, not stdin_header,
+                                       ' '.join(begin for begin in begins if begin), ' '.join(prelude),
+                                       schema_selects, quoted, headers)
+        if len(script) <= INLINE_SCRIPT_SIZE:
+            scripts[schema] = awk_program_args(script)
+        else:
+            script_name = get_output_name(file_spec, 'batch') + (f'_{len(scripts)}' if scripts else '') + '.awk'
+            save_script(script_name, script)
+            scripts[schema] = awk_program_args(script, script_name)
+        return scripts[schema]
+
+    # Generate the scripts before the files are searched on several threads
+    for schema in [primary, *file_schemas.values()]:
+        schema_script_args(schema)
+
+    def run_file(file: str) -> List[str]:
+        """Run the script on an input file, returning the names of the temporary outputs for each program."""
+        result_names = []
+        for _ in programs:
+            fd, result_name = tempfile.mkstemp(prefix='greppy_', suffix='.out')
+            os.close(fd)
+            result_names.append(result_name)
+        variables = awk_variables(**{f"out{number}": name for number, name in enumerate(result_names, 1)})
+        with awk_process([*variables, *schema_script_args(file_schemas.get(file, primary))], file,
+                         stdout=subprocess.DEVNULL):
+            pass
+        return result_names
+
+    multi_file = len(file_list) > 1
+    has_header = len(fields) > 0
+    output_dir = Path(args.output_dir) if args.output_dir else Path(__file__).parent
+    paths = [output_dir / (get_output_name(file_spec, config_file) + '.csv') for config_file in args.config_files]
+    headers_written = [False] * len(programs)
+    with ExitStack() as stack, ThreadPoolExecutor(max_workers=jobs) as executor:
+        outs = [stack.enter_context(path.open('ab')) for path in paths]
+        for file, result_names in zip(file_list, executor.map(run_file, file_list)):
+            try:
+                for number, result_name in enumerate(result_names):
+                    # The header line of standard input has been read already, so it is passed on by python
+                    header_lines = []
+                    if stdin_header and header_line:
+                        header_lines = [(project_line(header_line, selects[number], field_separator,
+                                                      get_splitter(field_separator, quoted))
+                                         if selects[number] else header_line) + '\n']
+                    with open(result_name, 'rb') as result:
+                        headers_written[number] = relay_results(
+                            chain((line.encode() for line in header_lines), result), outs[number], str(file),
+                            field_separator, multi_file, has_header, headers_written[number], console=False)
+            finally:
+                for result_name in result_names:
+                    os.remove(result_name)
+    for config_file, path in zip(args.config_files, paths):
+        print(f"Results for {config_file} in {path}")
+    return 0
+
+
+# ---------------------------------------------------------------------------------------------
+# Server
+#
+# "greppy.py serve" keeps running with the programs it is sent compiled for the python engine, and the
+# header lines of the files it searches, and searches on a pool of worker threads, so a search doesn't
+# pay for loading greppy, parsing the program, compiling its match conditions and reading headers each
+# time.  The threads share one interpreter, so they don't filter records in parallel.
+# greppy_client.py, next to greppy.py, sends a program to the server over a Unix socket (or localhost
+# TCP, with --port) and prints the results as they arrive, in place of "greppy.py PROGRAM --stdout-only".
+# ---------------------------------------------------------------------------------------------
+
+# Default number of compiled programs the server keeps
+SERVER_PROGRAMS = 128
+
+
+def get_socket_name() -> str:
+    """Get the default server socket - greppy.sock in the cache directory."""
+    return os.path.join(get_cache_dir(), 'greppy.sock')
+
+
+def get_server_address(socket_name: Optional[str] = None, port: Optional[int] = None):
+    """Get the server address - ('127.0.0.1', port) if a port is given, otherwise the name of the Unix socket."""
+    if port is not None:
+        return '127.0.0.1', port
+    return socket_name or get_socket_name()
+
+
+def connect_server(address) -> socket.socket:
+    """Connect to the server at an address from get_server_address."""
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(address)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def read_schemas(program: GreppyProgram, file_spec: str, file_list: List[str]) -> Tuple[Schema, Dict[str, Schema]]:
+    """
+    Read the columns of the files a program searches, for search_results.
+    args:
+        program: The parsed program.
+        file_spec: The file or directory to search.
+        file_list: The files to search (see get_input_files).
+    returns:
+        The Schema of the first file's header, and the Schema of each file in a directory whose columns are
+        different (see discover_schemas).
+    """
+    has_fields = len(program.fields) == 0 and not program.noheader
+    path_type = get_path_type(file_spec)
+    fields, header_line = program.fields, ''
+    if has_fields:
+        header_line = read_header_line(file_spec, path_type)
+        fields = fields_from_header(header_line, program.field_separator, program.quoted)
+    primary = Schema(header_line, fields, select_columns(program.select, fields) or None)
+    # Files in a directory with other columns are searched by their own
+    file_schemas = {}
+    if has_fields and path_type == 'dir' and len(file_list) > 1:
+        file_schemas = discover_schemas(program, file_list, primary, program.field_separator, program.select)
+    return primary, file_schemas
+
+
+def search_results(compiled: CompiledProgram, file_spec: str, name: Optional[str] = None,
+                   count_only: bool = False,
+                   schemas: Optional[Tuple[List[str], Schema, Dict[str, Schema]]] = None) -> Iterator[str]:
+    """
+    Search with a compiled program, producing the output of "greppy.py PROGRAM --stdout-only --engine python".
+    args:
+        compiled: The compiled program.
+        file_spec: The file or directory to search.
+        name: The file spec to name files by in the results, if it is not file_spec (a relative path, say).
+        count_only: If True, produce the number of matching records instead, as --count does.
+        schemas: The files to search and their schemas from read_schemas, if they are already known.
+    returns:
+        An iterator over the output lines, with line endings.
+    """
+    program = compiled.program
+    field_separator = program.field_separator
+    has_fields = len(program.fields) == 0 and not program.noheader
+    if schemas is None:
+        file_list = get_input_files(file_spec, get_path_type(file_spec))
+        schemas = (file_list, *read_schemas(program, file_spec, file_list))
+    file_list, primary, file_schemas = schemas
+    fields = primary.fields
+    aggregator = None
+    if (program.group_by or program.aggregates) and not count_only:
+        aggregator = Aggregator(*resolve_aggregates(program, fields), field_separator, program.quoted)
+    has_header = len(fields) > 0
+    multi_file = len(file_list) > 1
+    header_written = False
+    count = 0
+    for file in file_list:
+        schema = file_schemas.get(file, primary)
+        output = python_filter(read_lines(file), compiled.get_predicate(schema.fields), schema.fields,
+                               field_separator, has_fields, select=schema.select, header=schema.header,
+                               quoted=program.quoted)
+        if aggregator is not None:
+            aggregator.add_records(output, has_header)
+            continue
+        # Like relay_results, with one header line and the file name column for directories
+        file_name = (name or file_spec) + file[len(file_spec):]
+        for line_number, line in enumerate(output):
+            if has_header and line_number == 0:
+                if header_written or count_only:
+                    continue
+                header_written = True
+                yield line.strip() + (f" {field_separator} file name\n" if multi_file else '\n')
+            elif count_only:
+                count += 1
+            else:
+                yield line.strip() + (f"{field_separator} {file_name}\n" if multi_file else '\n')
+    if aggregator is not None:
+        yield from (line.strip() + '\n' for line in aggregator.lines(aggregate_header(program, field_separator)))
+    elif count_only:
+        yield f"{count}\n"
+
+
+class SearchHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a search request - a line of JSON with the program text ("program") and, optionally, the file spec
+    ("file_spec") if the program text doesn't start with one, the directory that relative file specs are in
+    ("cwd") and whether to count the matching records instead of returning them ("count").  The response is a
+    line of JSON, {"ok": true} or {"error": message}, then the results (see search_results) or the count and
+    another line of JSON saying whether the search finished, so the last line of a response is always a status.
+    """
+    # Results are sent in blocks rather than a line at a time
+    wbufsize = io.DEFAULT_BUFFER_SIZE
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or 'null')
+            if not isinstance(request, dict) or not isinstance(request.get('program'), str):
+                raise ValueError('The request has no program')
+            compiled = self.server.get_program(request['program'], request.get('file_spec'))
+            program = compiled.program
+            if program.path_type == 'stdin':
+                raise ValueError('The server cannot search standard input')
+            file_spec = os.path.join(request.get('cwd') or '', program.file_spec)
+            self.server.check_path(file_spec)
+            if not os.path.exists(file_spec):
+                raise ValueError(f"File or directory not found: {program.file_spec}")
+            schemas = self.server.get_schemas(program, file_spec)
+            for file in schemas[0]:
+                # Files in a directory can be links to files outside the root
+                self.server.check_path(file)
+            results = search_results(compiled, file_spec, program.file_spec, bool(request.get('count')), schemas)
+            # Start searching before answering, so that errors in the program are reported
+            first = next(results, None)
+        except (ValueError, OSError) as e:
+            self.wfile.write(json.dumps({'error': str(e)}).encode() + b'\n')
+            return
+        try:
+            self.wfile.write(b'{"ok": true}\n')
+            try:
+                for line in chain([first] if first is not None else [], results):
+                    self.wfile.write(line.encode())
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                # Like a file removed or a line that isn't utf-8 part way through the search
+                status = {'error': str(e) or type(e).__name__}
+            else:
+                status = {'ok': True}
+            self.wfile.write(json.dumps(status).encode() + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client has gone away
+            pass
+
+
+class SearchServer(socketserver.ThreadingMixIn):
+    """
+    Mixin for socketserver servers that handle search requests (see SearchHandler) on a pool of worker threads.
+        pool:         ThreadPoolExecutor - the worker threads
+        programs:     dict - the compiled programs, keyed by program text and file spec, least recently used first
+        schemas:      dict - (signature, files, primary schema, file schemas) for the file specs searched, keyed by
+                      file spec and the program settings that read_schemas uses, least recently used first.  The
+                      signature has the size and modification time of each file.
+        max_programs: int - the number of compiled programs, and of file specs' schemas, to keep
+        root:         string - the directory that searched files have to be in, or None to search any file the
+                      server can read
+        lock:         threading.Lock - guards programs and schemas
+    """
+
+    def __init__(self, address, jobs: int = 1, max_programs: int = SERVER_PROGRAMS, root: Optional[str] = None):
+        super().__init__(address, SearchHandler)
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.programs = {}
+        self.schemas = {}
+        self.max_programs = max_programs
+        self.root = os.path.realpath(root) if root is not None else None
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        """Handle a request on a worker thread from the pool, instead of on a new thread."""
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+    def get_program(self, program_text: str, file_spec: Optional[str] = None) -> CompiledProgram:
+        """Get the compiled program for program text, compiling it if it isn't one of the programs kept."""
+        key = (program_text, file_spec)
+        with self.lock:
+            compiled = self.programs.pop(key, None)
+        if compiled is None:
+            compiled = compile_program(program_text, file_spec)
+        with self.lock:
+            self.programs[key] = compiled
+            while len(self.programs) > self.max_programs:
+                del self.programs[next(iter(self.programs))]
+        return compiled
+
+    def check_path(self, path: str):
+        """Raise ValueError if a path is outside the root directory, after following links."""
+        if self.root is not None and os.path.commonpath([self.root, os.path.realpath(path)]) != self.root:
+            raise ValueError(f"{path} is outside the directory the server searches, {self.root}")
+
+    def get_schemas(self, program: GreppyProgram, file_spec: str) -> Tuple[List[str], Schema, Dict[str, Schema]]:
+        """
+        Get the files a program searches and their schemas, for search_results.  Header lines are only read
+        again when a file has been added, removed or changed since they were last read.
+        """
+        file_list = get_input_files(file_spec, get_path_type(file_spec))
+        signature = [(file, file_signature(file)) for file in file_list]
+        key = (os.path.abspath(file_spec), program.field_separator, program.quoted, program.noheader,
+               tuple(program.fields.items()), tuple(program.select or ()))
+        with self.lock:
+            entry = self.schemas.pop(key, None)
+        if entry is None or entry[0] != signature:
+            entry = (signature, file_list, *read_schemas(program, file_spec, file_list))
+        with self.lock:
+            self.schemas[key] = entry
+            while len(self.schemas) > self.max_programs:
+                del self.schemas[next(iter(self.schemas))]
+        return entry[1:]
+
+
+class TCPSearchServer(SearchServer, socketserver.TCPServer):
+    """A search server listening on a TCP port."""
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixSearchServer(SearchServer, socketserver.UnixStreamServer):
+        """A search server listening on a Unix socket, that only the user running it can connect to."""
+
+        def server_bind(self):
+            super().server_bind()
+            os.chmod(self.server_address, 0o600)
+
+
+def serve_main(argv: List[str]) -> int:
+    """The serve command: search for clients until interrupted."""
+    parser = argparse.ArgumentParser(prog='greppy.py serve',
+                                     description='Keep greppy programs compiled and search for greppy_client.py')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='The Unix socket to listen on (default greppy.sock in the cache directory)')
+    parser.add_argument('--port', type=int, help='Listen on this localhost TCP port instead of a Unix socket')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Number of searches to serve at once. 0 (the default) means one per CPU.  They '
+                        'share one python interpreter, so they overlap reading and sending results but don\'t '
+                        'filter records in parallel.')
+    parser.add_argument('--root', metavar='DIR',
+                        help='Only search files in this directory.  Required with --port, since any local user can '
+                        'connect to it and search the files the server can read.')
+    parser.add_argument('--programs', type=int, default=SERVER_PROGRAMS,
+                        help=f'Number of compiled programs, and of file specs\' header lines, to keep '
+                        f'(default {SERVER_PROGRAMS})')
+    args = parser.parse_args(argv)
+    if args.jobs < 0 or args.programs < 1:
+        parser.error('--jobs must be at least 0 and --programs at least 1')
+    if args.socket and args.port is not None:
+        parser.error('--socket and --port cannot be combined')
+    if args.port is not None and args.root is None:
+        parser.error('--port needs --root, since any local user can connect to the port')
+    if args.root is not None and not os.path.isdir(args.root):
+        parser.error(f"--root is not a directory: {args.root}")
+    address = get_server_address(args.socket, args.port)
+    jobs = args.jobs or os.cpu_count() or 1
+    if isinstance(address, tuple):
+        server = TCPSearchServer(address, jobs, args.programs, args.root)
+    else:
+        if not hasattr(socketserver, 'UnixStreamServer'):
+            parser.error('Unix sockets are not available here, so use --port')
+        if os.path.exists(address):
+            try:
+                connect_server(address).close()
+            except OSError:
+                # Left behind by a server that didn't shut down
+                os.remove(address)
+            else:
+                parser.error(f"A server is already listening on {address}")
+        os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+        server = UnixSearchServer(address, jobs, args.programs, args.root)
+    print(f"Serving on {server.server_address}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+    return 0
+
+
+# ---------------------------------------------------------------------------------------------
+# Searching
+#
+# main searches the input in work units - byte ranges of the input files, which are whole files unless
+# --chunk-size splits them.  Each unit is searched by search_unit, or all of them at once by search_parallel,
+# with the SearchSettings that main resolves from the options and the program, and the results are written
+# through a SearchOutput.
+# ---------------------------------------------------------------------------------------------
+
+def search_parser() -> argparse.ArgumentParser:
+    """Get the parser for the command line arguments of a search (see main)."""
+    parser = argparse.ArgumentParser(
+        description='Greppy: A simple grep-like utility',
+        epilog='Run "greppy.py index FILE COLUMN" to build a column index for exact match lookups, '
+        '"greppy.py zonemap PATH..." to build zone maps that let searches skip files that cannot match, '
+        '"greppy.py batch PROGRAM..." to run several programs that search the same input in one pass, and '
+        '"greppy.py serve" to start a server that "greppy_client.py PROGRAM" searches with.')
+    parser.add_argument('config_file', nargs='?',
+                        default='greppy.txt', help='Greppy configuration file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files to search in parallel when the file spec is a directory. '
+                        '0 means one per CPU.')
+    parser.add_argument('--unordered', action='store_true',
+                        help='With --jobs, output results for each file as soon as it is done '
+                        'instead of in directory listing order')
+    parser.add_argument('--chunk-size', type=parse_size, default=None,
+                        help='With --jobs other than 1, split files larger than this many bytes (e.g. 256M) into '
+                        'line-aligned chunks that are searched in parallel.  Needs the awk engine.  Files are '
+                        'searched whole with --limit, --exists, --incremental or --follow, through a column index '
+                        'or --prefilter, or if --jobs 0 finds one CPU, and compressed files and standard input '
+                        'are always searched whole')
+    parser.add_argument('--engine', choices=['awk', 'python', 'check'], default='awk',
+                        help='Filter with gawk (the default), in-process with python, or with both, '
+                        'checking that they agree')
+    parser.add_argument('--fast', action='store_true',
+                        help='Have awk format the results and write them straight to the output file, '
+                        'instead of passing every line through python')
+    parser.add_argument('--no-console', action='store_true',
+                        help='Only write results to the output file, not to the console')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always generate the awk script instead of reusing a cached one')
+    parser.add_argument('--cache-size', type=parse_size, default=CACHE_SIZE,
+                        help='Maximum total size of cached awk scripts (default 16M).  The cache directory '
+                        'is $GREPPY_CACHE_DIR or ~/.cache/greppy')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Report the time spent in each stage and, for each file, the bytes read, records '
+                        'scanned and matched, output bytes and awk CPU time on standard error, as text (the '
+                        'default) or json')
+    parser.add_argument('--no-optimize', action='store_true',
+                        help='Generate the awk match condition exactly as written in the program, instead of '
+                        'reordering and rewriting clauses to be cheaper to evaluate')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Scan the input files even if they have column indexes')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='Find the records that contain the text the program requires (the literal part of a '
+                        '/regex/, or exact match values) with a fast search of the memory-mapped input, and only '
+                        'check those against the whole program')
+    parser.add_argument('--no-zonemap', action='store_true',
+                        help='Search every file in a directory, even if its zone map shows that it cannot match')
+    parser.add_argument('--build-zonemaps', action='store_true',
+                        help='Build zone maps for the files in a directory that have none or have changed '
+                        'since theirs was built, in an extra pass over those files before searching')
+    parser.add_argument('--csv-quoting', action='store_true',
+                        help='Allow fields in double quotes to contain the separator, as the !QUOTED directive does')
+    parser.add_argument('--select', metavar='COLUMNS',
+                        help='Output only these columns, separated by commas (e.g. "ProductId,ProductPrice", or '
+                        '"$1,$3" by number), instead of the !SELECT directive or whole records')
+    parser.add_argument('--limit', type=int, metavar='N',
+                        help='Stop after N matching records.  Files are searched one at a time, and files after '
+                        'the one with the Nth match are not searched')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only search the records added to the input since the last --incremental run, '
+                        'keeping track of how far each file has been searched in a state file')
+    parser.add_argument('--state', metavar='PATH',
+                        help='With --incremental, the state file to use instead of the one next to the output csv '
+                        'file (or the --output file, with the extension .state)')
+    parser.add_argument('--follow', action='store_true',
+                        help='Like --incremental, but keep searching for new records every --interval seconds '
+                        'until interrupted')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='With --follow, the number of seconds to wait between searches (default 1)')
+    parser.add_argument('--distinct', nargs='?', const='', metavar='COLUMNS',
+                        help='Output only the first matching record with each value of these columns, separated by '
+                        'commas, or only the first of identical records if no columns are given (then put '
+                        '--distinct after the program file)')
+    parser.add_argument('--top', type=int, metavar='K',
+                        help='Output only the K matching records with the smallest values in the --by column, '
+                        'smallest first')
+    parser.add_argument('--by', metavar='COLUMN', help='With --top, the column to order records by')
+    parser.add_argument('--desc', action='store_true',
+                        help='With --top, output the records with the largest values, largest first')
+    answer_group = parser.add_mutually_exclusive_group()
+    answer_group.add_argument('--count', action='store_true',
+                              help='Print the number of matching records instead of the records')
+    answer_group.add_argument('--exists', action='store_true',
+                              help='Print nothing, and exit with status 0 if any record matches (at least --limit '
+                              'records, if set) and 1 if not.  The search stops at the first match')
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument('--stdout-only', action='store_true',
+                              help='Only write results to standard output, without the "Results for" lines, '
+                              'the output csv file or the saved awk script')
+    output_group.add_argument('--output', metavar='PATH',
+                              help='Append results to PATH instead of the output csv file next to greppy.py')
+    return parser
+
+
+def check_arguments(args: argparse.Namespace):
+    """
+    Check the command line arguments of a search (see search_parser) for values out of range and options that
+    cannot be combined.
+    args:
+        args: The parsed arguments.
+    raises:
+        ValueError with the message to report if the arguments cannot be used.
+    """
+    if args.jobs < 0:
+        raise ValueError('--jobs must be at least 0')
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        raise ValueError('--chunk-size must be positive')
+    if args.fast and args.engine != 'awk':
+        raise ValueError('--fast only applies to --engine awk')
+    if args.stdout_only and args.no_console:
+        raise ValueError('--stdout-only and --no-console leave nowhere to write results')
+    if args.limit is not None and args.limit <= 0:
+        raise ValueError('--limit must be positive')
+    count_only = args.count or args.exists
+    if count_only and (args.stdout_only or args.output or args.no_console or args.fast):
+        raise ValueError('--count and --exists do not write results, so they cannot be combined with --stdout-only, '
+                         '--output, --no-console or --fast')
+    if count_only and args.engine == 'check':
+        raise ValueError('--engine check compares results, so it cannot be combined with --count or --exists')
+    incremental = args.incremental or args.follow
+    if incremental and (args.limit is not None or args.exists):
+        raise ValueError('--limit and --exists stop before the end of the input, so they cannot be combined with '
+                         '--incremental or --follow')
+    if args.follow and args.count:
+        raise ValueError('--count prints the count at the end, so it cannot be combined with --follow')
+    if args.state and not incremental:
+        raise ValueError('--state only applies to --incremental and --follow')
+    if args.interval <= 0:
+        raise ValueError('--interval must be positive')
+    if (args.top is None) != (args.by is None) or (args.desc and args.top is None):
+        raise ValueError('--top needs --by, and --by and --desc only apply to --top')
+    if args.top is not None and args.top <= 0:
+        raise ValueError('--top must be positive')
+    if (args.distinct is not None or args.top is not None) and (
+            args.fast or args.limit is not None or count_only or incremental):
+        raise ValueError('--distinct and --top cannot be combined with --fast, --limit, --count, --exists, '
+                         '--incremental or --follow')
+    if args.chunk_size is not None and (args.jobs == 1 or args.engine != 'awk'):
+        raise ValueError('--chunk-size splits files between parallel awk processes, so it needs --jobs other than 1 '
+                         'and the awk engine')
+
+
+def check_program_arguments(args: argparse.Namespace, program: GreppyProgram):
+    """
+    Check the command line arguments of a search (see search_parser) against the program's input and directives.
+    args:
+        args: The parsed arguments.
+        program: The parsed program.
+    raises:
+        ValueError with the message to report if the arguments cannot be used with the program.
+    """
+    incremental = args.incremental or args.follow
+    if program.path_type == 'stdin' and args.engine == 'check':
+        raise ValueError('--engine check reads its input twice, so it cannot search standard input')
+    if program.path_type == 'stdin' and incremental:
+        raise ValueError('--incremental and --follow search files, not standard input')
+    if program.group_by or program.aggregates:
+        if args.fast or args.select or program.select or args.limit is not None or args.exists:
+            raise ValueError('!GROUPBY and !AGG output a summary of the matching records, so they cannot be '
+                             'combined with --fast, --select, --limit or --exists')
+        if args.distinct is not None or args.top is not None:
+            raise ValueError('--distinct and --top cannot be combined with !GROUPBY and !AGG')
+
+
+class SearchSettings(NamedTuple):
+    """
+    The settings that the work units of a search are searched with (see search_unit), resolved from the
+    command line arguments and the program.
+        program:             GreppyProgram - the parsed program
+        engine:              string - 'awk', 'python' or 'check' (see --engine)
+        fast:                bool - awk writes the results to the output file itself (see --fast)
+        has_fields:          bool - the input files have header lines
+        has_header:          bool - the results start with a header line
+        stdin_header:        bool - the header line of standard input has been read already, so it is passed on
+                             by python and the script does not expect one
+        header_lines:        list - the header line read from standard input, to pass on ahead of the input
+        output_header_lines: list - header_lines with the selected columns, to pass on ahead of the awk output
+        offsets:             dict - the offsets of the candidate records in each file, from column indexes or
+                             --prefilter, or None to scan the files
+        count_only:          bool - matches are counted instead of output (see --count and --exists)
+        counting:            bool - awk counts the records it reads and matches
+        aggregate:           tuple - (group_by, aggregates) from resolve_aggregates, or None if not aggregating
+        distinct_columns:    list - the output columns that make up the key of a record for --distinct, or None
+    """
+    program: GreppyProgram
+    engine: str = 'awk'
+    fast: bool = False
+    has_fields: bool = True
+    has_header: bool = True
+    stdin_header: bool = False
+    header_lines: Tuple[str, ...] = ()
+    output_header_lines: Tuple[str, ...] = ()
+    offsets: Optional[Dict[str, List[int]]] = None
+    count_only: bool = False
+    counting: bool = False
+    aggregate: Optional[Tuple[List[int], List[Tuple[str, int]]]] = None
+    distinct_columns: Optional[List[int]] = None
+
+
+class SearchOutput:
+    """
+    Where the results of a search are written, and what has been written or collected for them so far.
+        out:             file - the output csv file, opened in binary mode, or a ByteCounter if there is none
+        path:            Path - the name of the output file, or None if there is none
+        console:         bool - results are also written to standard output
+        banners:         bool - the results of each file are preceded by a "Results for" line
+        field_separator: string - the separator used in the csv files
+        multi_file:      bool - the name of the input file is added to the end of each record (see relay_results)
+        header_written:  bool - the header line has been written
+        aggregator:      Aggregator - the aggregates of the records searched in this pass, or None if not aggregating
+        distinct:        Distinct - the records output so far for --distinct, or None
+        top:             TopRecords - the records kept for --top, or None
+    """
+    __slots__ = ('out', 'path', 'console', 'banners', 'field_separator', 'multi_file', 'header_written',
+                 'aggregator', 'distinct', 'top')
+
+    def __init__(self, out: BinaryIO, path: Optional[Path] = None, console: bool = True, banners: bool = False,
+                 field_separator: str = '|', multi_file: bool = False, header_written: bool = False):
+        self.out = out
+        self.path = path
+        self.console = console
+        self.banners = banners
+        self.field_separator = field_separator
+        self.multi_file = multi_file
+        self.header_written = header_written
+        self.aggregator = None
+        self.distinct = None
+        self.top = None
+
+    def size(self) -> int:
+        """Get the number of bytes written to the output so far, for --stats."""
+        self.out.flush()
+        return os.fstat(self.out.fileno()).st_size if self.path is not None else self.out.count
+
+    def flush(self):
+        """Flush the console and the output file."""
+        sys.stdout.flush()
+        self.out.flush()
+
+    def banner(self, file: str):
+        """Print the "Results for" line of a file, unless the results are output together at the end."""
+        if self.banners and self.aggregator is None and self.top is None:
+            print(f"Results for {file}")
+            sys.stdout.flush()
+
+    def relay(self, lines: Iterable[bytes], file: str, unit_header: bool):
+        """Relay the output lines of a work unit (see relay_results), applying --distinct and --top."""
+        if self.distinct is not None:
+            lines = self.distinct.filter(lines, unit_header)
+        if self.top is not None:
+            # The records are output in order at the end
+            self.top.add_records(lines, file, unit_header)
+            return
+        self.header_written = relay_results(lines, self.out, file, self.field_separator, self.multi_file,
+                                            unit_header, self.header_written, self.console)
+
+    def relay_collected(self, file_spec: str, aggregate_header: Optional[str] = None):
+        """
+        Output what has been collected for the whole file spec in a pass - the aggregates, if aggregate_header
+        is given, and the --top records.
+        """
+        if self.aggregator is not None and aggregate_header is not None:
+            if self.banners:
+                print(f"Results for {file_spec}")
+                sys.stdout.flush()
+            relay_results((line.encode() for line in self.aggregator.lines(aggregate_header)), self.out, file_spec,
+                          self.field_separator, False, True, False, self.console)
+            self.flush()
+        if self.top is not None:
+            if self.banners:
+                print(f"Results for {file_spec}")
+                sys.stdout.flush()
+            top = self.top
+            self.header_written = relay_results([top.header] if top.header is not None else [], self.out, file_spec,
+                                                self.field_separator, self.multi_file, True, self.header_written,
+                                                self.console)
+            for record, file in top.records:
+                relay_results([record], self.out, file, self.field_separator, self.multi_file, False, True,
+                              self.console)
+            self.flush()
+
+
+def candidate_offsets(settings: SearchSettings, file: str) -> Optional[List[int]]:
+    """Get the offsets of the header line, if any, and the candidate records in a file, or None to scan it."""
+    if not settings.offsets:
+        return None
+    return [0] + settings.offsets[file] if settings.has_fields else settings.offsets[file]
+
+
+def filter_unit(settings: SearchSettings, lines: Iterable[str], schema: Schema, start: int,
+                predicate: Callable[[str], bool]) -> Iterator[str]:
+    """Filter the lines of a work unit that starts at byte start of a file with the python engine."""
+    program = settings.program
+    return python_filter(lines, predicate, schema.fields, program.field_separator, settings.has_fields, start == 0,
+                         schema.select, schema.header, program.quoted)
+
+
+def search_unit(settings: SearchSettings, output: SearchOutput, file: str, schema: Schema, start: int,
+                end: Optional[int], script_args: List[str], predicate: Optional[Callable[[str], bool]] = None,
+                file_stats: Optional[FileStats] = None, remaining: Optional[int] = None,
+                mismatches: Optional[List[str]] = None):
+    """
+    Search a work unit on its own, with the engine and output mode that the settings select.
+    args:
+        settings: The settings of the search.
+        output: Where the results are written.
+        file: The input file, or STDIN.
+        schema: The Schema of the file.
+        start: The offset of the first byte to search.  Must be the beginning of a line.
+        end: The offset just past the last byte to search, or None to search to the end of the file.
+        script_args: The awk arguments giving the script for the unit (see awk_program_args), or [] for the
+                     python engine.
+        predicate: The python predicate for the schema (see compile_predicate), or None for the awk engine.
+        file_stats: The counters of the file, for --stats, --count and --limit, or None if they aren't needed.
+                    The unit's records and matches are counted in them.
+        remaining: The number of matches still wanted for --limit and --exists, or None if there is no limit.
+        mismatches: With --engine check, the list that differences between the engines are added to.
+    """
+    # The header line is only at the start of a file
+    unit_header = settings.has_header and start == 0
+    stats_name = None
+    if file_stats is not None:
+        file_start, file_cpu = time.perf_counter(), children_cpu_seconds()
+        file_output = output.size()
+        if file == STDIN:
+            file_stats.bytes_read = 0 if settings.engine == 'python' else None
+        elif not settings.offsets:
+            file_stats.bytes_read = (end if end is not None else os.path.getsize(file)) - start
+        if settings.engine != 'python':
+            # awk counts the records it reads and matches
+            stats_name = awk_stats_name()
+    stats_variables = awk_variables(stats=stats_name) if stats_name is not None else []
+    if remaining is not None:
+        stats_variables += awk_variables(limit=remaining)
+    awk_args = [*stats_variables, *script_args]
+    output.banner(file)
+    if settings.engine == 'python':
+        search_unit_python(settings, output, file, schema, start, end, predicate, file_stats, remaining)
+    elif settings.fast:
+        search_unit_fast(settings, output, file, start, end, awk_args)
+    elif settings.aggregate is not None and not settings.count_only:
+        aggregate_unit(settings, output, file, schema, start, end, awk_args, predicate, mismatches)
+    else:
+        search_unit_awk(settings, output, file, schema, start, end, awk_args, predicate, remaining, mismatches)
+    output.flush()
+    if file_stats is not None:
+        if stats_name is not None:
+            file_stats.rows_scanned, file_stats.rows_matched = read_awk_stats(stats_name)
+        elif unit_header and file_stats.rows_matched > 0:
+            # The python engine's output starts with the header line
+            file_stats.rows_matched -= 1
+        if (settings.has_fields and start == 0 and file_stats.rows_scanned > 0
+                and not (stats_name is not None and settings.stdin_header)):
+            # Don't count the header line as a record
+            file_stats.rows_scanned -= 1
+        file_stats.seconds = time.perf_counter() - file_start
+        file_stats.cpu_seconds = children_cpu_seconds() - file_cpu
+        file_stats.output_bytes = output.size() - file_output
+
+
+def search_unit_python(settings: SearchSettings, output: SearchOutput, file: str, schema: Schema, start: int,
+                       end: Optional[int], predicate: Callable[[str], bool], file_stats: Optional[FileStats] = None,
+                       remaining: Optional[int] = None):
+    """
+    Search a work unit with the python engine, or check the candidate records that a column index or --prefilter
+    found in it (see search_unit).
+    """
+    unit_header = settings.has_header and start == 0
+    if settings.offsets:
+        lines = read_lines_at(file, candidate_offsets(settings, file))
+    else:
+        lines = chain(settings.header_lines, read_lines(file, start, end))
+    if file_stats is not None:
+        lines = count_lines(lines, file_stats, 'rows_scanned', bool(settings.offsets) or file == STDIN)
+    lines = filter_unit(settings, lines, schema, start, predicate)
+    if remaining is not None:
+        lines = head_records(lines, remaining, unit_header)
+    if file_stats is not None:
+        lines = count_lines(lines, file_stats, 'rows_matched')
+    if settings.count_only:
+        for _ in lines:
+            pass
+    elif output.aggregator is not None:
+        # The records have the first file's columns, whatever their schema
+        output.aggregator.add_records(lines, unit_header)
+    else:
+        output.relay((line.encode() for line in lines), str(file), unit_header)
+
+
+def search_unit_fast(settings: SearchSettings, output: SearchOutput, file: str, start: int, end: Optional[int],
+                     awk_args: List[str]):
+    """
+    Search a work unit with awk writing the results to the output file itself (--fast).  The console copy, if
+    any, is passed through in blocks.
+    """
+    for line in settings.output_header_lines:
+        output.out.write(line.encode())
+        output.out.flush()
+        if output.console:
+            sys.stdout.buffer.write(line.encode())
+            sys.stdout.flush()
+    variables = awk_variables(out=output.path if output.path is not None else '', console=int(output.console),
+                              header=int(not output.header_written), fname=file)
+    with awk_process([*variables, *awk_args], file, start, end, candidate_offsets(settings, file),
+                     stdout=subprocess.PIPE if output.console else subprocess.DEVNULL) as proc:
+        if output.path is None:
+            # Count the results with the stand-in for the output file as they are copied
+            copy_results(proc.stdout, output.out, False)
+        elif output.console:
+            shutil.copyfileobj(proc.stdout, sys.stdout.buffer, 1024 * 1024)
+        proc.wait()
+    output.header_written = output.header_written or (
+        settings.has_header and start == 0
+        and (not settings.has_fields or settings.stdin_header or os.path.getsize(file) > 0))
+
+
+def aggregate_unit(settings: SearchSettings, output: SearchOutput, file: str, schema: Schema, start: int,
+                   end: Optional[int], awk_args: List[str], predicate: Optional[Callable[[str], bool]] = None,
+                   mismatches: Optional[List[str]] = None):
+    """
+    Search a work unit with awk, which outputs partial aggregates that are merged into the output's aggregator.
+    With --engine check, they are checked against the python engine's.
+    """
+    program = settings.program
+    with awk_process(awk_args, file, start, end, candidate_offsets(settings, file), stdout=subprocess.PIPE) as proc:
+        partials = Aggregator(*settings.aggregate, program.field_separator, program.quoted)
+        for line in proc.stdout:
+            partials.add_partial(line.decode('utf-8'))
+        if settings.engine == 'check':
+            python_aggregates = Aggregator(*settings.aggregate, program.field_separator, program.quoted)
+            python_aggregates.add_records(filter_unit(settings, read_lines(file, start, end), schema, start, predicate),
+                                          settings.has_header and start == 0)
+            header = aggregate_header(program, program.field_separator)
+            if list(partials.lines(header)) != list(python_aggregates.lines(header)):
+                mismatches.append(f"{file}: aggregates differ")
+        output.aggregator.update(partials)
+        proc.wait()
+
+
+def awk_unit_lines(settings: SearchSettings, file: str, schema: Schema, start: int, end: Optional[int],
+                   predicate: Callable[[str], bool], remaining: Optional[int] = None) -> Iterator[str]:
+    """Get the lines that awk outputs for a work unit from the python engine, for --engine check."""
+    program = settings.program
+    unit_header = settings.has_header and start == 0
+    lines = filter_unit(settings, read_lines(file, start, end), schema, start, predicate)
+    if remaining is not None:
+        lines = head_records(lines, remaining, unit_header)
+    if settings.distinct_columns is not None:
+        # awk leaves out the records it has already printed for the file
+        unit_distinct = Distinct(settings.distinct_columns, program.field_separator, program.quoted)
+        lines = (line.decode('utf-8') for line in unit_distinct.filter(
+            (line.encode() for line in lines), unit_header))
+    return lines
+
+
+def search_unit_awk(settings: SearchSettings, output: SearchOutput, file: str, schema: Schema, start: int,
+                    end: Optional[int], awk_args: List[str], predicate: Optional[Callable[[str], bool]] = None,
+                    remaining: Optional[int] = None, mismatches: Optional[List[str]] = None):
+    """
+    Search a work unit with awk, relaying the results or, for --count and --exists, just counting them.
+    With --engine check, the results are checked against the python engine's.
+    """
+    with awk_process(awk_args, file, start, end, candidate_offsets(settings, file), stdout=subprocess.PIPE) as proc:
+        if settings.count_only:
+            # awk only counts the matches
+            proc.stdout.read()
+        else:
+            lines = chain((line.encode() for line in settings.output_header_lines), proc.stdout)
+            if settings.engine == 'check':
+                lines = check_results(lines, awk_unit_lines(settings, file, schema, start, end, predicate, remaining),
+                                      file, mismatches)
+            output.relay(lines, str(file), settings.has_header and start == 0)
+        proc.wait()
+
+
+def search_parallel(settings: SearchSettings, output: SearchOutput, units: Dict[str, List[Tuple[int, Optional[int]]]],
+                    script_args: Callable[[str, int], List[str]], jobs: int, unordered: bool = False,
+                    stats: Optional[RunStats] = None) -> int:
+    """
+    Search work units with up to jobs awk processes at once, each writing to a temporary file.
+    args:
+        settings: The settings of the search.
+        output: Where the results are written.
+        units: The (start, end) byte ranges to search in each file, in order.
+        script_args: Gets the awk arguments giving the script for the unit that starts at a byte of a file.
+        jobs: The number of awk processes to run at once.
+        unordered: If True, relay the results in the order that the files finish, instead of in file order.
+                   The chunks of a split file are always relayed in order, as soon as all of them are done.
+        stats: The statistics of the run, for --stats, or None.
+    returns:
+        The number of matching records if settings.counting is set, otherwise 0.
+    """
+    matched_total = 0
+
+    def run_unit(*unit) -> Tuple[str, float]:
+        """Run awk on a work unit (see run_awk_to_file), timing it for --stats."""
+        unit_start = time.perf_counter()
+        return run_awk_to_file(*unit), time.perf_counter() - unit_start
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        stats_names = {}
+        for file, ranges in units.items():
+            variables = awk_variables(console=1, header=1, fname=file) if settings.fast else []
+            for start, end in ranges:
+                stats_name = awk_stats_name() if settings.counting else None
+                stats_variables = awk_variables(stats=stats_name) if stats_name is not None else []
+                future = executor.submit(run_unit, script_args(file, start), file, start, end,
+                                         [*variables, *stats_variables])
+                futures[future] = file
+                stats_names[future] = stats_name
+        file_futures = {file: [] for file in units}
+        for future, file in futures.items():
+            file_futures[file].append(future)
+        completed = files_as_completed(file_futures) if unordered else file_futures
+        for file in completed:
+            results = [future.result() for future in file_futures[file]]
+            result_names = [result_name for result_name, _ in results]
+            relay_start = time.perf_counter()
+            file_output = output.size() if stats is not None else 0
+            try:
+                output.banner(file)
+                for chunk, result_name in enumerate(result_names if not settings.count_only else []):
+                    chunk_header = settings.has_header and units[file][chunk][0] == 0
+                    with open(result_name, 'rb') as result:
+                        if output.aggregator is not None:
+                            for line in result:
+                                output.aggregator.add_partial(line.decode('utf-8'))
+                        elif settings.fast:
+                            # awk has already formatted the results
+                            copied = copy_results(result, output.out, chunk_header and output.header_written,
+                                                  output.console)
+                            output.header_written = output.header_written or (chunk_header and copied)
+                        else:
+                            output.relay(result, str(file), chunk_header)
+            finally:
+                for result_name in result_names:
+                    os.remove(result_name)
+            output.flush()
+            file_stats = stats.file(file) if stats is not None else FileStats(file)
+            for (start, end), future in zip(units[file], file_futures[file]):
+                if stats_names[future] is None:
+                    continue
+                records, matched = read_awk_stats(stats_names[future])
+                file_stats.rows_scanned += records - (1 if start == 0 and settings.has_fields and records else 0)
+                file_stats.rows_matched += matched
+            matched_total += file_stats.rows_matched
+            if stats is not None:
+                # CPU time can't be told apart for files searched at once
+                file_stats.bytes_read = sum((end if end is not None else os.path.getsize(file)) - start
+                                            for start, end in units[file])
+                file_stats.seconds = sum(seconds for _, seconds in results) + time.perf_counter() - relay_start
+                file_stats.output_bytes = output.size() - file_output
+    return matched_total
+
+
+def main():
+    """Main function."""
+    if sys.argv[1:2] == ['index']:
+        return index_main(sys.argv[2:])
+    if sys.argv[1:2] == ['batch']:
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ['zonemap']:
+        return zonemap_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+    # Parse command line arguments.  Expecting a single argument, the greppy match rules file, defaulting to greppy.txt
+    parser = search_parser()
+    args = parser.parse_args()
+    try:
+        check_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    count_only = args.count or args.exists
+    incremental = args.incremental or args.follow
+    console = not args.no_console
+    jobs = args.jobs or os.cpu_count() or 1
+    stats = RunStats() if args.stats else None
+    cpu_start = children_cpu_seconds()
+
+    def stage(name: str):
+        """Time a stage of the run for --stats."""
+        return stats.stage(name) if stats is not None else nullcontext()
+
+    # Read the program once.  Everything after this works from the parsed program.
+    with stage('parse_program'):
+        program = read_program(args.config_file)
+    if args.csv_quoting:
+        program.quoted = True
+    try:
+        if program.quoted:
+            check_quoted_separator(program.field_separator)
+        check_program_arguments(args, program)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Get the file spec from the program and determine if it is a file, a directory or standard input
+    path_type, file_spec = program.path_type, program.file_spec
+
+    # Process directives - !FIELDS, !SEPARATOR and !NOHEADER
+    field_separator, fields, noheader = program.field_separator, dict(program.fields), program.noheader
+
+    # Get the fields from the first line of the file_spec or the first csv file in the directory
+    # if column names are not provided in directive and noheader is False.
+    # has_fields means input files have headers
+    has_fields = len(fields) == 0 and not noheader
+    header_line = ''
+    if has_fields:
+        with stage('read_header'):
+            header_line = read_header_line(file_spec, path_type)
+            fields = fields_from_header(header_line, field_separator, program.quoted)
+    # The header of standard input has been read already, so it is passed on by python
+    # and the rest of the input is searched by a script that does not expect a header.
+    stdin_header = has_fields and path_type == 'stdin'
+
+    # Resolve the columns to output from --select or !SELECT, if any
+    select_names = [name.strip() for name in args.select.split(',')] if args.select else program.select
+    try:
+        select = select_columns(select_names, fields) or None
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Resolve the columns used by !GROUPBY and !AGG, if any.  When aggregating, the matching records are
+    # summarized by an Aggregator instead of being output.
+    aggregate = None
+    if program.group_by or program.aggregates:
+        try:
+            aggregate = resolve_aggregates(program, fields)
+        except ValueError as e:
+            parser.error(str(e))
+    aggregating = aggregate is not None and not args.count
+
+    # Resolve the output columns used by --distinct and --top, if any
+    distinct_columns, top_column = None, None
+    try:
+        if args.distinct is not None:
+            distinct_columns = [output_column(name.strip(), fields, select)
+                                for name in args.distinct.split(',') if name.strip()]
+        if args.top is not None:
+            top_column = output_column(args.by.strip(), fields, select)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # The columns of the first file.  Files in a directory with other columns get their own Schema
+    # (see discover_schemas), with the program's field names resolved against their own headers.
+    primary = Schema(header_line, fields, select, aggregate=aggregate)
+    predicates = {}
+
+    def get_predicate(schema: Schema) -> Callable[[str], bool]:
+        """Compile the python predicate for files with the schema's columns, the first time it is needed."""
+        if schema not in predicates:
+            with stage('compile_predicate'):
+                predicates[schema] = compile_predicate(program, schema.fields, field_separator)
+        return predicates[schema]
+
+    if args.engine != 'awk':
+        try:
+            get_predicate(primary)
+        except ValueError as e:
+            parser.error(str(e))
+
+    output_name = get_output_name(file_spec, args.config_file)
+
+    # Generate a list of files to process.  If the file_spec is a file, just process that file.
+    # If it is a directory, add all files in the directory to the list.
+    file_list = get_input_files(file_spec, path_type)
+    # Files can be added to the directory between incremental searches, so their results always have
+    # the file name column, to keep the output the same shape.
+    multi_file = len(file_list) > 1 or (incremental and path_type == 'dir')
+
+    def get_schemas(file_list: List[str]) -> Dict[str, Schema]:
+        """Get the Schema of each input file in a directory, reading their header lines."""
+        if not has_fields or path_type != 'dir' or len(file_list) < 2:
+            return {}
+        with stage('discover_schemas'):
+            return discover_schemas(program, file_list, primary, field_separator, select_names, jobs)
+    file_schemas, schemas_list = get_schemas(file_list), file_list
+
+    # Skip the files in a directory whose zone maps (see build_zonemap) show that none of their records can
+    # match.  The first file is searched anyway if they all can be skipped, to output the header.
+    if path_type == 'dir' and not incremental and not args.no_zonemap:
+        if args.build_zonemaps:
+            with stage('build_zonemaps'):
+                stale = [file for file in file_list
+                         if read_zonemap(file, field_separator, has_fields, program.quoted) is None]
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    list(executor.map(lambda file: build_zonemap(file, field_separator, has_fields, program.quoted),
+                                      stale))
+        with stage('zonemap'):
+            kept = [file for file in file_list
+                    if zonemap_may_match(program, file_schemas.get(file, primary).fields, file, has_fields)]
+        if stats is not None:
+            stats.files_skipped = len(file_list) - len(kept)
+        file_list = kept or file_list[:1]
+
+    # Look up candidate records in column indexes (see build_index) instead of scanning, if every input
+    # file has an index that can be used for the program.  The engine checks the candidates against the
+    # whole program, as it checks every record in a scan.
+    # Indexes split records without regard to quotes, so they are not used for !QUOTED programs.
+    offsets = {}
+    if not args.no_index and args.engine != 'check' and not incremental and not program.quoted:
+        with stage('index_lookup'):
+            offsets = {file: index_offsets(program, file_schemas.get(file, primary).fields, file, has_fields)
+                       for file in file_list}
+        if None in offsets.values():
+            offsets = {}
+    # Otherwise, with --prefilter, the candidates are the records that contain the text the program requires
+    # (see prefilter_offsets).
+    if args.prefilter and not offsets and args.engine != 'check' and not incremental:
+        with stage('prefilter'):
+            offsets = {file: prefilter_offsets(program, file, has_fields) for file in file_list}
+        if None in offsets.values():
+            offsets = {}
+
+    # Matches are counted by awk if they are reported or needed to stop at --limit.
+    # remaining is the number of matches still wanted, or None if there is no limit.
+    counting = stats is not None or count_only or args.limit is not None
+    remaining = args.limit if args.limit is not None else 1 if args.exists else None
+    matched_total = 0
+
+    # Options that change the generated awk script, other than the program and input header
+    script_options = ScriptOptions(fast=args.fast, multi_file=multi_file, stats=counting, limit=remaining is not None,
+                                   count_only=count_only, quoted=program.quoted)
+
+    def get_script(schema: Schema, emit_header: bool = True) -> str:
+        """Generate the awk script for files with the schema's columns, or get it from the cache."""
+        options = script_options._replace(emit_header=emit_header, select=schema.select,
+                                          aggregate=schema.aggregate, header=schema.header)
+        if distinct_columns is not None:
+            # The key columns, numbered in the schema's input instead of the output
+            options = options._replace(distinct=[schema.select[number - 1] if schema.select else number
+                                                 for number in distinct_columns])
+
+        def generate() -> str:
+            if args.no_optimize:
+                match, begin, prelude = parse_rules(program, schema.fields), '', ''
+            else:
+                match, begin, prelude = optimize_rules(program, schema.fields)
+            return generate_awk_script(match, schema.fields, field_separator, has_fields, options,
+                                       begin=begin, prelude=prelude)
+        if args.no_cache:
+            return generate()
+        key = script_cache_key(program, schema.header_line, options, has_fields=has_fields,
+                               optimize=not args.no_optimize)
+        return get_cached_script(key, generate, max_size=args.cache_size)
+
+    def get_script_args(schema: Schema, emit_header: bool, name: str) -> List[str]:
+        """
+        Get the awk arguments that pass it the script.  The script is saved as name, unless --stdout-only is
+        set and it is short enough to pass on the awk command line.
+        """
+        with stage('generate_script'):
+            script = get_script(schema, emit_header)
+        if stats is not None:
+            stats.script_bytes = max(stats.script_bytes, len(script))
+        if args.stdout_only and len(script) <= INLINE_SCRIPT_SIZE:
+            return awk_program_args(script)
+        save_script(name, script)
+        return awk_program_args(script, name)
+
+    # The awk arguments for each script, keyed by schema and whether the script is for units that start
+    # after the beginning of a file, and the names the scripts are saved under
+    scripts = {}
+    script_names = {primary: output_name}
+
+    def schema_script_args(schema: Schema, body: bool = False) -> List[str]:
+        """Get the awk arguments giving the script for files with the schema's columns."""
+        key = (schema, body)
+        if key not in scripts:
+            name = script_names.setdefault(schema, f'{output_name}_{len(script_names)}')
+            if body:
+                # Chunks after the first one in a file, and the bytes added to a file since the last
+                # --incremental run, start in the middle of the file, so they need a script that does
+                # not treat their first line as the header.
+                scripts[key] = get_script_args(schema, False, name + '_body.awk')
+            else:
+                scripts[key] = get_script_args(schema, not stdin_header, name + '.awk')
+        return scripts[key]
+
+    def unit_script_args(file: str, start: int) -> List[str]:
+        """Get the awk arguments giving the script for a work unit that starts at byte start of file."""
+        return schema_script_args(file_schemas.get(file, primary), start > 0)
+
+    # Generate and save the awk script
+    if args.engine != 'python':
+        schema_script_args(primary)
+
+    # Execute the awk script on each file, printing the file name, then the results.
+    # Also pipe the results to a file with the same name as the file_spec with a .csv extension,
+    # or to the --output file.  With --stdout-only, the results only go to the console.
+    # The awk output starts with a header line if the input files have one or if !FIELDS provides one.
+    has_header = len(fields) > 0
+    header_written = False
+    mismatches = []
+    if incremental:
+        # The state of incremental searches is kept next to the output csv file by default
+        if args.state:
+            state_path = Path(args.state)
+        elif args.output:
+            state_path = Path(args.output).with_suffix('.state')
+        else:
+            state_path = Path(__file__).with_name(output_name + '.state')
+        # The state is saved after the results have been written (see save_state), so check that it can be
+        # before searching
+        try:
+            fd, probe_name = tempfile.mkstemp(prefix='greppy_', suffix='.state',
+                                              dir=os.path.dirname(os.path.abspath(state_path)))
+            os.close(fd)
+            os.remove(probe_name)
+        except OSError as e:
+            parser.error(f"cannot write the state file {state_path} ({e.strerror}), use --state to choose another one")
+        state = load_state(state_path)
+        header_written = state['header_written']
+    banners = console and not args.stdout_only and not count_only
+    if args.stdout_only or count_only:
+        p = None
+    elif args.output:
+        p = Path(args.output)
+    else:
+        p = Path(__file__).with_name(output_name + '.csv')
+    # The header line read from standard input, to pass on ahead of the search results
+    header_lines = [header_line + '\n'] if stdin_header and header_line else []
+    # The header line passed on by python has the selected columns, like the script output
+    output_header_lines = [project_line(header_line, select, field_separator,
+                                        get_splitter(field_separator, program.quoted)) + '\n'] \
+        if select and header_lines else header_lines
+    settings = SearchSettings(program, args.engine, args.fast, has_fields, has_header, stdin_header,
+                              tuple(header_lines), tuple(output_header_lines), offsets, count_only, counting,
+                              aggregate if aggregating else None, distinct_columns)
+    with (p.open('ab') if p is not None else nullcontext(ByteCounter())) as out:
+        output = SearchOutput(out, p, console, banners, field_separator, multi_file, header_written)
+
+        # Search the input.  --follow searches it again every --interval seconds, for the records added since.
+        search_start = time.perf_counter()
+        try:
+            while True:
+                if incremental:
+                    # Only search the bytes added to each file since the last run (see plan_increment)
+                    file_list = get_input_files(file_spec, path_type)
+                    increment, entries = plan_increment(file_list, state['files'])
+                    if file_list != schemas_list:
+                        # Files have been added to or removed from the directory
+                        file_schemas, schemas_list = get_schemas(file_list), file_list
+
+                # The python engine runs in-process, so it searches the files one at a time.
+                # So does --limit, so that it can stop once it has enough matches.
+                sequential = jobs == 1 or args.engine != 'awk' or bool(offsets) or remaining is not None
+
+                # Split the input files into work units - (file, start, end) byte ranges.
+                # Files are only split if --chunk-size is set and they are larger than the chunk size.
+                # Standard input and compressed files can only be read from start to end, so they are never split.
+                units = {}
+                for file in file_list:
+                    if incremental:
+                        if file in increment:
+                            units[file] = [increment[file]]
+                    elif (not sequential and args.chunk_size is not None and path_type != 'stdin'
+                            and get_compression(file) is None):
+                        ranges = split_file(file, args.chunk_size)
+                        units[file] = ranges if len(ranges) > 1 else [(0, None)]
+                    else:
+                        units[file] = [(0, None)]
+                # The aggregates of the records searched in this pass, and the records output so far for
+                # --distinct and --top
+                output.aggregator = Aggregator(*aggregate, field_separator, program.quoted) if aggregating else None
+                output.distinct = Distinct(distinct_columns, field_separator, program.quoted) \
+                    if distinct_columns is not None else None
+                output.top = TopRecords(args.top, top_column, args.desc, field_separator, program.quoted) \
+                    if top_column is not None else None
+
+                if sequential or sum(len(ranges) for ranges in units.values()) <= 1:
+                    for file, [(start, end)] in units.items():
+                        if remaining is not None and remaining <= 0:
+                            break
+                        schema = file_schemas.get(file, primary)
+                        if stats is not None:
+                            file_stats = stats.file(file)
+                        else:
+                            # Count matches for --count or --limit, without reporting them
+                            file_stats = FileStats(file) if counting else None
+                        search_unit(settings, output, file, schema, start, end,
+                                    unit_script_args(file, start) if args.engine != 'python' else [],
+                                    get_predicate(schema) if args.engine != 'awk' else None,
+                                    file_stats, remaining, mismatches)
+                        if file_stats is not None:
+                            matched_total += file_stats.rows_matched
+                            if remaining is not None:
+                                remaining -= file_stats.rows_matched
+                else:
+                    matched_total += search_parallel(settings, output, units, unit_script_args, jobs,
+                                                     args.unordered, stats)
+                # Aggregates and --top records are output together at the end of a pass, for the whole file spec
+                output.relay_collected(file_spec, aggregate_header(program, field_separator)
+                                       if aggregating and (units or not incremental) else None)
+                if incremental:
+                    state['files'] = entries
+                    state['header_written'] = output.header_written
+                    save_state(state_path, state)
+                if not args.follow:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            # --follow runs until it is interrupted
+            if not args.follow:
+                raise
+        except ValueError as e:
+            # An input file could not be read to the end, like a truncated compressed file
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+
+    if args.count:
+        print(matched_total)
+        sys.stdout.flush()
+    if stats is not None:
+        stats.stages['search'] = time.perf_counter() - search_start
+        stats.cpu_seconds = children_cpu_seconds() - cpu_start
+        print(stats.format(args.stats), file=sys.stderr)
+
+    for mismatch in mismatches:
+        print(f"Engines disagree: {mismatch}", file=sys.stderr)
+    if mismatches:
+        return 1
+    if args.exists:
+        return 0 if remaining <= 0 else 1
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Greppy client.
+
+Sends a greppy program to a server started with "python3 greppy.py serve" and prints the results as they
+arrive, the way "python3 greppy.py PROGRAM --stdout-only" does.  For example,
+
+    python3 runner/greppy_client.py greppy.txt
+
+The client only uses the standard library and doesn't load greppy.py, so a search costs little more than
+starting python.
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+from typing import List, Optional
+
+
+def get_socket_name() -> str:
+    """Get the default server socket - greppy.sock in greppy's cache directory, as greppy.get_socket_name does."""
+    if os.environ.get('GREPPY_CACHE_DIR'):
+        cache_dir = os.environ['GREPPY_CACHE_DIR']
+    else:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'greppy')
+    return os.path.join(cache_dir, 'greppy.sock')
+
+
+def connect(socket_name: Optional[str] = None, port: Optional[int] = None) -> socket.socket:
+    """Connect to the server on a localhost TCP port if one is given, otherwise on its Unix socket."""
+    if port is not None:
+        return socket.create_connection(('127.0.0.1', port))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_name or get_socket_name())
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def read_status(line: bytes) -> dict:
+    """Read a status line from the server - {"ok": true} or {"error": message}."""
+    try:
+        status = json.loads(line)
+    except ValueError:
+        status = None
+    if not isinstance(status, dict) or not ('ok' in status or 'error' in status):
+        # The server stopped before sending it, so the results are incomplete
+        return {'error': 'The server closed the connection before the search finished'}
+    return status
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Main function."""
+    parser = argparse.ArgumentParser(description='Search with a greppy server started by "greppy.py serve"')
+    parser.add_argument('config_file', nargs='?', default='greppy.txt', help='Greppy configuration file')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='The Unix socket the server listens on (default greppy.sock in the cache directory)')
+    parser.add_argument('--port', type=int, help='The localhost TCP port the server listens on')
+    parser.add_argument('--count', action='store_true',
+                        help='Print the number of matching records instead of the records')
+    args = parser.parse_args(argv)
+    with open(args.config_file, 'r', encoding='utf-8') as f:
+        request = {'program': f.read(), 'cwd': os.getcwd(), 'count': args.count}
+    try:
+        connection = connect(args.socket, args.port)
+    except OSError as e:
+        parser.error(f"Cannot connect to the greppy server ({e}).  Start one with \"greppy.py serve\".")
+    with connection, connection.makefile('rb') as response:
+        connection.sendall(json.dumps(request).encode() + b'\n')
+        status = read_status(response.readline())
+        if 'error' in status:
+            print(f"Error: {status['error']}", file=sys.stderr)
+            return 1
+        # The last line is the status of the search, so hold it back until the end
+        last_line = b''
+        for block in iter(lambda: response.read1(io.DEFAULT_BUFFER_SIZE), b''):
+            block = last_line + block
+            end = block.rfind(b'\n', 0, len(block) - 1) + 1
+            sys.stdout.buffer.write(block[:end])
+            sys.stdout.flush()
+            last_line = block[end:]
+        status = read_status(last_line)
+        if 'error' in status:
+            print(f"Error: {status['error']}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
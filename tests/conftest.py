@@ -2,4 +2,11 @@
 pytest configuration file
 """
 import sys
+import pytest
 sys.path.append("../")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path_factory, monkeypatch):
+    """Keep the awk scripts and header lines that greppy caches out of the user's cache, one directory per test."""
+    monkeypatch.setenv('GREPPY_CACHE_DIR', str(tmp_path_factory.mktemp('cache')))
@@ -1,6 +1,21 @@
 """Tests for greppy.py"""
+import io
+import json
+import os
+import shutil
+import subprocess
 import sys
-from runner.greppy import get_file_spec, get_fields, parse_rules, generate_awk_script, main
+import threading
+import pytest
+from runner.greppy import get_file_spec, get_fields, parse_rules, generate_awk_script, main, split_file, \
+    compile_predicate, compile_awk_condition, read_program, parse_program, Clause, read_header_line, \
+    script_cache_key, ScriptOptions, get_cached_script, evict_cache, compile_program, get_compression, read_lines, \
+    build_index, index_offsets, read_lines_at, RunStats, optimize_rules, generate_batch_script, \
+    get_output_name, select_columns, plan_increment, Aggregator, awk_aggregate, read_headers, \
+    build_zonemap, zonemap_may_match, regex_literal, program_literals, prefilter_offsets, TCPSearchServer, \
+    UnixSearchServer, Distinct, TopRecords, awk_regex, decompress_process, search_parser, check_arguments, \
+    check_program_arguments, Schema, FileStats, fields_from_header, SearchSettings, SearchOutput, search_unit
+from runner import greppy_client
 
 
 def test_get_file_spec():
@@ -234,3 +249,898 @@ def test_awk_add_fields(capsys):
     assert captured[0] == 'Results for test_files/awk/test-awk.csv'
     assert captured[1] == 'ProductId | price | quantity | gross profit'
     assert captured[2] == '1174 | 12 | 10 | 99'
+
+
+def test_main_jobs(capsys):
+    """Test --jobs gives the same output as a sequential run."""
+    sys.argv = ['./greppy.py', './test_multi_file.txt']
+    main()
+    sequential = capsys.readouterr().out
+    sys.argv = ['./greppy.py', './test_multi_file.txt', '--jobs', '2']
+    main()
+    captured = capsys.readouterr().out
+    assert captured == sequential
+    assert captured.count('file name') == 1
+
+
+def test_split_file():
+    """Test split_file aligns chunks to line boundaries."""
+    with open('./test_files/test.csv', 'rb') as f:
+        data = f.read()
+    ranges = split_file('./test_files/test.csv', 50)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert data[start - 1:start] == b'\n'
+
+
+def test_main_chunk_size(capsys):
+    """Test that splitting a file into chunks gives the same output as a single scan."""
+    sys.argv = ['./greppy.py', './test_and.txt']
+    main()
+    single = capsys.readouterr().out
+    sys.argv = ['./greppy.py', './test_and.txt', '--jobs', '3', '--chunk-size', '50']
+    main()
+    captured = capsys.readouterr().out
+    assert captured == single
+    assert captured.count('ProductId') == 1
+    # Without parallel awk processes there is nothing to split the files between
+    for options in [[], ['--jobs', '1'], ['--jobs', '3', '--engine', 'python']]:
+        sys.argv = ['./greppy.py', './test_and.txt', '--chunk-size', '50', *options]
+        with pytest.raises(SystemExit):
+            main()
+        assert '--chunk-size splits files between parallel awk processes' in capsys.readouterr().err
+
+
+def test_compile_predicate_value_range():
+    """Test the python engine follows awk comparison rules - empty prices compare as strings."""
+    fields = get_fields('./test_files/test.csv', 'file', '|')
+    predicate = compile_predicate('./test_value_range.txt', fields)
+    assert predicate('1122 | 3.00 | plain crumpets | grocery')
+    assert not predicate('1121 | 7.50 | fancy crumpets | grocery')
+    assert not predicate('1128 || "peanut butter dog treats" | pets')
+
+
+def test_compile_awk_condition():
+    """Test awk match conditions in the python engine."""
+    condition = compile_awk_condition('$4 < $2 * $3 && $1 !~ /^11/')
+    assert condition(['2174 ', ' 12 ', ' 10 ', ' 99'], '')
+    assert not condition(['1174 ', ' 12 ', ' 10 ', ' 99'], '')
+    assert not condition(['2174 ', ' 9 ', ' 2 ', ' 20'], '')
+    assert compile_awk_condition('$2 == "12"')(['1', '12'], '')
+    assert not compile_awk_condition('$2 == "12"')(['1', ' 12'], '')
+
+
+def test_main_python_engine(capsys):
+    """Test the python engine on AND search with negation."""
+    sys.argv = ['./greppy.py', './test_and.txt', '--engine', 'python']
+    main()
+    captured = capsys.readouterr().out.split('\n')
+    assert captured[0] == 'Results for test_files/test.csv'
+    assert captured[1] == 'ProductId | ProductPrice | ProductDescription | ProductCategory'
+    assert captured[2] == '1126 | 1.00 | plain peanut butter | grocery'
+    assert captured[3] == '1128 || "peanut butter dog treats" | pets'
+    assert captured[4] == '1129 | 3.00 | peanuts ||'
+    assert len(captured) == 6
+
+
+def test_main_python_engine_awk_clause(capsys):
+    """Test the python engine on the awk example from README."""
+    sys.argv = ['./greppy.py', './test_awk_add_fields.txt', '--engine', 'python']
+    main()
+    captured = capsys.readouterr().out.split('\n')
+    assert captured[1] == 'ProductId | price | quantity | gross profit'
+    assert captured[2] == '1174 | 12 | 10 | 99'
+    assert len(captured) == 4
+
+
+def test_main_check_engine(capsys):
+    """Test that the awk and python engines agree."""
+    sys.argv = ['./greppy.py', './test_multi_file.txt', '--engine', 'check']
+    assert main() == 0
+    assert 'disagree' not in capsys.readouterr().err
+
+
+def test_main_dot_value(tmp_path, capsys):
+    """Test a '.' in an exact match value matches any character with every engine, the way awk matches it."""
+    data = tmp_path / 'prices.csv'
+    data.write_text('ProductId | ProductPrice\n1 | 1.00\n2 | 1000\n3 | 1.50\n4 | "1x00"\n')
+    config = tmp_path / 'test_dot.txt'
+    config.write_text(f'{data}\nProductPrice | 1.00\n')
+    predicate = compile_predicate(str(config), get_fields(str(data), 'file', '|'))
+    assert [predicate(record) for record in ['1 | 1.00', '2 | 1000', '3 | 1.50', '4 | "1x00"']] == \
+        [True, True, False, True]
+    for engine in ['awk', 'python', 'check']:
+        sys.argv = ['./greppy.py', str(config), '--stdout-only', '--engine', engine]
+        assert main() == 0
+        captured = capsys.readouterr()
+        assert captured.out.splitlines()[-3:] == ['1 | 1.00', '2 | 1000', '4 | "1x00"']
+        assert 'disagree' not in captured.err
+
+
+
+def test_awk_regex():
+    """Test gawk regular expressions are translated to python ones that match the same text."""
+    assert awk_regex('[[:digit:]]x').search('1|abc5x')
+    assert not awk_regex('[[:alpha:][:space:]]x').search('5x')
+    assert awk_regex('[^]a]').search(']b')
+    assert not awk_regex('[^]a]').search(']a')
+    assert awk_regex('[a-]').search('-')
+    assert [bool(awk_regex(r'\<abc').search(text)) for text in ['1|abc', 'foo abc', 'xabc']] == [True, True, False]
+    assert [bool(awk_regex(r'abc\>').search(text)) for text in ['abc|1', 'abcd']] == [True, False]
+    assert [bool(awk_regex(r'\yabc\y').search(text)) for text in ['1|abc', 'zabc', 'abcz']] == [True, False, False]
+    assert [bool(awk_regex(r'a\Bb').search(text)) for text in ['ab', 'a b']] == [True, False]
+    assert awk_regex(r'\s\w+\/').search(' a1/')
+    assert awk_regex('x{').search('x{')
+    assert awk_regex('a*+b').search('aab')
+    for pattern in ['(?i)abc', '[[:letter:]]', '[abc', 'a\\']:
+        with pytest.raises(ValueError):
+            awk_regex(pattern)
+
+
+def test_main_gawk_regex(tmp_path, capsys):
+    """Test the python engine matches gawk regular expressions the way awk does, and rejects what it can't match."""
+    data = tmp_path / 'descriptions.csv'
+    data.write_text('Id|Desc\n1|abc5x\n2|xabc\n3|foo abc\n')
+    config = tmp_path / 'test_regex.txt'
+    for regex, ids in [('/[[:digit:]]x/', ['1']), ('/\\<abc/', ['1', '3']), ('/\\yabc/', ['1', '3'])]:
+        config.write_text(f'{data}\nDesc | {regex}\n')
+        for engine in ['awk', 'python', 'check']:
+            sys.argv = ['./greppy.py', str(config), '--stdout-only', '--engine', engine]
+            assert main() == 0
+            captured = capsys.readouterr()
+            assert [line.split('|')[0] for line in captured.out.splitlines()[1:]] == ids
+            assert 'disagree' not in captured.err
+    config.write_text(f'{data}\nDesc | /(?i)ABC/\n')
+    sys.argv = ['./greppy.py', str(config), '--stdout-only', '--engine', 'python']
+    with pytest.raises(SystemExit):
+        main()
+    assert 'Unsupported regular expression for the python engine: /(?i)ABC/' in capsys.readouterr().err
+
+
+def test_generate_awk_script_fast():
+    """Test generate_awk_script formats output in awk with fast."""
+    fields = get_fields('./test_files/test.csv', 'file', '|')
+    match = parse_rules('./test_pwd.txt', fields)
+    script_lines = generate_awk_script(match, fields, options=ScriptOptions(fast=True, multi_file=True)).split('\n')
+    assert script_lines[1] == 'NR == 1 { if (header) emit(trim($0) " | file name") }'
+    assert script_lines[2] == 'NR > 1 && $0 ~ /crumpet/  { emit(trim($0) "| " fname) }'
+    assert script_lines[3].startswith('function trim(s)')
+
+
+def test_main_fast(capsys):
+    """Test --fast gives the same output as the python relay."""
+    sys.argv = ['./greppy.py', './test_multi_file.txt']
+    main()
+    relayed = capsys.readouterr().out
+    sys.argv = ['./greppy.py', './test_multi_file.txt', '--fast']
+    main()
+    assert capsys.readouterr().out == relayed
+
+
+def test_generate_awk_script_limit():
+    """Test generate_awk_script stops at the limit and counts without printing."""
+    fields = get_fields('./test_files/test.csv', 'file', '|')
+    match = parse_rules('./test_pwd.txt', fields)
+    script_lines = generate_awk_script(match, fields, options=ScriptOptions(limit=True)).split('\n')
+    assert script_lines[2] == 'NR > 1 && $0 ~ /crumpet/  { matched++; print $0; if (matched >= limit) exit }'
+    script_lines = generate_awk_script(match, fields, options=ScriptOptions(stats=True, count_only=True)).split('\n')
+    assert script_lines[1] == 'NR == 1 { }'
+    assert script_lines[2] == 'NR > 1 && $0 ~ /crumpet/  { matched++ }'
+
+
+def test_generate_awk_script_select():
+    """Test generate_awk_script prints only the selected columns."""
+    fields = get_fields('./test_files/test.csv', 'file', '|')
+    program = read_program('./test_select.txt')
+    assert program.select == ['ProductDescription', 'ProductId']
+    select = select_columns(program.select, fields)
+    assert select == [3, 1]
+    script_lines = generate_awk_script(parse_rules(program, fields), fields,
+                                       options=ScriptOptions(select=select)).split('\n')
+    assert script_lines[1] == 'NR == 1 { print $3 "|" $1 }'
+    assert script_lines[2] == 'NR > 1 && $4 ~ /^[ ]*"?pets"?[ ]*$/  { print $3 "|" $1 }'
+    fields = read_program('./test_in_prices_no_header.txt').fields
+    script_lines = generate_awk_script('$2 > 5', fields, has_fields=False,
+                                       options=ScriptOptions(select=[4, 1])).split('\n')
+    assert script_lines[0] == 'BEGIN { FS="|"; print "ProductCategory|ProductId" }'
+
+
+def test_main_select(capsys):
+    """Test !SELECT and --select give the same columns with each engine."""
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--engine', 'check']]:
+        sys.argv = ['./greppy.py', './test_select.txt', '--stdout-only', *options]
+        assert main() == 0
+        assert capsys.readouterr().out.splitlines() == [
+            'ProductDescription |ProductId', 'Salty jerky treads |1124', '"peanut butter dog treats" |1128']
+    sys.argv = ['./greppy.py', './test_select.txt', '--stdout-only', '--select', '$4,ProductPrice']
+    main()
+    assert capsys.readouterr().out.splitlines() == ['ProductCategory| ProductPrice', 'pets| 2.00', 'pets|']
+    products = compile_program('!SELECT [ProductId, $4]\nProductCategory | pets', file_spec='')
+    assert list(products.filter('./test_files/test.csv')) == ['1124| pets', '1128 | pets']
+
+
+def test_aggregator():
+    """Test merging aggregates from records and from the partial aggregates output by awk."""
+    accumulate, end = awk_aggregate([4], [('count', 0), ('sum', 2), ('min', 2), ('avg', 2)])
+    assert accumulate.startswith('_k = _norm($4); _count[_k]++')
+    assert end.startswith('END { for (_k in _count) printf')
+    records = Aggregator([4], [('count', 0), ('sum', 2), ('min', 2), ('avg', 2)])
+    records.add_records(['a|b|c\n', '1| 2.5 |x| dogs\n', '2|1|y|"cats"\n', '3|4|z|dogs\n'])
+    partials = Aggregator([4], [('count', 0), ('sum', 2), ('min', 2), ('avg', 2)])
+    partials.add_partial('dogs\x1c2\x1c2\x1c6.5\x1c2.5\x1c6.5\n')
+    partials.add_partial('cats\x1c1\x1c1\x1c1\x1c1\x1c1\n')
+    assert list(records.lines('h')) == list(partials.lines('h')) == ['h\n', 'cats|1|1|1|1\n', 'dogs|2|6.5|2.5|3.25\n']
+    partials.update(records)
+    assert list(partials.lines('h'))[2] == 'dogs|4|13|2.5|3.25\n'
+
+
+def test_main_groupby(capsys):
+    """Test !GROUPBY and !AGG give the same aggregates with each engine and with --jobs."""
+    for options in [[], ['--engine', 'python'], ['--engine', 'check'], ['--jobs', '2', '--chunk-size', '100']]:
+        sys.argv = ['./greppy.py', './test_groupby.txt', '--stdout-only', *options]
+        assert main() == 0
+        assert capsys.readouterr().out.splitlines() == [
+            'ProductCategory|count()|sum(ProductPrice)|min(ProductPrice)|max(ProductPrice)|avg(ProductPrice)',
+            '|1|3|3|3|3', 'grocery|4|12.5|1|7.5|3.125', 'pets|1|2|2|2|2', 'snacks|3|8|1|5|2.66666666666667']
+    sys.argv = ['./greppy.py', './test_groupby.txt', '--count']
+    assert main() == 0
+    assert capsys.readouterr().out == '9\n'
+
+
+def test_read_headers(tmp_path):
+    """Test reading the header lines of files, and reading them from the cache while the files are unchanged."""
+    files = ['./test_files/schemas/products-2024.csv', './test_files/schemas/products-2025.csv']
+    expected = {files[0]: 'ProductId|ProductPrice|ProductDescription|ProductCategory',
+                files[1]: 'ProductCategory|ProductId|Supplier|ProductDescription'}
+    assert read_headers(files, 2, str(tmp_path)) == expected
+    cache = json.loads((tmp_path / 'headers.json').read_text())
+    assert cache[os.path.abspath(files[0])][2] == expected[files[0]]
+    cache[os.path.abspath(files[0])][2] = 'cached'
+    (tmp_path / 'headers.json').write_text(json.dumps(cache))
+    assert read_headers(files[:1], 1, str(tmp_path)) == {files[0]: 'cached'}
+
+
+def test_main_schemas(capsys):
+    """Test that files with different columns are each searched by column name, and output with the same columns."""
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--engine', 'check'], ['--jobs', '2']]:
+        sys.argv = ['./greppy.py', './test_schemas.txt', '--stdout-only', '--select', 'ProductId,ProductDescription',
+                    *options]
+        assert main() == 0
+        captured = capsys.readouterr().out.splitlines()
+        assert captured[0] == 'ProductId|ProductDescription | file name'
+        assert sorted(captured[1:]) == ['1124|Salty jerky treads| ./test_files/schemas/products-2024.csv',
+                                        '1130|squeaky bone| ./test_files/schemas/products-2025.csv']
+
+
+def test_get_fields_quoted():
+    """Test that names in quotes can contain the separator with !QUOTED."""
+    assert get_fields('./test_files/quoted/test-quoted.csv', 'file', ',', True) == {
+        'ProductId': 1, 'ProductPrice': 2, 'Description, long': 3, 'ProductCategory': 4, '': 0}
+    script = generate_awk_script('$4 ~ /pets/', {}, ',', options=ScriptOptions(quoted=True))
+    assert 'OFS=","' in script and 'if (index($0, "\\"")) _unquote()' in script and 'function _unquote(' in script
+
+
+def test_main_quoted(capsys):
+    """Test !QUOTED and --csv-quoting give the same fields with each engine."""
+    expected = ['ProductId , ProductPrice , "Description, long" , ProductCategory',
+                '1121 , 7.50 , "crumpets, fancy" , grocery', '1122 , 3.00 , "crumpets, plain" , grocery',
+                '1123 , 5.00 , "pretzels, salty ""dog""" , snacks']
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--engine', 'check'], ['--csv-quoting']]:
+        sys.argv = ['./greppy.py', './test_quoted.txt', '--stdout-only', *options]
+        assert main() == 0
+        assert capsys.readouterr().out.splitlines() == expected
+    for engine in ['awk', 'python']:
+        sys.argv = ['./greppy.py', './test_quoted.txt', '--stdout-only', '--select', 'ProductId,$3', '--engine', engine]
+        main()
+        assert capsys.readouterr().out.splitlines() == ['ProductId , "Description, long"', '1121 , "crumpets, fancy"',
+                                                        '1122 , "crumpets, plain"', '1123 , "pretzels, salty ""dog"""']
+    sys.argv = ['./greppy.py', './test_quoted.txt', '--count']
+    main()
+    assert capsys.readouterr().out == '3\n'
+    products = compile_program('!SEPARATOR ,\n!QUOTED\n!SELECT [$3]\nProductCategory | grocery', file_spec='')
+    assert list(products.filter('./test_files/quoted/test-quoted.csv')) == [' "crumpets, fancy" ', ' "crumpets, plain" ']
+
+
+def test_main_limit(capsys):
+    """Test --limit, --count and --exists with each engine and with --jobs."""
+    sys.argv = ['./greppy.py', './test_multi_file.txt', '--stdout-only']
+    main()
+    records = capsys.readouterr().out.splitlines()
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--engine', 'check'], ['--jobs', '2']]:
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--stdout-only', '--limit', '7', *options]
+        assert main() == 0
+        assert capsys.readouterr().out.splitlines() == records[:8]
+    for options in [[], ['--engine', 'python'], ['--jobs', '2', '--chunk-size', '100']]:
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--count', *options]
+        assert main() == 0
+        assert capsys.readouterr().out == '16\n'
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--count', '--limit', '3', *options]
+        main()
+        assert capsys.readouterr().out == '3\n'
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--exists', *options]
+        assert main() == 0
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--exists', '--limit', '17', *options]
+        assert main() == 1
+        assert capsys.readouterr().out == ''
+
+
+def test_main_distinct_top(capsys):
+    """Test --distinct and --top give the same records with each engine and with --jobs."""
+    distinct = Distinct([4], '|', False, 1)
+    lines = [b'1 | a | x | pets\n', b'2 | b | y |  pets \n', b'3 | c | z | snacks\n']
+    assert list(distinct.filter(lines, False)) == [lines[0], lines[2]]
+    assert distinct.spill is not None
+    assert not list(distinct.filter(lines, False))
+    top = TopRecords(2, 2, False, '|', False)
+    top.add_records([b'h\n', b'1 | 2.00\n', b'2 | \n', b'3 | 1.00\n'], 'a', True)
+    top.add_records([b'h\n', b'4 | 1.00\n'], 'b', True)
+    assert top.header == b'h\n'
+    assert top.records == [(b'3 | 1.00', 'a'), (b'4 | 1.00', 'b')]
+    for options in [['--distinct', 'ProductCategory'], ['--top', '4', '--by', 'ProductPrice'],
+                    ['--top', '4', '--by', 'ProductPrice', '--desc', '--distinct', 'ProductPrice']]:
+        outputs = []
+        for engine in [[], ['--engine', 'python'], ['--engine', 'check'], ['--jobs', '2', '--chunk-size', '100']]:
+            sys.argv = ['./greppy.py', './test_multi_file.txt', '--stdout-only', *options, *engine]
+            assert main() == 0
+            outputs.append(capsys.readouterr().out)
+        assert all(output == outputs[0] for output in outputs)
+    assert len(outputs[0].splitlines()) == 4
+
+
+def test_check_arguments():
+    """Test check_arguments and check_program_arguments reject options that can't be combined."""
+    parser = search_parser()
+    args = parser.parse_args(['./test_and.txt', '--jobs', '2', '--chunk-size', '1K', '--limit', '3'])
+    check_arguments(args)
+    check_program_arguments(args, read_program('./test_and.txt'))
+    for options, message in [(['--fast', '--engine', 'python'], '--fast only applies to --engine awk'),
+                             (['--count', '--fast'], '--count and --exists do not write results'),
+                             (['--incremental', '--exists'], '--limit and --exists stop before the end'),
+                             (['--top', '2'], '--top needs --by'),
+                             (['--distinct', 'ProductId', '--limit', '2'], '--distinct and --top cannot'),
+                             (['--chunk-size', '1K'], '--chunk-size splits files')]:
+        with pytest.raises(ValueError, match=message):
+            check_arguments(parser.parse_args(['./test_and.txt', *options]))
+    with pytest.raises(ValueError, match='cannot search standard input'):
+        check_program_arguments(parser.parse_args(['./test_stdin.txt', '--engine', 'check']),
+                                read_program('./test_stdin.txt'))
+    check_program_arguments(parser.parse_args(['./test_groupby.txt', '--count']), read_program('./test_groupby.txt'))
+    for options in [['--select', 'ProductId'], ['--top', '2', '--by', 'ProductPrice']]:
+        with pytest.raises(ValueError, match='cannot be combined'):
+            check_program_arguments(parser.parse_args(['./test_groupby.txt', *options]),
+                                    read_program('./test_groupby.txt'))
+
+
+def test_search_unit(tmp_path, capsys):
+    """Test search_unit and SearchOutput with the python engine, outside of main."""
+    program = read_program('./test_and.txt')
+    file = './test_files/test.csv'
+    header_line = read_header_line(file, 'file')
+    schema = Schema(header_line, fields_from_header(header_line, '|'))
+    predicate = compile_predicate(program, schema.fields, '|')
+    settings = SearchSettings(program, 'python')
+    path = tmp_path / 'out.csv'
+    with path.open('ab') as out:
+        output = SearchOutput(out, path, banners=True)
+        file_stats = FileStats(file)
+        search_unit(settings, output, file, schema, 0, None, [], predicate, file_stats)
+    results = path.read_text()
+    assert [line.split('|')[0].strip() for line in results.splitlines()] == ['ProductId', '1126', '1128', '1129']
+    assert capsys.readouterr().out == f"Results for {file}\n" + results
+    assert (file_stats.rows_scanned, file_stats.rows_matched) == (11, 3)
+    assert file_stats.bytes_read == os.path.getsize(file)
+    assert file_stats.output_bytes == len(results)
+    assert output.header_written
+    # Once the header has been written, later units only add their records, up to the remaining matches
+    output = SearchOutput(io.BytesIO(), console=False, header_written=True)
+    search_unit(settings, output, file, schema, 0, None, [], predicate, remaining=2)
+    assert [line.split('|')[0].strip() for line in output.out.getvalue().decode().splitlines()] == ['1126', '1128']
+    # --top records are kept until relay_collected outputs them for the whole file spec, with the file names
+    output = SearchOutput(io.BytesIO(), console=False, banners=True, multi_file=True)
+    output.top = TopRecords(2, 2)
+    search_unit(settings, output, file, schema, 0, None, [], predicate)
+    assert output.out.getvalue() == b''
+    output.relay_collected('test_files')
+    assert output.out.getvalue().decode().splitlines() == [
+        'ProductId | ProductPrice | ProductDescription | ProductCategory | file name',
+        f'1126 | 1.00 | plain peanut butter | grocery| {file}', f'1129 | 3.00 | peanuts ||| {file}']
+    assert capsys.readouterr().out == 'Results for test_files\n'
+
+
+def test_main_stdin(capsys):
+    """Test searching standard input, with results only on standard output."""
+    sys.argv = ['./greppy.py', './test_and.txt']
+    main()
+    expected = capsys.readouterr().out.split('\n', 1)[1]
+    scripts = set(os.listdir('.'))
+    for engine in ['awk', 'python']:
+        for options in [[], ['--fast']] if engine == 'awk' else [[]]:
+            with open('./test_files/test.csv', 'rb') as stdin:
+                result = subprocess.run([sys.executable, '../runner/greppy.py', './test_stdin.txt', '--stdout-only',
+                                         '--engine', engine, *options], stdin=stdin, capture_output=True,
+                                        check=True)
+            assert result.stdout.decode() == expected
+    # Nothing is saved
+    assert set(os.listdir('.')) == scripts
+
+
+def test_main_compressed(capsys):
+    """Test searching a compressed file gives the same results as searching it uncompressed."""
+    sys.argv = ['./greppy.py', './test_and.txt']
+    main()
+    expected = capsys.readouterr().out.split('\n', 1)[1]
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--engine', 'check']]:
+        sys.argv = ['./greppy.py', './test_compressed.txt', *options]
+        assert main() == 0
+        assert capsys.readouterr().out.split('\n', 1)[1] == expected
+
+
+
+def test_main_compressed_errors(tmp_path, capsys, monkeypatch):
+    """Test a truncated compressed file, or one greppy has no decompressor for, is reported as an error."""
+    truncated = tmp_path / 'test.csv.gz'
+    with open('./test_files/compressed/test.csv.gz', 'rb') as f:
+        truncated.write_bytes(f.read()[:-20])
+    config = tmp_path / 'test_truncated.txt'
+    config.write_text(f'{truncated}\nProductDescription | /nut/\n')
+    sys.argv = ['./greppy.py', str(config), '--stdout-only']
+    assert main() == 1
+    assert f'Could not decompress {truncated}' in capsys.readouterr().err
+    monkeypatch.setattr(shutil, 'which', lambda command: None)
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(ValueError, match='needs the zstd command or the python zstandard module'):
+        decompress_process(str(tmp_path / 'test.csv.zst'), 'zstd')
+
+
+def test_get_compression(tmp_path):
+    """Test compressed files are recognized by extension or magic bytes and read decompressed."""
+    assert get_compression('./test_files/test.csv') is None
+    assert get_compression('./test_files/compressed/test.csv.xz') == 'xz'
+    renamed = tmp_path / 'test'
+    with open('./test_files/compressed/test.csv.gz', 'rb') as f:
+        renamed.write_bytes(f.read())
+    assert get_compression(str(renamed)) == 'gzip'
+    expected = list(read_lines('./test_files/test.csv'))
+    assert list(read_lines(str(renamed))) == expected
+    assert list(read_lines('./test_files/compressed/test.csv.xz')) == expected
+
+
+def test_index(tmp_path, capsys, monkeypatch):
+    """Test exact match lookups with a column index give the same results as a scan."""
+    data = tmp_path / 'test.csv'
+    with open('./test_files/test.csv', 'rb') as f:
+        data.write_bytes(f.read())
+    config = tmp_path / 'test_index.txt'
+    config.write_text(f'{data}\nAND\nProductCategory | [grocery, pets]\nProductDescription | /nut/\n')
+    # Keep the output and awk script, which are named after the program, out of the package
+    monkeypatch.chdir(tmp_path)
+    output = ['--output', str(tmp_path / 'output.csv')]
+    sys.argv = ['./greppy.py', str(config), *output]
+    main()
+    expected = capsys.readouterr().out
+    program = read_program(str(config))
+    fields = get_fields(str(data), 'file', '|')
+    assert index_offsets(program, fields, str(data), True) is None
+    sys.argv = ['./greppy.py', 'index', str(data), 'ProductCategory']
+    assert main() == 0
+    capsys.readouterr()
+    assert build_index(str(data), 'ProductCategory') == 11
+    assert len(index_offsets(program, fields, str(data), True)) == 6
+    # Values with regex characters like '.' can match other values, so they are left to a scan
+    assert build_index(str(data), 'ProductPrice') == 11
+    assert index_offsets(parse_program(f'{data}\nProductPrice | 1.00\n'), fields, str(data), True) is None
+    assert len(index_offsets(parse_program(f'{data}\nProductPrice | 1\n'), fields, str(data), True)) == 0
+    # The index is only used with the header setting it was built with
+    assert index_offsets(program, fields, str(data), False) is None
+    for engine in ['awk', 'python']:
+        sys.argv = ['./greppy.py', str(config), '--engine', engine, *output]
+        main()
+        assert capsys.readouterr().out == expected
+    # Changing the file makes the index out of date
+    with data.open('a') as f:
+        f.write('9999 | 1.00 | nutmeg | grocery\n')
+    assert index_offsets(program, fields, str(data), True) is None
+    # An unreadable index is ignored, and replaced when the file is indexed again
+    index = tmp_path / 'test.csv.gpidx'
+    index.write_bytes(b'not an index')
+    assert index_offsets(program, fields, str(data), True) is None
+    assert 'unreadable index' in capsys.readouterr().err
+    assert build_index(str(data), 'ProductCategory') == 11
+    assert len(index_offsets(program, fields, str(data), True)) == 5
+
+
+
+def test_index_same_results(tmp_path, capsys, monkeypatch):
+    """Test building an index never changes the results, even for clauses only awk matches as written."""
+    data = tmp_path / 'descriptions.csv'
+    data.write_text('Id|Desc\n1|abc5x\n2|abc6x\n1|xyz\n')
+    config = tmp_path / 'test_index_regex.txt'
+    config.write_text(f'{data}\nAND\nId | 1\nDesc | /[[:digit:]]x/\n')
+    monkeypatch.chdir(tmp_path)
+    results = {}
+    for indexed in [False, True]:
+        if indexed:
+            assert build_index(str(data), 'Id') == 3
+        for engine in ['awk', 'python']:
+            sys.argv = ['./greppy.py', str(config), '--stdout-only', '--engine', engine]
+            assert main() == 0
+            results[indexed, engine] = capsys.readouterr().out
+    assert results[False, 'awk'] == 'Id|Desc\n1|abc5x\n'
+    assert len(set(results.values())) == 1
+
+
+def test_zonemap(tmp_path, capsys):
+    """Test files that zone maps show cannot match are skipped, without changing the results."""
+    data = tmp_path / 'schemas'
+    data.mkdir()
+    for name in ['products-2024.csv', 'products-2025.csv']:
+        with open(f'./test_files/schemas/{name}', 'rb') as f:
+            (data / name).write_bytes(f.read())
+    config = tmp_path / 'test_zonemap.txt'
+    for rules, skipped in [('NOT | ProductId | <= 1131', 2), ('NOT\nProductCategory | pets', 0),
+                           ('OR\nProductCategory | [toys]\nProductDescription | squeaky bone', 1),
+                           ('AND\nProductId | > 1124\nProductCategory | grocery', 1), ('ProductId | 11.4', 0),
+                           ('ProductId | >= 1130', 1)]:
+        config.write_text(f'{data}\n{rules}\n')
+        sys.argv = ['./greppy.py', str(config), '--stdout-only', '--no-zonemap']
+        main()
+        expected = capsys.readouterr().out
+        sys.argv = ['./greppy.py', str(config), '--stdout-only', '--build-zonemaps', '--stats', 'json']
+        main()
+        captured = capsys.readouterr()
+        assert captured.out == expected
+        assert json.loads(captured.err[captured.err.index('{'):])['totals']['files_skipped'] == skipped
+    assert sorted(os.listdir(data)) == ['products-2024.csv', 'products-2024.csv.gpzm', 'products-2025.csv',
+                                        'products-2025.csv.gpzm']
+    program = read_program(str(config))
+    fields = get_fields(str(data / 'products-2024.csv'), 'file', '|')
+    assert not zonemap_may_match(program, fields, str(data / 'products-2024.csv'), True)
+    # Changing the file makes the zone map out of date
+    with (data / 'products-2024.csv').open('a') as f:
+        f.write('1127|1.50|nutmeg|grocery\n')
+    assert zonemap_may_match(program, fields, str(data / 'products-2024.csv'), True)
+    assert build_zonemap(str(data / 'products-2024.csv'), bloom_bits=0) == 3
+    assert not zonemap_may_match(program, fields, str(data / 'products-2024.csv'), True)
+    # awk matches values with regex characters like '.' as regexes, so 11.4 can match 1124
+    program = parse_program(f'{data}\nProductId | 11.4\n')
+    assert zonemap_may_match(program, fields, str(data / 'products-2024.csv'), True)
+
+
+def test_prefilter(tmp_path, capsys, monkeypatch):
+    """Test --prefilter only checks the records that contain the required text, without changing the results."""
+    assert [regex_literal(p) for p in ['crumpets', '^a.*bcd$', 'colou?r', 'ab+c', 'x(abc)?yz', '[]x]yz', 'a|b']] == \
+        ['crumpets', 'bcd', 'colo', 'ab', 'yz', 'yz', '']
+    # Bracket classes and gawk's word boundary and other operators are never part of the text
+    assert [regex_literal(p) for p in ['[[:digit:]]x', '[^[:space:]]yz', r'\<abc', r'abc\>', r'\yab\y', r'a\sbc']] == \
+        ['x', 'yz', 'abc', 'abc', 'ab', 'bc']
+    program = parse_program('test.csv\nOR\nProductId | [1123, 1128]\nProductDescription | /crumpets/\n')
+    assert program_literals(program) == ['1123', '1128', 'crumpets']
+    program = parse_program('test.csv\nAND\nProductId | [1123, 1128]\nProductDescription | /nut/\n')
+    assert program_literals(program) == ['nut']
+    assert program_literals(parse_program('test.csv\nNOT | ProductDescription | /nut/\n')) is None
+    # awk matches exact match values as regexes, so a record matching 1.00 only has to contain 00
+    assert program_literals(parse_program('test.csv\nProductPrice | [1.00, 2]\n')) == ['00', '2']
+    assert program_literals(parse_program('test.csv\nOR\nProductPrice | < 2\nProductDescription | /nut/\n')) is None
+    offsets = prefilter_offsets(program, './test_files/test.csv', True)
+    assert [line[:4] for line in read_lines_at('./test_files/test.csv', offsets)] == ['1126', '1127', '1128', '1129']
+    for config in ['./test_and.txt', './test_column_search.txt', './test_select.txt', './test_quoted.txt']:
+        for engine in ['awk', 'python']:
+            sys.argv = ['./greppy.py', config, '--stdout-only', '--engine', engine]
+            main()
+            expected = capsys.readouterr().out
+            sys.argv = ['./greppy.py', config, '--stdout-only', '--engine', engine, '--prefilter']
+            main()
+            assert capsys.readouterr().out == expected
+    data = tmp_path / 'descriptions.csv'
+    data.write_text('Id|Desc\n1|abc5x\n2|xabc\n3|foo abc\n')
+    config = tmp_path / 'test_prefilter_regex.txt'
+    monkeypatch.chdir(tmp_path)
+    for regex in ['/[[:digit:]]x/', '/\\<abc/', '/\\yabc/']:
+        config.write_text(f'{data}\nDesc | {regex}\n')
+        for engine in ['awk', 'python']:
+            sys.argv = ['./greppy.py', str(config), '--stdout-only', '--engine', engine]
+            assert main() == 0
+            expected = capsys.readouterr().out
+            sys.argv.append('--prefilter')
+            assert main() == 0
+            assert capsys.readouterr().out == expected
+
+
+def test_serve(tmp_path, capsys):
+    """Test a server gives the same results as searching with the python engine, on TCP and Unix sockets."""
+    tcp = TCPSearchServer(('127.0.0.1', 0), 2, max_programs=1)
+    unix = UnixSearchServer(str(tmp_path / 'greppy.sock'), 2)
+    rooted = TCPSearchServer(('127.0.0.1', 0), 1, root=str(tmp_path))
+    for server in [tcp, unix, rooted]:
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    try:
+        for config in ['./test_and.txt', './test_multi_file.txt', './test_schemas.txt', './test_groupby.txt']:
+            sys.argv = ['./greppy.py', config, '--stdout-only', '--engine', 'python']
+            main()
+            expected = capsys.readouterr().out
+            for address in [['--port', str(tcp.server_address[1])], ['--socket', str(tmp_path / 'greppy.sock')]]:
+                assert greppy_client.main([config, *address]) == 0
+                assert capsys.readouterr().out == expected
+        assert list(tcp.programs) == [(open('./test_groupby.txt').read(), None)]
+        assert greppy_client.main(['./test_multi_file.txt', '--count', '--port', str(tcp.server_address[1])]) == 0
+        assert capsys.readouterr().out == '16\n'
+        # The server keeps header lines until their files change
+        data = tmp_path / 'data.csv'
+        data.write_text('ProductId | ProductCategory\n1 | pets\n')
+        config = tmp_path / 'test_changed.txt'
+        config.write_text(f'{data}\nProductCategory | pets\n')
+        assert greppy_client.main([str(config), '--port', str(tcp.server_address[1])]) == 0
+        assert len(tcp.schemas) == 1
+        data.write_text('ProductCategory | ProductId\npets | 22\n')
+        assert greppy_client.main([str(config), '--port', str(tcp.server_address[1])]) == 0
+        assert capsys.readouterr().out.splitlines() == ['ProductId | ProductCategory', '1 | pets',
+                                                        'ProductCategory | ProductId', 'pets | 22']
+        # Only the user running the server can connect to its Unix socket, and with a root directory it only
+        # searches files in it
+        assert os.stat(tmp_path / 'greppy.sock').st_mode & 0o777 == 0o600
+        assert greppy_client.main([str(config), '--port', str(rooted.server_address[1])]) == 0
+        assert capsys.readouterr().out == 'ProductCategory | ProductId\npets | 22\n'
+        (tmp_path / 'link.csv').symlink_to(os.path.abspath('./test_files/test.csv'))
+        (tmp_path / 'link.txt').write_text(f'{tmp_path / "link.csv"}\nProductId | 1128\n')
+        for outside in ['./test_and.txt', str(tmp_path / 'link.txt')]:
+            assert greppy_client.main([outside, '--port', str(rooted.server_address[1])]) == 1
+            assert 'is outside the directory the server searches' in capsys.readouterr().err
+        # Errors part way through the results are reported after them
+        data.write_bytes(b'ProductId | ProductCategory\n1 | pets\n2 | \xff pets\n')
+        assert greppy_client.main([str(config), '--port', str(tcp.server_address[1])]) == 1
+        captured = capsys.readouterr()
+        assert captured.out == 'ProductId | ProductCategory\n1 | pets\n'
+        assert "Error: 'utf-8' codec can't decode" in captured.err
+        config = tmp_path / 'test_missing.txt'
+        config.write_text('./missing.csv\nProductId | 1\n')
+        assert greppy_client.main([str(config), '--port', str(tcp.server_address[1])]) == 1
+        assert 'File or directory not found: ./missing.csv' in capsys.readouterr().err
+    finally:
+        for server in [tcp, unix, rooted]:
+            server.shutdown()
+            server.server_close()
+
+
+def test_main_stats(capsys):
+    """Test --stats counts the same records with each engine and with --jobs."""
+    for options in [[], ['--fast'], ['--engine', 'python'], ['--jobs', '2'], ['--jobs', '2', '--chunk-size', '100']]:
+        sys.argv = ['./greppy.py', './test_multi_file.txt', '--stats', 'json', *options]
+        main()
+        captured = capsys.readouterr()
+        stats = json.loads(captured.err)
+        assert [f['rows_scanned'] for f in stats['files']] == [11, 11]
+        assert [f['rows_matched'] for f in stats['files']] == [5, 11]
+        assert stats['totals']['output_bytes'] == len(captured.out.encode()) - len(
+            ''.join(line + '\n' for line in captured.out.splitlines() if line.startswith('Results for')))
+        assert 'parse_program' in stats['stages'] and 'search' in stats['stages']
+
+
+def test_compile_program_stats():
+    """Test filtering in-process with statistics."""
+    products = compile_program("AND\nProductDescription | /nut/\nNOT | ProductCategory | snacks", file_spec='')
+    stats = RunStats()
+    assert products.count('./test_files/test.csv', stats) == 3
+    file_stats = stats.files['./test_files/test.csv']
+    assert (file_stats.rows_scanned, file_stats.rows_matched) == (11, 3)
+    assert file_stats.bytes_read == os.path.getsize('./test_files/test.csv')
+    assert 'rows_matched' in stats.format()
+
+
+def test_optimize_rules():
+    """Test the optimizer reorders clauses, uses arrays for lists and drops redundant range bounds."""
+    fields = {'ProductId': 1, 'ProductPrice': 2, 'ProductDescription': 3, 'ProductCategory': 4, '': 0}
+    program = parse_program('test.csv\nAND\nProductDescription | /nut/\nNOT | ProductId | [1123, 2234, 1111]\n'
+                            'ProductCategory | pets\nProductPrice | >= 2\nProductPrice | >= 3\nProductPrice | < 5\n')
+    match, begin, prelude = optimize_rules(program, fields)
+    assert match == '$2 >= 3 && $2 < 5 && !(_norm($1) in _list1) && _norm($4) == "pets" && $3 ~ /nut/'
+    assert begin == '_split = split("1123\\n2234\\n1111", _values, "\\n"); ' \
+        'for (_i = 1; _i <= _split; _i++) _list1[_values[_i]];'
+    assert prelude == ''
+    # Bounds are kept if comparing their string forms would give a different answer
+    program = parse_program('test.csv\nAND\nProductPrice | >= 9\nProductPrice | >= 10\nProductPrice | < 5\n'
+                            'ProductPrice | <= 5\n')
+    assert optimize_rules(program, fields)[0] == '$2 >= 9 && $2 >= 10 && $2 < 5'
+    # Fields tested by more than one literal clause are normalized once
+    program = parse_program('test.csv\nOR\nProductCategory | pets\n!AWK | ProductPrice > 5\n'
+                            'ProductCategory | [snacks, grocery]\n')
+    match, begin, prelude = optimize_rules(program, fields)
+    assert match == '(_n4 == "pets" || $2 > 5 || (_n4 in _list1))'
+    assert prelude == '_n4 = _norm($4);'
+    script = generate_awk_script(match, fields, begin=begin, prelude=prelude)
+    assert script.split('\n')[1:3] == [f'BEGIN {{ {begin} }}', '{ _n4 = _norm($4); }']
+    assert 'function _norm(s)' in script
+
+
+def test_main_optimize(capsys):
+    """Test optimized scripts give the same results."""
+    for config in ['./test_awk_add_fields.txt', './test_in_prices_no_header.txt', './test_multi_file.txt']:
+        sys.argv = ['./greppy.py', config, '--no-optimize']
+        main()
+        expected = capsys.readouterr().out
+        sys.argv = ['./greppy.py', config]
+        main()
+        assert capsys.readouterr().out == expected
+
+
+def test_read_program():
+    """Test the program parser reads everything in one pass."""
+    program = read_program('./test_and_no_header.txt')
+    assert program.file_spec == 'test_files/no-header/test-no-header.csv'
+    assert program.path_type == 'file'
+    assert program.fields == {'ProductId': 1, 'ProductPrice': 2,
+                              'ProductDescription': 3, 'ProductCategory': 4, '': 0}
+    assert program.operator == '&&'
+    assert not program.negate
+    assert program.clauses == [Clause(False, 'ProductDescription', '/nut/'),
+                               Clause(True, 'ProductCategory', 'snacks')]
+    assert [clause.kind for clause in program.clauses] == ['regex', 'equal']
+
+
+def test_parse_program_directives():
+    """Test directives and list clauses in program text."""
+    program = parse_program('test.csv\n!SEPARATOR ,\n!NOHEADER\nNOT\n$4 | [grocery, pets]\n')
+    assert program.field_separator == ','
+    assert program.noheader
+    assert program.negate
+    assert program.clauses[0].kind == 'list'
+    assert program.clauses[0].values == ['grocery', 'pets']
+    assert parse_rules(program, {}) == '!($4 ~ /^[ ]*"?(grocery|pets)"?[ ]*$/)'
+
+
+def test_get_cached_script(tmp_path):
+    """Test awk scripts are generated once, then read from the cache."""
+    program = read_program('./test_and.txt')
+    header_line = read_header_line('./test_files/test.csv', 'file')
+    key = script_cache_key(program, header_line, ScriptOptions())
+    assert key == script_cache_key(program, header_line, ScriptOptions(fast=False))
+    # Every option, and whether the input has a header or the rules are optimized, changes the key
+    for name in ScriptOptions._fields:
+        changed = ScriptOptions()._replace(**{name: [1] if name in ['select', 'distinct'] else 'x'})
+        assert key != script_cache_key(program, header_line, changed)
+    assert key != script_cache_key(program, header_line, ScriptOptions(), has_fields=False)
+    assert key != script_cache_key(program, header_line, ScriptOptions(), optimize=False)
+    calls = []
+
+    def generate():
+        calls.append(1)
+        return 'BEGIN { FS="|"}\n'
+    assert get_cached_script(key, generate, str(tmp_path)) == 'BEGIN { FS="|"}\n'
+    assert get_cached_script(key, generate, str(tmp_path)) == 'BEGIN { FS="|"}\n'
+    assert len(calls) == 1
+
+
+def test_evict_cache(tmp_path):
+    """Test the least recently used scripts are evicted first."""
+    for i, name in enumerate(['old', 'middle', 'new']):
+        path = tmp_path / (name + '.awk')
+        path.write_text('x' * 100)
+        os.utime(path, (i, i))
+    evict_cache(str(tmp_path), 250)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['middle.awk', 'new.awk']
+
+
+def test_compile_program_filter():
+    """Test filtering in-process with the library API."""
+    products = compile_program('AND\nProductDescription | /nut/\nNOT | ProductCategory | snacks', file_spec='')
+    assert list(products.filter('./test_files/test.csv')) == [
+        '1126 | 1.00 | plain peanut butter | grocery',
+        '1128 || "peanut butter dog treats" | pets',
+        '1129 | 3.00 | peanuts ||']
+    with open('./test_files/test.csv', 'rb') as f:
+        assert products.count(f) == 3
+    lines = ['ProductDescription | ProductCategory', 'peanut | snacks', 'walnut | grocery']
+    assert list(products.filter(lines)) == ['walnut | grocery']
+
+
+def test_compile_program_file_spec():
+    """Test the file spec in the program is the default input."""
+    products = compile_program(open('./test_in_prices_no_header.txt', encoding='utf-8').read())
+    assert products.count() == 2
+
+
+def test_generate_batch_script():
+    """Test generate_batch_script routes matching records to an output per program."""
+    fields = get_fields('./test_files/test.csv', 'file', '|')
+    script_lines = generate_batch_script(['$4 ~ /pets/', '$3 ~ /nut/'], fields).split('\n')
+    assert script_lines[0] == 'BEGIN { FS="|"}'
+    assert script_lines[1] == 'NR == 1 { print $0 > out1; print $0 > out2 }'
+    assert script_lines[2] == 'NR > 1 { if ($4 ~ /pets/) print $0 > out1; if ($3 ~ /nut/) print $0 > out2 }'
+    script_lines = generate_batch_script(['$1 ~ /pets/', '$4 ~ /nut/'], fields, selects=[None, [2, 4]],
+                                         headers=['A|B|C|D', 'B|D']).split('\n')
+    assert script_lines[1] == 'NR == 1 { print "A|B|C|D" > out1; print "B|D" > out2 }'
+    assert script_lines[2] == 'NR > 1 { if ($1 ~ /pets/) print $0 > out1; if ($4 ~ /nut/) print $2 "|" $4 > out2 }'
+
+
+def test_main_batch(tmp_path, capsys):
+    """Test batch mode writes the same output for each program as separate runs."""
+    programs = ['./test_multi_file.txt', './test_pwd.txt', './test_value_range.txt']
+    for options in [[], ['--no-optimize'], ['--jobs', '2']]:
+        batch_dir = tmp_path / 'batch'
+        batch_dir.mkdir()
+        sys.argv = ['./greppy.py', 'batch', *programs, '--output-dir', str(batch_dir), *options]
+        assert main() == 0
+        for program in programs:
+            expected = tmp_path / 'expected.csv'
+            sys.argv = ['./greppy.py', program, '--output', str(expected), '--no-console']
+            main()
+            assert (batch_dir / (get_output_name('./test_files', program) + '.csv')).read_bytes() == \
+                expected.read_bytes()
+            expected.unlink()
+        capsys.readouterr()
+        for path in batch_dir.iterdir():
+            path.unlink()
+        batch_dir.rmdir()
+
+
+def test_main_batch_schemas(tmp_path, capsys):
+    """Test batch mode searches files with different columns by column name, as separate runs do."""
+    selected = tmp_path / 'test_schemas_select.txt'
+    selected.write_text('./test_files/schemas\n!SELECT [ProductDescription, ProductId]\nProductDescription | /o/\n')
+    programs = ['./test_schemas.txt', str(selected)]
+    sys.argv = ['./greppy.py', 'batch', *programs, '--output-dir', str(tmp_path)]
+    assert main() == 0
+    for program in programs:
+        expected = tmp_path / 'expected.csv'
+        sys.argv = ['./greppy.py', program, '--output', str(expected), '--no-console']
+        main()
+        assert (tmp_path / (get_output_name('./test_files/schemas', program) + '.csv')).read_bytes() == \
+            expected.read_bytes()
+        expected.unlink()
+    capsys.readouterr()
+
+
+def test_plan_increment(tmp_path):
+    """Test incremental searches pick up appended lines, leave partial lines and restart rotated files."""
+    data = tmp_path / 'data.csv'
+    data.write_bytes(b'id|cat\n1|pets\n2|fo')
+    ranges, files = plan_increment([str(data)], {})
+    assert ranges == {str(data): (0, 14)}
+    with data.open('ab') as f:
+        f.write(b'od\n3|pets\n')
+    ranges, files = plan_increment([str(data)], files)
+    assert ranges == {str(data): (14, 28)}
+    assert plan_increment([str(data)], files) == ({}, files)
+    data.unlink()
+    data.write_bytes(b'id|cat\n')
+    assert plan_increment([str(data)], files)[0] == {str(data): (0, 7)}
+
+
+def test_main_incremental(tmp_path, capsys, monkeypatch):
+    """Test --incremental only searches the records added since the last run."""
+    monkeypatch.chdir(tmp_path)
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    program = tmp_path / 'program.txt'
+    program.write_text(f'{data_dir}\nProductCategory | pets\n')
+    for options in [[], ['--engine', 'python'], ['--fast', '--jobs', '2']]:
+        output, state = tmp_path / 'output.csv', tmp_path / 'state.json'
+        (data_dir / 'a.csv').write_text('ProductId | ProductCategory\n1 | pets\n2 | grocery\n')
+        sys.argv = ['./greppy.py', str(program), '--incremental', '--no-console', '--output', str(output),
+                    '--state', str(state), *options]
+        main()
+        with (data_dir / 'a.csv').open('a') as f:
+            f.write('3 | pets\n4 | pe')
+        (data_dir / 'b.csv').write_text('ProductId | ProductCategory\n5 | pets\n')
+        main()
+        main()
+        with (data_dir / 'a.csv').open('a') as f:
+            f.write('ts\n')
+        main()
+        assert output.read_text().splitlines() == [
+            'ProductId | ProductCategory | file name', f'1 | pets| {data_dir / "a.csv"}',
+            f'3 | pets| {data_dir / "a.csv"}', f'5 | pets| {data_dir / "b.csv"}', f'4 | pets| {data_dir / "a.csv"}']
+        output.unlink()
+        state.unlink()
+        (data_dir / 'b.csv').unlink()
+    capsys.readouterr()
+    # The state file goes next to the --output file by default, and has to be writable
+    sys.argv = ['./greppy.py', str(program), '--incremental', '--no-console', '--engine', 'python',
+                '--output', str(output)]
+    main()
+    assert (tmp_path / 'output.state').exists()
+    sys.argv += ['--state', str(tmp_path / 'missing' / 'state.json')]
+    with pytest.raises(SystemExit):
+        main()
+    assert 'cannot write the state file' in capsys.readouterr().err